@@ -0,0 +1,8 @@
+"""
+    Benchmarks for the overhead the test.ai SDK adds on top of selenium.
+
+    TestAiDriver is run against an in-process FakeWebDriver and a local StandInServer in place of sdk.test.ai,
+    run `python -m benchmarks.run --help` for the options.
+"""
+from benchmarks.fake_driver import FakeWebDriver, FakeWebElement
+from benchmarks.fake_server import StandInServer
@@ -0,0 +1,255 @@
+import base64
+import io
+import json
+import random
+import time
+
+from PIL import Image, ImageDraw
+from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.remote.command import Command
+from selenium.webdriver.remote.webelement import WebElement
+
+from test_ai import test_ai
+
+
+class FakeWebElement(WebElement):
+    """
+        A WebElement whose commands are answered by the FakeWebDriver it belongs to.
+    """
+    def __init__(self, parent, id_, rect, tag_name):
+        super(FakeWebElement, self).__init__(parent, id_)
+        self._fake_rect = rect
+        self._fake_tag_name = tag_name
+
+
+class FakeWebDriver():
+    """
+        Stands in for a selenium WebDriver with a generated page of dom_size elements.
+
+        Every command sleeps for `latency` seconds, screenshots additionally for `screenshot_latency` seconds per
+        megapixel, and is counted in `round_trips` so the WebDriver traffic of the SDK can be measured.
+        Selectors listed in `broken_selectors` fail to find anything after waiting out the implicit wait.
+    """
+    def __init__(self, dom_size=1000, width=1280, height=800, device_pixel_ratio=2, latency=0.0,
+                 screenshot_latency=0.0, seed=0):
+        self.session_id = 'fake-session'
+        self.capabilities = {'browserName': 'fake'}
+        self.width = width
+        self.height = height
+        self.device_pixel_ratio = device_pixel_ratio
+        self.latency = latency
+        self.screenshot_latency = screenshot_latency
+        self.broken_selectors = set()
+        self.implicit_wait = 0
+        self.round_trips = {}
+        self._page_id = 0
+        self._page_version = 0
+        self._layout = None
+        self._screenshot = None
+        # Page.captureScreenshot parameters of the last capture and the screenshots taken with them
+        self._capture_params = None
+        self._captures = {}
+        self._random = random.Random(seed)
+        self.elements = self._generate_elements(dom_size)
+
+    def _generate_elements(self, dom_size):
+        elements = [FakeWebElement(self, 'element-0', {'x': 0, 'y': 0, 'width': self.width, 'height': self.height}, 'html')]
+        for i in range(1, dom_size):
+            width = self._random.randint(20, 300)
+            height = self._random.randint(10, 60)
+            rect = {'x': self._random.randint(0, self.width - width), 'y': self._random.randint(0, self.height - height),
+                    'width': width, 'height': height}
+            tag_name = self._random.choice(['div', 'div', 'div', 'span', 'a', 'input', 'button'])
+            elements.append(FakeWebElement(self, 'element-%d' % i, rect, tag_name))
+        return elements
+
+    def _round_trip(self, name, extra_latency=0.0):
+        self.round_trips[name] = self.round_trips.get(name, 0) + 1
+        if self.latency or extra_latency:
+            time.sleep(self.latency + extra_latency)
+
+    def total_round_trips(self):
+        return sum(self.round_trips.values())
+
+    def mutate(self):
+        """
+            Changes the page the way a DOM update would, so the next screenshot differs.
+        """
+        self._page_version += 1
+        element = self._random.choice(self.elements[1:])
+        element._fake_rect = dict(element._fake_rect, x=self._random.randint(0, self.width - element._fake_rect['width']))
+        self._screenshot = None
+        self._captures = {}
+        # Render right away so drawing the fake page is not counted in the timings of the SDK
+        self._png()
+        if self._capture_params is not None:
+            self._capture(self._capture_params)
+
+    def _png(self):
+        if self._screenshot is None:
+            scale = self.device_pixel_ratio
+            img = Image.new('RGB', (self.width * scale, self.height * scale), 'white')
+            draw = ImageDraw.Draw(img)
+            for i, element in enumerate(self.elements[1:]):
+                r = element._fake_rect
+                shade = (i * 37) % 200
+                draw.rectangle([r['x'] * scale, r['y'] * scale, (r['x'] + r['width']) * scale - 1,
+                                (r['y'] + r['height']) * scale - 1], outline=(shade, shade, 255 - shade))
+            buf = io.BytesIO()
+            img.save(buf, 'PNG')
+            self._screenshot = buf.getvalue()
+        return self._screenshot
+
+    def _capture(self, params):
+        """
+            Screenshot as Page.captureScreenshot takes it with params: clipped, scaled and encoded in their format.
+        """
+        cache_key = json.dumps(params, sort_keys=True)
+        if cache_key not in self._captures:
+            img = Image.open(io.BytesIO(self._png()))
+            clip = params.get('clip')
+            if clip:
+                scale = self.device_pixel_ratio
+                img = img.crop((round(clip['x'] * scale), round(clip['y'] * scale),
+                                round((clip['x'] + clip['width']) * scale), round((clip['y'] + clip['height']) * scale)))
+                if clip.get('scale', 1) != 1:
+                    img = img.resize((round(img.size[0] * clip['scale']), round(img.size[1] * clip['scale'])))
+            image_format = params.get('format', 'png')
+            options = {'quality': params.get('quality', 80)} if image_format != 'png' else {}
+            buf = io.BytesIO()
+            img.save(buf, image_format.upper(), **options)
+            self._captures[cache_key] = buf.getvalue()
+        return self._captures[cache_key]
+
+    def _screenshot_latency(self, image=None):
+        if image is None:
+            width, height = self.width * self.device_pixel_ratio, self.height * self.device_pixel_ratio
+        else:
+            width, height = Image.open(io.BytesIO(image)).size
+        return self.screenshot_latency * width * height / 1e6
+
+    # WebDriver API used by TestAiDriver
+
+    def get(self, url):
+        self._round_trip('get')
+        self._page_id += 1
+        self._page_version = 0
+
+    def implicitly_wait(self, time_to_wait):
+        self._round_trip('implicitly_wait')
+        self.implicit_wait = time_to_wait
+
+    def get_window_size(self, windowHandle='current'):
+        self._round_trip('get_window_size')
+        return {'width': self.width, 'height': self.height}
+
+    def get_screenshot_as_base64(self):
+        self._round_trip('screenshot', self._screenshot_latency())
+        return base64.b64encode(self._png()).decode('ascii')
+
+    def get_screenshot_as_png(self):
+        self._round_trip('screenshot', self._screenshot_latency())
+        return self._png()
+
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        if cmd == 'Page.captureScreenshot':
+            self._capture_params = cmd_args
+            image = self._capture(cmd_args)
+            self._round_trip('screenshot', self._screenshot_latency(image))
+            return {'data': base64.b64encode(image).decode('ascii')}
+        self._round_trip('execute_cdp_cmd')
+        if cmd == 'Page.getLayoutMetrics':
+            return {'layoutViewport': {'clientWidth': self.width * self.device_pixel_ratio},
+                    'cssLayoutViewport': {'clientWidth': self.width},
+                    'cssVisualViewport': {'pageX': 0, 'pageY': 0, 'clientWidth': self.width,
+                                          'clientHeight': self.height}}
+        return {}
+
+    def find_element(self, by='id', value=None):
+        if value in self.broken_selectors:
+            self._round_trip('find_element', self.implicit_wait)
+            raise NoSuchElementException('Unable to locate element: %s' % value)
+        self._round_trip('find_element')
+        # Any working selector finds the same input in the middle of the page
+        return self.elements[len(self.elements) // 2]
+
+    def find_elements(self, by='id', value=None):
+        if value in self.broken_selectors:
+            self._round_trip('find_elements', self.implicit_wait)
+            return []
+        self._round_trip('find_elements')
+        if value == '//*':
+            return list(self.elements)
+        middle = len(self.elements) // 2
+        return self.elements[middle:middle + 5]
+
+    def find_elements_by_xpath(self, xpath):
+        return self.find_elements('xpath', xpath)
+
+    def execute(self, driver_command, params=None):
+        self._round_trip(driver_command)
+        if driver_command == Command.W3C_ACTIONS:
+            return {'value': None}
+        element = self.elements[int(params['id'].split('-')[1])]
+        if driver_command == Command.GET_ELEMENT_RECT:
+            return {'value': dict(element._fake_rect)}
+        if driver_command == Command.GET_ELEMENT_TAG_NAME:
+            return {'value': element._fake_tag_name}
+        return {'value': None}
+
+    def execute_script(self, script, *args):
+        self._round_trip('execute_script')
+        if script == test_ai.PAGE_VERSION_SCRIPT:
+            return '%d:%d' % (self._page_id, self._page_version)
+        if script == test_ai.MATCH_BOX_SCRIPT:
+            return self._match_box(args[0])
+        if script == test_ai.MATCH_BOXES_SCRIPT:
+            return [self._match_box(box) for box in args[0]]
+        if script == test_ai.ELEMENT_VIEWPORT_RECT_SCRIPT:
+            r = args[0]._fake_rect
+            return [r['x'], r['y'], r['width'], r['height'], 0, 0]
+        if script == test_ai.ELEMENT_RECTS_SCRIPT:
+            return [[e._fake_rect[k] for k in ('x', 'y', 'width', 'height')] for e in args[0]]
+        if script == test_ai.LAYOUT_SNAPSHOT_SCRIPT:
+            rects = []
+            for element in self.elements:
+                r = element._fake_rect
+                rects.extend([r['x'], r['y'], r['width'], r['height']])
+            version = '%d:%d' % (self._page_id, self._page_version)
+            self._layout = (args[0], version)
+            return [version, rects, [element._fake_tag_name for element in self.elements]]
+        if script == test_ai.RESOLVE_LAYOUT_SCRIPT:
+            if self._layout != (args[0], '%d:%d' % (self._page_id, self._page_version)):
+                return None
+            return [self.elements[i] for i in args[1]]
+        if 'devicePixelRatio' in script:
+            return self.device_pixel_ratio
+        return None
+
+    def execute_async_script(self, script, *args):
+        self._round_trip('execute_async_script')
+        return None
+
+    def _match_box(self, box):
+        # Same scoring as MATCH_BOX_SCRIPT does in the browser
+        cx, cy = box['x'] + box['width'] / 2, box['y'] + box['height'] / 2
+        results = []
+        for element in self.elements:
+            r = element._fake_rect
+            if not (r['x'] < cx < r['x'] + r['width'] and r['y'] < cy < r['y'] + r['height']):
+                continue
+            dx = min(box['x'] + box['width'], r['x'] + r['width']) - max(box['x'], r['x'])
+            dy = min(box['y'] + box['height'], r['y'] + r['height']) - max(box['y'], r['y'])
+            overlap = dx * dy if dx >= 0 and dy >= 0 else 0
+            union = box['width'] * box['height'] + r['width'] * r['height'] - overlap
+            score = overlap / union if union > 0 else 0
+            if score > 0:
+                results.append([element, score, element._fake_tag_name])
+        results.sort(key=lambda x: x[1], reverse=True)
+        return results
+
+    def close(self):
+        self._round_trip('close')
+
+    def quit(self):
+        self._round_trip('quit')
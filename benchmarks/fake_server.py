@@ -0,0 +1,197 @@
+import base64
+import email
+import gzip
+import io
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+class StandInServer():
+    """
+        Local HTTP stand-in for the sdk.test.ai endpoints the SDK calls.
+
+        Boxes sent to /add_action are remembered and returned by /check_screenshot_exists like the real server does,
+        /classify answers with `classify_box`, if it lies in the crop for region requests, or `classify_boxes` when
+        asked for every match, and /test_case/get_bounding_box returns the boxes set with label_test_case_box, holding
+        long-poll requests open until then, unless `long_poll` is off like on servers that answer right away.
+        Requests, bytes received and bytes sent are counted per endpoint and every request is delayed by `latency`
+        seconds. fail_next makes an endpoint answer with error statuses.
+    """
+    def __init__(self, latency=0.0, classify_box=None, classify_boxes=None, long_poll=True, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.long_poll = long_poll
+        self.classify_box = classify_box
+        self.classify_boxes = classify_boxes
+        self.requests = {}
+        self.bytes_received = {}
+        self.bytes_sent = {}
+        self.boxes = {}
+        self.test_case_boxes = {}
+        self.failures = {}
+        self._lock = threading.Lock()
+        self._labeled = threading.Condition(self._lock)
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='testai-stand-in-server', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes_received.clear()
+            self.bytes_sent.clear()
+
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def total_bytes_received(self):
+        return sum(self.bytes_received.values())
+
+    def fail_next(self, endpoint, *statuses):
+        """
+            Answers the next requests to endpoint with statuses, one per request, before handling them again.
+        """
+        with self._lock:
+            self.failures.setdefault(endpoint, []).extend(statuses)
+
+    def _next_failure(self, endpoint):
+        with self._lock:
+            statuses = self.failures.get(endpoint)
+            return statuses.pop(0) if statuses else None
+
+    def label_test_case_box(self, label, box):
+        """
+            Draws the box of label like a user would in the test case UI.
+        """
+        with self._labeled:
+            self.test_case_boxes[label] = box
+            self._labeled.notify_all()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                endpoint = urllib.parse.urlparse(self.path).path
+                if server.latency:
+                    time.sleep(server.latency)
+                failure = server._next_failure(endpoint)
+                try:
+                    if failure is not None:
+                        status, response = failure, {'success': False, 'message': 'Injected failure'}
+                    else:
+                        status, response = 200, server.handle(endpoint, server.parse_body(self.headers, body))
+                except Exception as e:
+                    status, response = 400, {'success': False, 'message': repr(e)}
+                out = json.dumps(response).encode('utf-8')
+                with server._lock:
+                    server.requests[endpoint] = server.requests.get(endpoint, 0) + 1
+                    server.bytes_received[endpoint] = server.bytes_received.get(endpoint, 0) + len(body)
+                    server.bytes_sent[endpoint] = server.bytes_sent.get(endpoint, 0) + len(out)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+        return Handler
+
+    def classify_region(self, key, data):
+        """
+            Answers /classify for a crop of the screenshot at offset, finding `classify_box` when its center is in it.
+        """
+        left, top = json.loads(data['offset'])
+        screenshot = data['screenshot']
+        if isinstance(screenshot, str):
+            screenshot = base64.b64decode(screenshot)
+        width, height = Image.open(io.BytesIO(screenshot)).size
+        scale = float(data.get('screenshot_scale') or 1)
+        box = self.classify_box
+        cx, cy = (box['x'] + box['width'] / 2 - left) * scale, (box['y'] + box['height'] / 2 - top) * scale
+        if not (0 <= cx < width and 0 <= cy < height):
+            return {'success': False, 'key': key, 'message': 'Did not find'}
+        return {'success': True, 'key': key, 'elem': dict(box, x=(box['x'] - left) * scale,
+                                                           y=(box['y'] - top) * scale,
+                                                           width=box['width'] * scale, height=box['height'] * scale)}
+
+    def parse_body(self, headers, body):
+        content_type = headers.get('Content-Type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body)
+        if content_type.startswith('multipart/form-data'):
+            message = email.message_from_bytes(b'Content-Type: ' + content_type.encode('ascii') + b'\r\n\r\n' + body)
+            parts = {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+                     for part in message.get_payload()}
+            data = json.loads(gzip.decompress(parts.pop('metadata')))
+            data.update(parts)
+            return data
+        return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode('utf-8')).items()}
+
+    def handle(self, endpoint, data):
+        if endpoint == '/check_screenshot_exists':
+            if 'labels' in data:
+                return {'success': True, 'boxes': {label: self.boxes.get((data['screenshot_uuid'], label))
+                                                   for label in data['labels']}}
+            box = self.boxes.get((data['screenshot_uuid'], data['label']))
+            return {'success': True, 'box': box} if box else {'success': False}
+        if endpoint == '/add_action':
+            box = {k: data[k] for k in ('x', 'y', 'width', 'height')}
+            with self._lock:
+                self.boxes[(data['key'], data['label'])] = box
+            return {'success': True}
+        if endpoint == '/classify':
+            key = uuid.uuid4().hex
+            if 'labels' in data:
+                labels = json.loads(data['labels'])
+                return {'success': True, 'key': key, 'elems': {label: self.classify_box for label in labels}}
+            if data.get('multiple') in (True, 'True'):
+                boxes = self.classify_boxes or ([self.classify_box] if self.classify_box else [])
+                if not boxes:
+                    return {'success': False, 'key': key, 'message': 'Did not find'}
+                return {'success': True, 'key': key, 'boxes': boxes}
+            if self.classify_box is None:
+                return {'success': False, 'key': key, 'message': 'Did not find'}
+            if 'offset' in data:
+                return self.classify_region(key, data)
+            return {'success': True, 'key': key, 'elem': self.classify_box}
+        if endpoint == '/test_case/upload_screenshot':
+            return {'success': True, 'key': uuid.uuid4().hex}
+        if endpoint == '/test_case/get_bounding_box':
+            deadline = time.time() + (float(data.get('wait') or 0) if self.long_poll else 0)
+            with self._labeled:
+                while data['label'] not in self.test_case_boxes and time.time() < deadline:
+                    self._labeled.wait(deadline - time.time())
+                return {'success': True, 'box': self.test_case_boxes.get(data['label'])}
+        # /sdk_checkin, /upload_screenshot, /test_case/set_test_case_status
+        return {'success': True}
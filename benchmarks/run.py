@@ -0,0 +1,234 @@
+"""
+    Measures the overhead of TestAiDriver against a fake WebDriver and a local stand-in server.
+
+    Usage:
+        python -m benchmarks.run --dom-size 5000 --driver-latency 0.002 --option track_page_changes=true
+"""
+import argparse
+import json
+import logging
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmarks.fake_driver import FakeWebDriver
+from benchmarks.fake_server import StandInServer
+from test_ai.test_ai import TestAiDriver, testai_elem
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+class Benchmark():
+    def __init__(self, args):
+        self.args = args
+        self.options = dict(parse_option(option) for option in args.option)
+        self.cache_dir = tempfile.mkdtemp(prefix='testai-bench-')
+        self.server = StandInServer(latency=args.server_latency).start()
+        self.driver = FakeWebDriver(dom_size=args.dom_size, width=args.width, height=args.height,
+                                    device_pixel_ratio=args.device_pixel_ratio, latency=args.driver_latency,
+                                    screenshot_latency=args.screenshot_latency)
+        self.driver.broken_selectors.add('broken')
+        self.testai_driver = None
+        self._next_target = 0
+        self._random = random.Random(0)
+
+    def close(self):
+        if self.testai_driver is not None:
+            self.testai_driver.flush()
+        self.server.stop()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def new_testai_driver(self, **kwargs):
+        options = dict(self.options, **kwargs)
+        options.setdefault('cache_dir', self.cache_dir)
+        testai_driver = TestAiDriver(self.driver, 'benchmark', test_case_name='benchmark', server_url=self.server.url,
+                                     **options)
+        if self.args.implicit_wait:
+            testai_driver.implicitly_wait(self.args.implicit_wait)
+        return testai_driver
+
+    def target_box(self):
+        """
+            Screenshot pixel box of a different element every call, as the classifier would return it.
+        """
+        elements = self.driver.elements
+        self._next_target = (self._next_target + 7919) % (len(elements) - 1)
+        rect = elements[1 + self._next_target]._fake_rect
+        return {k: v * self.testai_driver.multiplier for k, v in rect.items()}
+
+    def before_each(self):
+        if not self.args.static_page:
+            self.driver.mutate()
+
+    # Operations, each returns the function to time for one iteration
+
+    def op_startup(self):
+        def run():
+            self.new_testai_driver()
+        return run
+
+    def op_find_element(self):
+        def run():
+            self.testai_driver.find_element('id', 'working')
+        return run
+
+    def op_ai_fallback(self):
+        def run():
+            self.server.classify_box = self.target_box()
+            self.testai_driver.find_element('id', 'broken')
+        return run
+
+    def op_ai_fallback_nearby(self):
+        # The element only moves a little between iterations, like between two builds of an app. This is what the
+        # opt-in region of interest is for, so the operations from here on use a driver with it turned on
+        if self.testai_driver.label_boxes is None:
+            self.testai_driver.flush()
+            self.testai_driver = self.new_testai_driver(region_of_interest=True)
+        element = self.driver.elements[1]
+        origin = dict(element._fake_rect)
+
+        def run():
+            element._fake_rect = dict(origin, x=origin['x'] + self._random.randint(-20, 20),
+                                      y=origin['y'] + self._random.randint(-20, 20))
+            self.driver.mutate()
+            self.server.classify_box = {k: v * self.testai_driver.multiplier for k, v in element._fake_rect.items()}
+            self.testai_driver.find_element('id', 'broken')
+        return run
+
+    def op_find_elements_fallback(self):
+        def run():
+            self.server.classify_boxes = [self.target_box() for _ in range(20)]
+            self.testai_driver.find_elements('id', 'broken', element_name='results')
+        return run
+
+    def op_form_entry(self):
+        # Types into five fields found by the classifier, like filling in a form
+        def run():
+            for _ in range(5):
+                box = self.target_box()
+                field = testai_elem(None, box, box, self.driver, self.testai_driver.multiplier,
+                                    inputs=self.testai_driver.inputs)
+                field.send_keys('hello')
+        return run
+
+    def op_match_bounding_box(self):
+        def run():
+            self.testai_driver._match_bounding_box_to_selenium_element(self.target_box(),
+                                                                       multiplier=self.testai_driver.multiplier)
+        return run
+
+    def measure(self, name):
+        run = getattr(self, 'op_' + name)()
+        # Warm up connections, caches and lazy imports so they don't skew the first sample
+        self.before_each()
+        run()
+        self.testai_driver.flush()
+        self.server.reset_counters()
+        self.driver.round_trips.clear()
+        timings = []
+        for _ in range(self.args.iterations):
+            self.before_each()
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        self.testai_driver.flush()
+        result = {
+            'operation': name,
+            'iterations': self.args.iterations,
+            'p50_ms': percentile(timings, 50) * 1000,
+            'p90_ms': percentile(timings, 90) * 1000,
+            'p99_ms': percentile(timings, 99) * 1000,
+            'webdriver_round_trips': 1.0 * self.driver.total_round_trips() / self.args.iterations,
+            'server_round_trips': 1.0 * self.server.total_requests() / self.args.iterations,
+            'bytes_uploaded': 1.0 * self.server.total_bytes_received() / self.args.iterations,
+        }
+        # Memory is measured in a separate pass as tracemalloc slows everything down
+        tracemalloc.start()
+        for _ in range(self.args.memory_iterations):
+            self.before_each()
+            run()
+        self.testai_driver.flush()
+        result['peak_memory_kb'] = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+        return result
+
+    def run(self, operations):
+        self.testai_driver = self.new_testai_driver()
+        return [self.measure(name) for name in operations]
+
+
+def parse_option(option):
+    name, _, value = option.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return name, value
+
+
+def print_table(results, out=sys.stdout):
+    columns = ['operation', 'p50_ms', 'p90_ms', 'p99_ms', 'webdriver_round_trips', 'server_round_trips',
+               'bytes_uploaded', 'peak_memory_kb']
+    widths = [max([len(c), 12] + [len(r[c]) for r in results if isinstance(r[c], str)]) for c in columns]
+    out.write('  '.join(c.rjust(w) for c, w in zip(columns, widths)) + '\n')
+    for result in results:
+        cells = []
+        for column, width in zip(columns, widths):
+            value = result[column]
+            cells.append((value if isinstance(value, str) else '%.1f' % value).rjust(width))
+        out.write('  '.join(cells) + '\n')
+
+
+OPERATIONS = ['startup', 'find_element', 'ai_fallback', 'ai_fallback_nearby', 'find_elements_fallback',
+              'form_entry', 'match_bounding_box']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('operations', nargs='*', metavar='OPERATION',
+                        help='operations to measure, one of %s (default: all)' % ', '.join(OPERATIONS))
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--memory-iterations', type=int, default=5)
+    parser.add_argument('--dom-size', type=int, default=2000, help='number of elements on the fake page')
+    parser.add_argument('--width', type=int, default=1280, help='viewport width in CSS pixels')
+    parser.add_argument('--height', type=int, default=800, help='viewport height in CSS pixels')
+    parser.add_argument('--device-pixel-ratio', type=int, default=2)
+    parser.add_argument('--driver-latency', type=float, default=0.0, help='seconds added to every WebDriver command')
+    parser.add_argument('--screenshot-latency', type=float, default=0.0,
+                        help='seconds added to every screenshot per megapixel')
+    parser.add_argument('--server-latency', type=float, default=0.0, help='seconds added to every server request')
+    parser.add_argument('--implicit-wait', type=float, default=0.0,
+                        help='implicit wait in seconds, waited out by every broken selector')
+    parser.add_argument('--static-page', action='store_true', help='do not change the page between iterations')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+                        help='TestAiDriver keyword argument, VALUE is parsed as JSON when possible')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+    for name in args.operations:
+        if name not in OPERATIONS:
+            parser.error('unknown operation %s' % name)
+
+    logging.basicConfig(level=logging.CRITICAL)
+    benchmark = Benchmark(args)
+    try:
+        results = benchmark.run(args.operations or OPERATIONS)
+    finally:
+        benchmark.close()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_table(results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,8 @@ setuptools.setup(
     },
     include_package_data=True,
     packages=setuptools.find_packages(include=["test_ai"]),
-    install_requires=["packaging", "pillow", "requests", "selenium"],
+    install_requires=["pillow", "requests", "selenium"],
+    extras_require={"numpy": ["numpy"], "async": ["aiohttp"]},
     classifiers=[
         "Natural Language :: English",
         "Programming Language :: Python :: 3",
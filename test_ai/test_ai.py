@@ -1,51 +1,339 @@
+import asyncio
+import atexit
 import base64
+import collections
+import contextlib
+import functools
+import gzip
 import hashlib
 import json
 import logging
 import os
 import platform
-import requests
+import queue
+import random
+import struct
 import sys
+import threading
 import time
 import traceback
 import urllib.parse
 import uuid
 import warnings
 import webbrowser
+import zlib
 
 
 import io
+from array import array
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
 from distutils.util import strtobool
-from PIL import Image
-from packaging import version
 import selenium
 
-if version.parse(selenium.__version__) < version.parse('4.0.0'):
+# PIL, requests and numpy are imported where they are used so importing and constructing the driver stays cheap
+
+if int(selenium.__version__.split('.')[0]) < 4:
     old_selenium = True
 else:
     old_selenium = False
 
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.common.exceptions import StaleElementReferenceException
+from selenium.webdriver.remote.command import Command
 
 from selenium import webdriver
 
-requests.packages.urllib3.disable_warnings()
-
 
 log = logging.getLogger(__name__)
 
+_numpy_module = None
+_numpy_checked = False
+
+def _numpy():
+    """
+        Returns the numpy module, or None when it is not installed.
+    """
+    global _numpy_module, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = None
+        _numpy_checked = True
+    return _numpy_module
+
+_shared_instances = {}
+_shared_instances_lock = threading.Lock()
+
+def _shared_instance(cls, path, **kwargs):
+    """
+        Returns the one cls(path, **kwargs) of the process, so every driver using a cache file with the same
+        settings shares it in memory. Saves merge with the file, so instances with other settings don't lose entries.
+    """
+    instance_key = (cls, path) + tuple(sorted(kwargs.items()))
+    with _shared_instances_lock:
+        instance = _shared_instances.get(instance_key)
+        if instance is None:
+            instance = _shared_instances[instance_key] = cls(path, **kwargs)
+        return instance
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """
+        Holds an exclusive lock on path + '.lock' across processes and threads for the with block.
+        Without fcntl or msvcrt the block runs unlocked.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.lock', 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        elif msvcrt is not None:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            elif msvcrt is not None:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# (connect, read) timeouts in seconds per server endpoint
+DEFAULT_TIMEOUTS = {
+    'default': (3.05, 30),
+    '/sdk_checkin': (1, 1),
+    '/check_screenshot_exists': (3.05, 10),
+    '/add_action': (3.05, 10),
+    '/classify': (3.05, 60),
+}
+
+# How screenshots are taken with Page.captureScreenshot: format png, jpeg or webp, quality of jpeg / webp from 0 to
+# 100, optimize_for_speed to trade size for encoding time, clip {x, y, width, height} to only capture that part of the
+# viewport in CSS pixels, and css_pixels to capture at CSS pixel size on HiDPI displays
+DEFAULT_CAPTURE = {
+    'format': 'png',
+    'quality': None,
+    'optimize_for_speed': False,
+    'clip': None,
+    'css_pixels': False,
+}
+
+# Element crops and screenshots are matched locally at this fraction of their CSS pixel size
+LOCAL_MATCH_SCALE = 0.5
+
+# Installs a counter that is bumped on anything that can change what the page looks like.
+# Together with the page id, which changes on navigation because the window object is replaced, it
+# forms the page version '<page id>:<counter>'.
+PAGE_VERSION_INSTALL_JS = '''
+if (window.__testaiPageVersion === undefined) {
+    window.__testaiPageVersion = 0;
+    window.__testaiPageId = Date.now().toString(36) + Math.random().toString(36).slice(2);
+    var bump = function() { window.__testaiPageVersion++; };
+    new MutationObserver(bump).observe(document, {attributes: true, childList: true, characterData: true, subtree: true});
+    ['scroll', 'resize', 'input', 'change', 'focusin', 'focusout', 'mouseover', 'mouseout', 'mousedown', 'mouseup',
+     'load', 'transitionend', 'animationend'].forEach(function(name) {
+        window.addEventListener(name, bump, true);
+    });
+}
+'''
+
+PAGE_VERSION_SCRIPT = PAGE_VERSION_INSTALL_JS + '''
+return window.__testaiPageId + ':' + window.__testaiPageVersion;
+'''
+
+# Returns [page version, flat [x, y, width, height, ...] viewport rects, tag names] for every element and keeps
+# the elements in the page under the token in arguments[0] so they can be fetched by index later.
+LAYOUT_SNAPSHOT_SCRIPT = PAGE_VERSION_INSTALL_JS + '''
+var elements = document.querySelectorAll('*');
+var rects = new Array(elements.length * 4);
+var tags = new Array(elements.length);
+for (var i = 0; i < elements.length; i++) {
+    var r = elements[i].getBoundingClientRect();
+    rects[4 * i] = r.x;
+    rects[4 * i + 1] = r.y;
+    rects[4 * i + 2] = r.width;
+    rects[4 * i + 3] = r.height;
+    tags[i] = elements[i].tagName.toLowerCase();
+}
+var version = window.__testaiPageId + ':' + window.__testaiPageVersion;
+window.__testaiLayout = {token: arguments[0], version: version, elements: elements};
+return [version, rects, tags];
+'''
+
+# Returns the elements at the indices in arguments[1] of the layout snapshot arguments[0],
+# or null when the page changed since that snapshot was taken.
+RESOLVE_LAYOUT_SCRIPT = '''
+var layout = window.__testaiLayout;
+if (!layout || layout.token !== arguments[0] || window.__testaiPageId + ':' + window.__testaiPageVersion !== layout.version) {
+    return null;
+}
+return arguments[1].map(function(i) { return layout.elements[i]; });
+'''
+
+# Scores the elements under the center of box (in CSS pixels) by IOU in the browser and
+# returns [element, score, tag name] for every candidate with a positive score, best first.
+MATCH_BOX_FUNCTION = '''
+function testaiMatchBox(box) {
+var cx = box.x + box.width / 2, cy = box.y + box.height / 2;
+var candidates = document.elementsFromPoint ? document.elementsFromPoint(cx, cy) : [];
+if (candidates.length === 0) {
+    // The center is outside of the viewport, elementsFromPoint only looks inside it
+    candidates = document.querySelectorAll('*');
+}
+var area = box.width * box.height;
+var results = [];
+for (var i = 0; i < candidates.length; i++) {
+    var r = candidates[i].getBoundingClientRect();
+    if (!(cx > r.x && cx < r.x + r.width && cy > r.y && cy < r.y + r.height)) {
+        continue;
+    }
+    var dx = Math.min(box.x + box.width, r.x + r.width) - Math.max(box.x, r.x);
+    var dy = Math.min(box.y + box.height, r.y + r.height) - Math.max(box.y, r.y);
+    var overlap = (dx >= 0 && dy >= 0) ? dx * dy : 0;
+    var union = area + r.width * r.height - overlap;
+    var score = union > 0 ? overlap / union : 0;
+    if (score > 0) {
+        results.push([candidates[i], score, candidates[i].tagName.toLowerCase()]);
+    }
+}
+results.sort(function(a, b) { return b[1] - a[1]; });
+return results;
+}
+'''
+
+MATCH_BOX_SCRIPT = MATCH_BOX_FUNCTION + '''
+return testaiMatchBox(arguments[0]);
+'''
+
+# Matches every box in the list arguments[0] in one round trip, returning the candidates of each
+MATCH_BOXES_SCRIPT = MATCH_BOX_FUNCTION + '''
+return arguments[0].map(testaiMatchBox);
+'''
+
+# [x, y, width, height] of arguments[0] relative to the viewport, which is what screenshots show, followed by the
+# scroll offsets of the page
+ELEMENT_VIEWPORT_RECT_SCRIPT = '''
+var r = arguments[0].getBoundingClientRect();
+return [r.x, r.y, r.width, r.height, window.pageXOffset, window.pageYOffset];
+'''
+
+# [x, y, width, height] of every element in arguments[0], relative to the document like WebElement.rect
+ELEMENT_RECTS_SCRIPT = '''
+return arguments[0].map(function(element) {
+    var r = element.getBoundingClientRect();
+    return [r.x + window.pageXOffset, r.y + window.pageYOffset, r.width, r.height];
+});
+'''
+
+# Calls back once the browser painted the frame after the one that is pending, or after 100ms on pages that
+# don't render, e.g. in a background tab
+NEXT_FRAME_SCRIPT = '''
+var done = arguments[arguments.length - 1];
+var timer = setTimeout(done, 100);
+requestAnimationFrame(function() {
+    requestAnimationFrame(function() { clearTimeout(timer); done(); });
+});
+'''
+
 class TestAiDriver():
+    """
+        Wraps a selenium WebDriver, falling back to the test.ai classifier when a selector fails.
+
+        Like the WebDriver it wraps, a TestAiDriver is used by one thread at a time, while any number of them can run
+        side by side in threads or processes. Drivers in a process share the caches in cache_dir in memory and save
+        them under a file lock. With shared_cache the caches are also read and written during the run, so the
+        processes on a host benefit from each other's lookups.
+    """
     def __init__(self, driver, api_key, test_case_name=None, debug=False, use_classifier_during_creation=True,
-                 train=False, server_url=None, use_cdp=False):
+                 train=False, server_url=None, use_cdp=False, use_box_cache=True, box_cache_size=10000,
+                 box_cache_ttl=86400, cache_dir=None, async_uploads=True, upload_queue_size=100, timeouts=None,
+                 max_retries=2, retry_backoff=0.5, circuit_breaker_threshold=5, circuit_breaker_cooldown=30,
+                 track_page_changes=False, hash_mode='md5', screenshot_transport='base64', upload_format=None,
+                 upload_quality=None, downscale_uploads=False, fast_start=False, interactive_timeout=None,
+                 long_poll_wait=30, instrumentation=None, replay_mode=None, replay_bundle=None, local_matching=False,
+                 local_match_threshold=0.9, local_match_margin=200, shared_cache=None, selector_fast_fail=True,
+                 selector_failure_threshold=2, selector_retry_interval=3600, dedupe_training=True, max_training_per_label=None,
+                 training_sample_rate=1.0, capture=None, region_of_interest=None, region_margin=150,
+                 input_transport=None, wait_for_input=False, insert_text=False):
         self.version = 'selenium-0.1.20'
         self.debug = debug
+        # Spans and counters of the SDK's own work, so its overhead can be told apart from the app under test.
+        # Takes an Instrumentation, or listeners to create one with.
+        if not isinstance(instrumentation, Instrumentation):
+            if instrumentation is None:
+                listeners = []
+            elif isinstance(instrumentation, (list, tuple)):
+                listeners = list(instrumentation)
+            else:
+                listeners = [instrumentation]
+            instrumentation = Instrumentation(listeners)
+        if debug:
+            instrumentation.add_listener(_print_span)
+        self.instrumentation = instrumentation
         self.train = train
         self.driver = driver
         self.api_key = api_key
         self.run_id = str(uuid.uuid1())
         self.last_test_case_screenshot_uuid = None
         self.use_cdp = use_cdp
+        self.track_page_changes = track_page_changes
+        # 'md5' produces the same screenshot keys as the server and other SDKs. 'fast' keys are cheaper but only key
+        # the local caches, the server still gets the md5 key of the screenshots it is sent
+        if hash_mode not in ('md5', 'fast'):
+            raise ValueError('hash_mode must be one of md5, fast')
+        self.hash_mode = hash_mode
+        # 'multipart' sends raw image bytes plus gzipped JSON metadata instead of base64 inside JSON / form bodies
+        if screenshot_transport not in ('base64', 'multipart'):
+            raise ValueError('screenshot_transport must be one of base64, multipart')
+        if upload_format not in (None, 'png', 'webp', 'jpeg'):
+            raise ValueError('upload_format must be one of png, webp, jpeg')
+        self.screenshot_transport = screenshot_transport
+        self.upload_format = upload_format
+        self.upload_quality = upload_quality
+        self.downscale_uploads = downscale_uploads
+        self.capture = dict(DEFAULT_CAPTURE)
+        if capture:
+            unknown = set(capture) - set(DEFAULT_CAPTURE)
+            if unknown:
+                raise ValueError('Unknown capture settings %s' % ', '.join(sorted(unknown)))
+            self.capture.update(capture)
+        if self.capture['format'] not in ('png', 'jpeg', 'webp'):
+            raise ValueError('capture format must be one of png, jpeg, webp')
+        # Capture settings other than the defaults need Page.captureScreenshot, which Chromium drivers have without use_cdp
+        self._cdp_capture = use_cdp or self.capture != DEFAULT_CAPTURE
+        if self._cdp_capture and not use_cdp and not hasattr(driver, 'execute_cdp_cmd'):
+            log.warning('The capture settings need a Chromium driver, taking PNG screenshots of the viewport instead')
+            self._cdp_capture = False
+        self._capture_format = self.capture['format'] if self._cdp_capture else 'png'
+        # Clicks and keys of testai_elems go as one W3C Actions command, or the clicks as Input.dispatchMouseEvent
+        # with 'cdp' like they always did with use_cdp. Keys stay real key events unless insert_text is on
+        if input_transport is None:
+            input_transport = 'cdp' if use_cdp else 'actions'
+        if input_transport not in ('actions', 'cdp'):
+            raise ValueError('input_transport must be one of actions, cdp')
+        if input_transport == 'cdp' and not hasattr(driver, 'execute_cdp_cmd'):
+            log.warning('input_transport cdp needs a Chromium driver, sending W3C Actions instead')
+            input_transport = 'actions'
+        if insert_text and not hasattr(driver, 'execute_cdp_cmd'):
+            log.warning('insert_text needs a Chromium driver, typing with key events instead')
+            insert_text = False
+        self.inputs = InputQueue(driver, transport=input_transport, wait_for_frame=wait_for_input,
+                                 instrumentation=instrumentation, insert_text=insert_text)
+        # Top left corner of the screenshot in the viewport, in CSS pixels
+        clip = self.capture['clip'] if self._cdp_capture else None
+        self._capture_origin = (clip['x'], clip['y']) if clip else (0, 0)
+        # (page version, screenshot, hash) of the last capture, reused while the page is unchanged
+        self._last_capture = None
+        self._layout_snapshot = None
         try:
             self.test_case_creation_mode = strtobool(os.environ.get('TESTAI_INTERACTIVE', '0')) == 1
         except Exception:
@@ -55,55 +343,379 @@ class TestAiDriver():
         self.test_case_uuid = test_case_name
         if self.test_case_creation_mode:
             self.use_classifier_during_creation = use_classifier_during_creation
+        if interactive_timeout is None and os.environ.get('TESTAI_INTERACTIVE_TIMEOUT'):
+            interactive_timeout = float(os.environ['TESTAI_INTERACTIVE_TIMEOUT'])
+        # Overall time to wait for an element to be labeled in the UI, None waits forever
+        self.interactive_timeout = interactive_timeout
+        # How long the server may hold each poll for a bounding box open before answering
+        self.long_poll_wait = long_poll_wait
         if server_url is None:
             server_url = os.environ.get('TESTAI_FLUFFY_DRAGON_URL', 'https://sdk.test.ai')
         self.url = server_url
-        self._checkin()
-        window_size = self.driver.get_window_size()
-        screenshotBase64 = self._get_screenshot()
-
-        im = Image.open(io.BytesIO(base64.b64decode(screenshotBase64)))
-        width, height = im.size
-        self.multiplier = 1.0 * width / window_size['width']
-        self_attrs = dir(self)
+        # Not named timeouts, that is the WebDriver's own attribute and is forwarded to it
+        self.server_timeouts = dict(DEFAULT_TIMEOUTS)
+        if timeouts:
+            self.server_timeouts.update(timeouts)
+        self._max_retries = max_retries
+        self._retry_backoff = retry_backoff
+        # Created on the first server call
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.circuit_breaker = CircuitBreaker(failure_threshold=circuit_breaker_threshold,
+                                              cooldown=circuit_breaker_cooldown)
+        if cache_dir is None:
+            cache_dir = os.environ.get('TESTAI_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.testai'))
+        self.cache_dir = cache_dir
+        # 'record' saves the server responses to a bundle, 'replay' serves them from it without any network,
+        # for hermetic CI runs
+        if replay_mode is None:
+            replay_mode = os.environ.get('TESTAI_REPLAY_MODE') or None
+        if replay_mode not in (None, 'record', 'replay'):
+            raise ValueError('replay_mode must be one of record, replay')
+        self.replay_bundle = None
+        if replay_mode is not None:
+            if replay_bundle is None:
+                replay_bundle = os.environ.get('TESTAI_REPLAY_BUNDLE') or os.path.join(
+                    cache_dir, 'replay', '%s.json.gz' % urllib.parse.quote(self.test_case_uuid, safe=''))
+            self.replay_bundle = _shared_instance(ReplayBundle, replay_bundle, mode=replay_mode)
+            # Boxes served from the local cache would never reach the bundle
+            use_box_cache = False
+        # One cache file per server / account so boxes never leak between them. Drivers in the same process share
+        # the caches in memory, with shared_cache the processes on the host see each other's entries during the run.
+        cache_name = hashlib.md5((self.url + self.api_key).encode('utf-8')).hexdigest()[:12]
+        if shared_cache is None:
+            shared_cache = strtobool(os.environ.get('TESTAI_SHARED_CACHE', '0')) == 1
+        self.box_cache = None
+        if use_box_cache:
+            self.box_cache = _shared_instance(BoxCache, os.path.join(cache_dir, 'box_cache_%s.json' % cache_name),
+                                              max_entries=box_cache_size, ttl=box_cache_ttl, shared=shared_cache)
+        # Crops of elements found by their selector, matched in the screenshot before asking /classify when the
+        # selector breaks. Only matches scoring at least local_match_threshold within local_match_margin CSS pixels
+        # of where the element was last seen are used.
+        self.template_store = None
+        self.local_match_threshold = local_match_threshold
+        self.local_match_margin = local_match_margin
+        if local_matching:
+            if _numpy() is None:
+                log.warning('local_matching needs numpy, install it with pip install test-ai-selenium[numpy]')
+            else:
+                self.template_store = _shared_instance(TemplateStore, os.path.join(cache_dir, 'templates_%s.npz' % cache_name),
+                                                       shared=shared_cache)
+        # Selectors that failed selector_failure_threshold times in a row in this test case are probed without the
+        # implicit wait, and get the full wait again every selector_retry_interval seconds. Set the implicit wait
+        # through this driver so it can be restored afterwards
+        self._implicit_wait = None
+        self.selector_stats = None
+        if selector_fast_fail:
+            self.selector_stats = SelectorStats(
+                _shared_instance(BoxCache, os.path.join(cache_dir, 'selector_stats_%s.json' % cache_name),
+                                 max_entries=box_cache_size, ttl=30 * 86400, shared=shared_cache),
+                failure_threshold=selector_failure_threshold, retry_interval=selector_retry_interval)
+        # Training examples already sent in this or an earlier run are not sent again. max_training_per_label caps the
+        # examples sent per label each day and training_sample_rate sends only that share of them. Replayed runs
+        # send nothing, so they are not logged.
+        self.training_log = None
+        replaying = self.replay_bundle is not None and self.replay_bundle.mode == 'replay'
+        if (dedupe_training or max_training_per_label is not None or training_sample_rate < 1) and not replaying:
+            self.training_log = TrainingLog(
+                _shared_instance(BoxCache, os.path.join(cache_dir, 'training_log_%s.json' % cache_name),
+                                 max_entries=box_cache_size, ttl=30 * 86400, shared=shared_cache),
+                dedupe=dedupe_training, max_per_label_per_day=max_training_per_label,
+                sample_rate=training_sample_rate)
+        # Last known box of each label in CSS pixels of the viewport. When a selector breaks, /classify is first asked
+        # about the area within region_margin CSS pixels around it and only gets the whole screenshot when that finds
+        # nothing. Off by default, as only a server that understands the offset of a crop can classify one.
+        self.label_boxes = None
+        self.region_margin = region_margin
+        if region_of_interest is None:
+            region_of_interest = strtobool(os.environ.get('TESTAI_REGION_OF_INTEREST', '0')) == 1
+        if region_of_interest:
+            self.label_boxes = _shared_instance(BoxCache, os.path.join(cache_dir, 'label_boxes_%s.json' % cache_name),
+                                                max_entries=box_cache_size, ttl=30 * 86400, shared=shared_cache)
+        # Training uploads are not needed to return the element, so they run off the test thread
+        self.upload_worker = None
+        if async_uploads:
+            self.upload_worker = UploadWorker(max_queue_size=upload_queue_size)
+        self._multiplier = None
+        self._multiplier_validated = False
+        if fast_start:
+            # Nothing is done with the check in response, so don't make the test wait for it.
+            # The multiplier is estimated when first needed and checked against the first screenshot taken.
+            self._checkin_in_background()
+        else:
+            self._checkin()
+            # The first screenshot sets the multiplier
+            self._get_screenshot()
         # Disable warnings
-        requests.packages.urllib3.disable_warnings()
         warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-        for a_name in dir(driver):
-            if a_name in self_attrs:
-                continue
-            try:
-                def _call_driver(*args, name=a_name, **kwargs):
-                    v = getattr(self.driver, name)
-                    return v(*args, **kwargs)
-                v = getattr(self.driver, a_name)
-                if hasattr(v, '__call__'):
-                    setattr(self, a_name, _call_driver)
-                else:
-                    setattr(self, a_name, v)
-            except Exception as err:
-                continue
+    def __getattr__(self, name):
+        # Only called for attributes TestAiDriver does not have itself. Forward them to the wrapped driver on access
+        # so properties like page_source or current_url are always fresh and never fetched up front.
+        driver = self.__dict__.get('driver')
+        if driver is None or name[0:2] == '__':
+            raise AttributeError(name)
+        return getattr(driver, name)
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(dir(self.driver)))
 
     def get(self, url):
         self.driver.get(url)
-        for a_name in dir(self.driver):
-            try:
-                v = getattr(self.driver, a_name)
-                if hasattr(v, '__call__'):
-                    continue
-                elif '__' == a_name[0:2]:
-                    # Skip these as they mess with internal properties
-                    continue
-                else:
-                    setattr(self, a_name, v)
-            except Exception as err:
-                continue
 
 
+    def batch_input(self):
+        """
+            Sends the clicks and keys of testai_elems in the with block together once it ends, e.g. to fill a form:
+                with driver.batch_input():
+                    driver.find_by_element_name('name').send_keys('Jane')
+                    driver.find_by_element_name('email').send_keys('jane@example.com')
+            Only the input of elements found by the classifier is held back. Elements found by their selector are
+            plain WebElements whose input is sent right away, ahead of what is held back, so keep them out of the
+            block. Reading the page in the block sees it as before the input.
+        """
+        return self.inputs.batch()
+
     def implicitly_wait(self, wait_time):
+        self._implicit_wait = wait_time
         self.driver.implicitly_wait(wait_time)
 
+    def _current_implicit_wait(self):
+        if self._implicit_wait is None:
+            try:
+                self.instrumentation.incr('webdriver.round_trips', command='get_timeouts')
+                self._implicit_wait = self.driver.timeouts.implicit_wait
+            except Exception:
+                # Older drivers can't report it, the WebDriver default is no wait
+                self._implicit_wait = 0
+        return self._implicit_wait
+
+    @contextlib.contextmanager
+    def _without_implicit_wait(self):
+        wait = self._current_implicit_wait()
+        if not wait:
+            yield
+            return
+        self.instrumentation.incr('webdriver.round_trips', 2, command='implicitly_wait')
+        self.driver.implicitly_wait(0)
+        try:
+            yield
+        finally:
+            self.driver.implicitly_wait(wait)
+
+    def _run_selector(self, element_name, find):
+        """
+            Runs the standard selector through find and records whether it found anything. A selector that kept
+            failing in earlier runs is only probed, without the implicit wait, so it fails fast instead of waiting
+            out the timeout before the classifier is used. Once the probe, or the periodic retry with the full wait,
+            finds the element again it is trusted again.
+        """
+        if self.selector_stats is None:
+            return find()
+        found = False
+        probe = self.selector_stats.should_probe(self.test_case_uuid, element_name)
+        try:
+            if probe:
+                self.instrumentation.incr('selector.fast_fail_probes')
+                if self.debug:
+                    print(f'Selector for {element_name} failed in earlier runs, probing it without the implicit wait')
+                with self._without_implicit_wait():
+                    result = find()
+            else:
+                result = find()
+            found = bool(result)
+            return result
+        finally:
+            self.selector_stats.record(self.test_case_uuid, element_name, found, probed=probe)
+
+    def _run_flow(self, flow):
+        """
+            Runs a flow, a generator of the steps of a find shared by TestAiDriver and AsyncTestAiDriver. Every step
+            that waits on the browser, the disk or the server is yielded as (function, args), and the flow is sent
+            its result or thrown its exception. Here the steps simply run one after the other.
+        """
+        result, error = None, None
+        while True:
+            try:
+                fn, args = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration as e:
+                return e.value
+            try:
+                result, error = fn(*args), None
+            except Exception as e:
+                result, error = None, e
+
+    def _submit(self, fn, *args):
+        """
+            Runs fn, like a training upload, on the upload worker or right away without async_uploads.
+        """
+        if self.upload_worker is not None:
+            self.upload_worker.submit(fn, *args)
+        else:
+            fn(*args)
+
+    def flush(self, timeout=None):
+        """
+            Blocks until all queued training uploads have been sent to the server, then writes the caches to
+            cache_dir. They are written at exit as well, but forked workers leaving with os._exit and killed runs
+            never get there.
+        """
+        if self.upload_worker is not None:
+            self.upload_worker.flush(timeout=timeout)
+        if self.replay_bundle is not None:
+            self.replay_bundle.save()
+        for store in (self.box_cache, self.template_store, self.label_boxes,
+                      self.selector_stats and self.selector_stats.cache, self.training_log and self.training_log.cache):
+            if store is not None:
+                store.save()
+
+    def close(self):
+        self.flush()
+        self._stop_upload_worker()
+        self._release_screenshots()
+        self.driver.close()
+
+    def quit(self):
+        self.flush()
+        self._stop_upload_worker()
+        self._release_screenshots()
+        if self._session is not None:
+            self._session.close()
+        self.driver.quit()
+
+    def _stop_upload_worker(self):
+        # Drivers come and go all day in a test run, each ending its thread keeps the thread count flat
+        if self.upload_worker is not None:
+            self.upload_worker.stop()
+
+    def _release_screenshots(self):
+        """
+            Frees the screenshots the driver holds on to, once nothing queued can still use them.
+        """
+        if self._last_capture is not None:
+            self._last_capture[1].release()
+            self._last_capture = None
+        if getattr(self, 'last_screenshot', None) is not None:
+            self.last_screenshot.release()
+            self.last_screenshot = None
+
+    @property
+    def multiplier(self):
+        """
+            Ratio between screenshot pixels and CSS pixels.
+        """
+        if self._multiplier is None:
+            self._multiplier = self._estimate_multiplier()
+        return self._multiplier
+
+    @multiplier.setter
+    def multiplier(self, value):
+        self._multiplier = value
+
+    def _estimate_multiplier(self):
+        if self._cdp_capture and self.capture['css_pixels']:
+            return 1.0
+        try:
+            if self.use_cdp:
+                self.instrumentation.incr('webdriver.round_trips', command='execute_cdp_cmd')
+                metrics = self.driver.execute_cdp_cmd('Page.getLayoutMetrics', {})
+                # layoutViewport is in device pixels, cssLayoutViewport in CSS pixels
+                return 1.0 * metrics['layoutViewport']['clientWidth'] / metrics['cssLayoutViewport']['clientWidth']
+            return float(self._execute_script('return window.devicePixelRatio;') or 1.0)
+        except Exception:
+            log.debug('Could not read the device pixel ratio, validating the multiplier with a screenshot', exc_info=True)
+            self._validate_multiplier(self._get_screenshot())
+            return self._multiplier
+
+    def _validate_multiplier(self, screenshot):
+        self._multiplier_validated = True
+        self.instrumentation.incr('webdriver.round_trips', command='get_window_size')
+        window_size = self.driver.get_window_size()
+        width, height = screenshot.size
+        multiplier = 1.0 * width / window_size['width']
+        if self._multiplier is not None and abs(self._multiplier - multiplier) > 0.01 and self.debug:
+            print(f'Estimated multiplier {self._multiplier} does not match the screenshot, using {multiplier}')
+        self._multiplier = multiplier
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._create_session(self._max_retries, self._retry_backoff)
+        return self._session
+
+    def _create_session(self, max_retries, retry_backoff):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        requests.packages.urllib3.disable_warnings()
+        session = requests.Session()
+        # Verify is False as the lets encrypt certificate raises issue on mac.
+        session.verify = False
+        # POSTs are not idempotent, so only requests that never reached the server or were turned away by a proxy are
+        # sent again. A read timeout may mean the server is still working on it, e.g. on a slow /classify.
+        retry = Retry(total=max_retries, connect=max_retries, read=0, status=max_retries,
+                      backoff_factor=retry_backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset(['GET', 'POST']), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _post(self, endpoint, replay_key=None, **kwargs):
+        """
+            POSTs to a test.ai server endpoint over the shared session, using the endpoint's timeout.
+            Raises ServerUnavailableException without calling the server while the circuit breaker is open.
+            replay_key, (screenshot hash, label or labels), identifies the response in the replay bundle.
+        """
+        if self.replay_bundle is not None and self.replay_bundle.mode == 'replay':
+            return self._replay(endpoint, replay_key)
+        if not self.circuit_breaker.allow():
+            raise ServerUnavailableException('test.ai server is unavailable after repeated failures, '
+                                             'skipping %s for up to %ds' % (endpoint, self.circuit_breaker.cooldown))
+        timeout = kwargs.pop('timeout', None) or self.server_timeouts.get(endpoint, self.server_timeouts['default'])
+        with self.instrumentation.span('POST ' + endpoint, endpoint=endpoint) as attributes:
+            try:
+                r = self.session.post(self.url + endpoint, timeout=timeout, **kwargs)
+            except Exception:
+                self.circuit_breaker.record_failure()
+                self.instrumentation.incr('http.failures', endpoint=endpoint)
+                raise
+            except BaseException:
+                # Interrupted before the server answered, this call can't settle the trial of a half open circuit
+                self.circuit_breaker.release_trial()
+                raise
+            attributes['status'] = r.status_code
+        body = r.request.body if r.request is not None else None
+        if body:
+            self.instrumentation.incr('http.bytes_uploaded', len(body), endpoint=endpoint)
+        if r.status_code >= 500:
+            self.circuit_breaker.record_failure()
+            self.instrumentation.incr('http.failures', endpoint=endpoint)
+        else:
+            self.circuit_breaker.record_success()
+            if self.replay_bundle is not None and replay_key is not None:
+                self.replay_bundle.record(endpoint, replay_key, r.status_code, r.text)
+        return r
+
+    def _replay(self, endpoint, replay_key):
+        """
+            Serves the response to endpoint from the replay bundle without any network.
+            Requests that only send data to the server, like training uploads, are answered with success.
+        """
+        if replay_key is None:
+            return ServerResponse(200, json.dumps({'success': True}))
+        response = self.replay_bundle.response(endpoint, replay_key)
+        if response is not None:
+            self.instrumentation.incr('replay.hit', endpoint=endpoint)
+            return response
+        self.instrumentation.incr('replay.miss', endpoint=endpoint)
+        msg = 'No recorded response for %s of %s in the replay bundle %s' % (endpoint, replay_key[1], self.replay_bundle.path)
+        log.warning(msg)
+        return ServerResponse(200, json.dumps({'success': False, 'key': None, 'message': msg}))
+
 
     def find_element(self, by='id', value=None, element_name=None):
         """
@@ -114,35 +726,15 @@ class TestAiDriver():
         :rtype: WebElement
         """
 
-        # Try to classify with selector
-        #    If success, call update_elem ('train_if_necessary': true)
-        #    If NOT successful, call _classify
-        #        If succesful, return element
-        #        If NOT succesful, raise element not found with link
-        if element_name is None:
-            element_name = 'element_name_by_%s_%s' % (str(by).replace('.', '_'), str(value).replace('.', '_'))
-        element_name = element_name.replace(' ', '_')
-        key = None
-        msg = 'test.ai driver exception'
+        element_name = self._selector_element_name(by, value, element_name)
 
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element(by=by, value=value)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element(by=by, value=value))
+
+    def _selector_element_name(self, by, value, element_name=None):
+        if element_name is None:
+            element_name = 'element_name_by_%s_%s' % (str(by).replace('.', '_'), str(value).replace('.', '_'))
+        return element_name.replace(' ', '_')
 
     def find_element_by_accessibility_id(self, accessibility_id, element_name=None):
         """
@@ -166,27 +758,8 @@ class TestAiDriver():
             element_name = 'element_name_by_accessibility_id_%s' % (str(accessibility_id).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
-        key = None
-        msg = 'test.ai driver exception'
-
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_accessibility_id(accessibility_id)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_accessibility_id(accessibility_id))
 
     def find_element_by_class_name(self, name, element_name=None):
         """
@@ -210,27 +783,8 @@ class TestAiDriver():
             element_name = 'element_name_by_class_name_%s' % (str(name).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
-        key = None
-        msg = 'test.ai driver exception'
-
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_class_name(name)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_class_name(name))
 
 
     def find_element_by_css_selector(self, css_selector, element_name=None):
@@ -256,27 +810,8 @@ class TestAiDriver():
             element_name = 'element_name_by_css_selector_%s' % (str(css_selector).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
-        key = None
-        msg = 'test.ai driver exception'
-
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_css_selector(css_selector)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_css_selector(css_selector))
 
 
     def find_element_by_id(self, id_, element_name=None):
@@ -302,27 +837,8 @@ class TestAiDriver():
             element_name = 'element_name_by_id_%s' % (str(id_).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
-        key = None
-        msg = 'test.ai driver exception'
-
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_id(id_)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_id(id_))
 
 
     def find_element_by_link_text(self, link_text, element_name=None):
@@ -348,27 +864,8 @@ class TestAiDriver():
             element_name = 'element_name_by_link_text_%s' % (str(link_text).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
-        key = None
-        msg = 'test.ai driver exception'
-
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_link_text(link_text)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_link_text(link_text))
 
 
     def find_element_by_name(self, name, element_name=None):
@@ -394,28 +891,8 @@ class TestAiDriver():
             element_name = 'element_name_by_name_%s' % (str(name).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
-        key = None
-        msg = 'test.ai driver exception'
-
-
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_name(name)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_name(name))
 
 
     def find_element_by_partial_link_text(self, link_text, element_name=None):
@@ -441,27 +918,8 @@ class TestAiDriver():
             element_name = 'element_name_by_partial_link_text_%s' % (str(link_text).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
-        key = None
-        msg = 'test.ai driver exception'
-
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_partial_link_text(link_text)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_partial_link_text(link_text))
 
 
     def find_element_by_tag_name(self, name, element_name=None):
@@ -487,27 +945,8 @@ class TestAiDriver():
             element_name = 'element_name_by_tag_name_%s' % (str(name).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
-        key = None
-        msg = 'test.ai driver exception'
-
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_tag_name(name)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
-        return None
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_tag_name(name))
 
 
     def find_element_by_xpath(self, xpath, element_name=None):
@@ -533,28 +972,95 @@ class TestAiDriver():
             element_name = 'element_name_by_xpath_%s' % (str(xpath).replace('.', '_'))
         element_name = element_name.replace(' ', '_')
 
+        # Run the standard selector
+        return self._find_element_with_fallback(element_name, lambda: self.driver.find_element_by_xpath(xpath))
+
+    def _find_element_with_fallback(self, element_name, find):
+        """
+            Runs the standard selector through find. On success the element is sent for training, if the selector
+            fails the element is classified from a screenshot instead.
+        """
+        return self._run_flow(self._find_element_flow(element_name, find))
+
+    def _find_element_flow(self, element_name, find):
+        # Try to classify with selector
+        #    If success, call update_elem ('train_if_necessary': true)
+        #    If NOT successful, call _classify
+        #        If succesful, return element
+        #        If NOT succesful, raise element not found with link
         key = None
         msg = 'test.ai driver exception'
 
         # Run the standard selector
-        try:
-            driver_element = self.driver.find_element_by_xpath(xpath)
-            if driver_element:
-                key = self._upload_screenshot_if_necessary(element_name)
-                self._update_elem(driver_element, key, element_name)
-            return driver_element
-        except NoElementFoundException as e:
-            log.exception(e)
-        except Exception as err:
-            # If this happens, then error during the driver call
-            classified_element, key, msg = self._classify(element_name)
-            if classified_element:
-                log.error('Selector failed, using test.ai classifier element')
-                return classified_element
-            else:
-                raise Exception(msg)
+        with self.instrumentation.span('find_element', element_name=element_name) as attributes:
+            try:
+                self.instrumentation.incr('webdriver.round_trips', command='find_element')
+                driver_element = yield self._run_selector, (element_name, find)
+                attributes['outcome'] = 'selector'
+                self.instrumentation.incr('find_element.selector_found')
+                if driver_element:
+                    yield from self._update_elem_flow(driver_element, element_name)
+                return driver_element
+            except NoElementFoundException as e:
+                log.exception(e)
+            except Exception:
+                # If this happens, then error during the driver call
+                self.instrumentation.incr('find_element.selector_failed')
+                classified_element, key, msg = yield from self._classify_flow(element_name)
+                if classified_element:
+                    log.error('Selector failed, using test.ai classifier element')
+                    attributes['outcome'] = 'classifier'
+                    self.instrumentation.incr('find_element.fallback_found')
+                    return classified_element
+                else:
+                    attributes['outcome'] = 'not_found'
+                    self.instrumentation.incr('find_element.fallback_failed')
+                    raise Exception(msg)
         return None
 
+    def find_elements(self, by='id', value=None, element_name=None):
+        """
+        Find elements given a By strategy and locator. When the selector finds nothing and element_name is given,
+        the elements labeled element_name are classified from a single screenshot instead. Without element_name
+        an empty list is returned as it is, finding nothing is a normal answer for find_elements.
+
+        :Usage:
+            ::
+
+                elements = driver.find_elements(By.CLASS_NAME, 'search-result', element_name='search_result')
+
+        :rtype: list of WebElement, testai_elem for the classified ones
+        """
+        if element_name is None:
+            self.instrumentation.incr('webdriver.round_trips', command='find_elements')
+            return self.driver.find_elements(by=by, value=value)
+        element_name = element_name.replace(' ', '_')
+
+        with self.instrumentation.span('find_elements', element_name=element_name) as attributes:
+            try:
+                self.instrumentation.incr('webdriver.round_trips', command='find_elements')
+                driver_elements = self._run_selector(element_name,
+                                                     lambda: self.driver.find_elements(by=by, value=value))
+            except Exception:
+                log.debug('Selector for %s failed' % element_name, exc_info=True)
+                driver_elements = []
+            if driver_elements:
+                attributes['outcome'] = 'selector'
+                self.instrumentation.incr('find_elements.selector_found')
+                self._update_elems(driver_elements, element_name)
+                return driver_elements
+            self.instrumentation.incr('find_elements.selector_failed')
+            elements, key, msg = self._classify_all(element_name)
+            if elements:
+                log.error('Selector found nothing, using %d test.ai classifier elements' % len(elements))
+                attributes['outcome'] = 'classifier'
+                self.instrumentation.incr('find_elements.fallback_found')
+            else:
+                log.info(msg)
+                attributes['outcome'] = 'not_found'
+                self.instrumentation.incr('find_elements.fallback_failed')
+            return elements
+
     def find_element_by_element_name(self, element_name):
         """
         Finds an element by test.ai element name.
@@ -596,162 +1102,801 @@ class TestAiDriver():
             raise Exception(msg)
         return el
 
+    def find_by_element_names(self, element_names):
+        """
+        Finds several elements by element_name from a single screenshot.
+
+        :Args:
+         - element_names: The label names of the elements to be classified.
+
+        :Returns:
+         - dict - element_name to WebElement, for every element_name
+
+        :Raises:
+         - Exception - if any of the elements wasn't found
+
+        :Usage:
+            ::
+
+                elements = driver.find_by_element_names(['email_field', 'password_field', 'login_button'])
+        """
+        element_names = [element_name.replace(' ', '_') for element_name in element_names]
+        if self.test_case_creation_mode:
+            # Each label is drawn separately in the UI while creating a test case
+            return {element_name: self.find_by_element_name(element_name) for element_name in element_names}
+        elements, key, msgs = self._classify_many(element_names)
+        return self._found_elements(element_names, elements, msgs)
+
+    def _found_elements(self, element_names, elements, msgs):
+        """
+            Returns elements, raising with the messages of the element_names that weren't found if there are any.
+        """
+        missing = [element_name for element_name in element_names if elements[element_name] is None]
+        if missing:
+            msg = '\n'.join(msgs.get(element_name) or 'Could not find element_name: %s' % element_name
+                            for element_name in missing)
+            print(msg)
+            raise Exception(msg)
+        return elements
+
     def _checkin(self):
         """
         Check in the current test.ai session.
         """
-        data = {'api_key': self.api_key, 'os': platform.platform(), 'sdk_version': self.version, 'language': 'python3-' + sys.version, 'test_case_uuid': self.test_case_uuid}
         try:
-            res = requests.post(self.url + '/sdk_checkin', json=data, timeout=1, verify=False)
+            res = self._post('/sdk_checkin', json=self._checkin_data())
         except Exception:
             pass
 
+    def _checkin_data(self):
+        return {'api_key': self.api_key, 'os': platform.platform(), 'sdk_version': self.version, 'language': 'python3-' + sys.version, 'test_case_uuid': self.test_case_uuid}
+
+    def _checkin_in_background(self):
+        threading.Thread(target=self._checkin, name='testai-checkin', daemon=True).start()
+
+    def _page_version(self):
+        try:
+            return self._execute_script(PAGE_VERSION_SCRIPT)
+        except Exception:
+            return None
+
+    def _capture(self):
+        """
+            Returns a screenshot like _take_screenshot and its key.
+        """
+        screenshot = self._take_screenshot()
+        return screenshot, self._screenshot_key(screenshot)
+
+    def _take_screenshot(self):
+        """
+            Returns a screenshot, reusing the previous one when track_page_changes is on and nothing on the page
+            changed since. Canvas / video repaints are not detected by the page version.
+        """
+        page_version = self._page_version() if self.track_page_changes else None
+        last_capture = self._last_capture
+        if page_version is not None and last_capture is not None and last_capture[0] == page_version:
+            if self.debug:
+                print(f'Page unchanged since last screenshot ({page_version}), reusing it')
+            self.instrumentation.incr('screenshot.reused')
+            return last_capture[1]
+        screenshot = self._get_screenshot()
+        if page_version is not None:
+            self._last_capture = (page_version, screenshot)
+        return screenshot
+
+    def _screenshot_key(self, screenshot):
+        """
+            Key of the screenshot in the hash_mode, hashed the first time it is needed and kept on the screenshot.
+        """
+        if screenshot.key is None:
+            with self.instrumentation.span('screenshot_hash', hash_mode=self.hash_mode):
+                screenshot.key = self.get_screenshot_hash(screenshot)
+        return screenshot.key
+
     def _get_screenshot(self):
-        if self.use_cdp:
-            screenshotBase64 = self.driver.execute_cdp_cmd('Page.captureScreenshot', {})['data']
-        else:
-            screenshotBase64 = self.driver.get_screenshot_as_base64()
-        return screenshotBase64
+        self.instrumentation.incr('webdriver.round_trips', command='screenshot')
+        with self.instrumentation.span('screenshot', use_cdp=self._cdp_capture, format=self._capture_format):
+            if self._cdp_capture:
+                screenshot = Screenshot(self._cdp_screenshot())
+            else:
+                screenshot = Screenshot(self.driver.get_screenshot_as_base64())
+        if not self._multiplier_validated:
+            self._validate_multiplier(screenshot)
+        return screenshot
+
+    def _cdp_screenshot(self):
+        """
+            Takes the screenshot with Page.captureScreenshot using the capture settings.
+        """
+        capture = self.capture
+        params = {'format': capture['format']}
+        if capture['quality'] is not None and capture['format'] != 'png':
+            params['quality'] = capture['quality']
+        if capture['optimize_for_speed']:
+            params['optimizeForSpeed'] = True
+        if capture['clip'] or capture['css_pixels']:
+            self.instrumentation.incr('webdriver.round_trips', command='execute_cdp_cmd')
+            metrics = self.driver.execute_cdp_cmd('Page.getLayoutMetrics', {})
+            viewport = metrics['cssVisualViewport']
+            # layoutViewport is in device pixels, cssLayoutViewport in CSS pixels
+            device_pixel_ratio = 1.0 * metrics['layoutViewport']['clientWidth'] / metrics['cssLayoutViewport']['clientWidth']
+            clip = capture['clip'] or {'x': 0, 'y': 0, 'width': viewport['clientWidth'], 'height': viewport['clientHeight']}
+            scale = 1.0 / device_pixel_ratio if capture['css_pixels'] else 1.0
+            # The clip of Page.captureScreenshot is relative to the document, ours to the viewport
+            params['clip'] = {'x': viewport['pageX'] + clip['x'], 'y': viewport['pageY'] + clip['y'],
+                              'width': clip['width'], 'height': clip['height'], 'scale': scale}
+            # A clipped screenshot can't be compared with the window size, but the multiplier is known here
+            self._multiplier = device_pixel_ratio * scale
+            self._multiplier_validated = True
+        return self.driver.execute_cdp_cmd('Page.captureScreenshot', params)['data']
+
+    def _screenshot_box(self, rect):
+        """
+            Box in screenshot pixels of rect, in CSS pixels of the viewport.
+        """
+        m = self.multiplier
+        ox, oy = self._capture_origin
+        return {'x': (rect['x'] - ox) * m, 'y': (rect['y'] - oy) * m, 'width': rect['width'] * m,
+                'height': rect['height'] * m}
+
+    def _viewport_box(self, box):
+        """
+            Box in screenshot pixels moved to where it is in a screenshot of the whole viewport.
+        """
+        ox, oy = self._capture_origin
+        if not ox and not oy:
+            return box
+        m = self.multiplier
+        return dict(box, x=box['x'] + ox * m, y=box['y'] + oy * m)
+
+    def _remember_rect(self, element_name, rect):
+        """
+            Keeps rect, in CSS pixels of the viewport, as the last known box of element_name.
+        """
+        if self.label_boxes is None:
+            return
+        rect = {k: round(rect[k], 1) for k in ('x', 'y', 'width', 'height')}
+        if self.label_boxes.get(self.test_case_uuid, element_name) != rect:
+            self.label_boxes.put(self.test_case_uuid, element_name, rect)
+
+    def _remember_box(self, element_name, box):
+        """
+            Keeps box, in screenshot pixels, as the last known box of element_name.
+        """
+        if self.label_boxes is None:
+            return
+        m = self.multiplier
+        ox, oy = self._capture_origin
+        self._remember_rect(element_name, {'x': box['x'] / m + ox, 'y': box['y'] / m + oy, 'width': box['width'] / m,
+                                           'height': box['height'] / m})
+
+    def _execute_script(self, script, *args):
+        self.instrumentation.incr('webdriver.round_trips', command='execute_script')
+        return self.driver.execute_script(script, *args)
+
+    def _element_rects(self, elem):
+        """
+            (rect relative to the document like WebElement.rect, rect relative to the viewport) of elem in one round
+            trip. Screenshots only show the viewport, so crops out of them are placed with the second.
+        """
+        try:
+            r = self._execute_script(ELEMENT_VIEWPORT_RECT_SCRIPT, elem)
+            viewport_rect = {'x': r[0], 'y': r[1], 'width': r[2], 'height': r[3]}
+            return dict(viewport_rect, x=r[0] + r[4], y=r[1] + r[5]), viewport_rect
+        except Exception:
+            # Drivers without javascript, e.g. native apps, don't scroll a document
+            self.instrumentation.incr('webdriver.round_trips', command='rect')
+            rect = elem.rect
+            return rect, rect
+
+    def _update_elem_flow(self, elem, element_name, train_if_necessary=True):
+        """
+            Trains element_name on elem, found by its selector. Only the screenshot and the rect are read on the
+            calling thread, as the page may have changed by the time the upload runs, everything else is submitted.
+        """
+        screenshot = yield self._take_screenshot, ()
+        rect, viewport_rect = yield self._element_rects, (elem,)
+        yield self._remember_rect, (element_name, viewport_rect)
+        yield self._submit, (self._train, screenshot, element_name, rect, viewport_rect, train_if_necessary)
+
+    def _update_elems(self, elems, element_name, train_if_necessary=True):
+        """
+            Trains element_name on every match of a selector in one /add_action. The first box goes in the usual
+            fields so servers that only know about single boxes still learn from it.
+        """
+        screenshot = self._take_screenshot()
+        try:
+            rects = self._execute_script(ELEMENT_RECTS_SCRIPT, elems)
+            rects = [{'x': r[0], 'y': r[1], 'width': r[2], 'height': r[3]} for r in rects]
+        except Exception:
+            self.instrumentation.incr('webdriver.round_trips', len(elems), command='rect')
+            rects = [elem.rect for elem in elems]
+        self._submit(self._train, screenshot, element_name, rects[0], None, train_if_necessary, rects)
 
+    def _train(self, screenshot, element_name, rect, viewport_rect=None, train_if_necessary=True, rects=None):
+        return self._run_flow(self._train_flow(screenshot, element_name, rect, viewport_rect, train_if_necessary, rects))
 
-    def _update_elem(self, elem, key, element_name, train_if_necessary=True):
-        data = {
+    def _train_flow(self, screenshot, element_name, rect, viewport_rect=None, train_if_necessary=True, rects=None):
+        """
+            Uploads the screenshot and the box of element_name at rect, or at every one of rects, as a training
+            example and learns its template from viewport_rect. Runs on the upload worker, so hashing the
+            screenshot and decoding it for the template are off the test thread too.
+        """
+        key = yield self._screenshot_key, (screenshot,)
+        # No example of element_name is sent once its quota for the day is used, so the screenshot isn't needed
+        if (yield self._training_quota_left, (element_name,)):
+            yield self._upload_screenshot, (key, screenshot, element_name)
+        server_key = yield self._server_key, (screenshot, key)
+        data = self._action_data(rect, server_key, element_name, train_if_necessary)
+        if rects is not None:
+            data['boxes'] = [self._screenshot_box(r) for r in rects]
+        if (yield self._should_send_action, (data,)):
+            yield self._add_action, (data,)
+        if viewport_rect is not None and (yield self._should_learn_template, (element_name, viewport_rect, screenshot)):
+            yield self._learn_template, (element_name, key, screenshot, viewport_rect)
+
+    def _action_data(self, rect, key, element_name, train_if_necessary=True):
+        box = self._screenshot_box(rect)
+        return {
             'key': key,
             'api_key': self.api_key,
             'run_id': self.run_id,
             'label': element_name,
-            'x': elem.rect['x'] * self.multiplier,
-            'y': elem.rect['y'] * self.multiplier,
-            'width': elem.rect['width'] * self.multiplier,
-            'height': elem.rect['height'] * self.multiplier,
+            'x': box['x'],
+            'y': box['y'],
+            'width': box['width'],
+            'height': box['height'],
             'multiplier': self.multiplier,
             'train_if_necessary': train_if_necessary,
             'test_case_uuid': self.test_case_uuid
         }
+
+    def _should_send_action(self, data):
+        if self.training_log is None:
+            return True
+        reason = self.training_log.skip_reason(data)
+        if reason is None:
+            return True
+        self.instrumentation.incr('training.skipped', reason=reason)
+        if self.debug:
+            print(f'Not sending training example for {data["label"]}: {reason}')
+        return False
+
+    def _training_quota_left(self, element_name):
+        return self.training_log is None or self.training_log.quota_left(element_name)
+
+    def _should_learn_template(self, element_name, rect, screenshot):
+        if screenshot is None or self.template_store is None:
+            return False
+        entry = self.template_store.get(element_name)
+        # Elements that did not move are assumed to look the same, saves decoding the screenshot
+        return entry is None or entry[1] != rect
+
+    def _learn_template(self, element_name, key, screenshot, rect):
+        """
+            Keeps the crop of rect, in CSS pixels relative to the viewport, out of the screenshot as the template of
+            element_name.
+            Elements that are tiny, not fully in the screenshot or too plain to be recognized are skipped.
+        """
+        from PIL import Image
+        img = screenshot.open()
+        box = self._screenshot_box(rect)
+        left, top = box['x'], box['y']
+        right, bottom = left + box['width'], top + box['height']
+        width, height = round(rect['width'] * LOCAL_MATCH_SCALE), round(rect['height'] * LOCAL_MATCH_SCALE)
+        if left < 0 or top < 0 or right > img.size[0] or bottom > img.size[1] or width < 4 or height < 4:
+            return
+        if width * height > 256 * 256:
+            return
+        crop = img.crop((round(left), round(top), round(right), round(bottom))).convert('L')
+        template = _numpy().asarray(crop.resize((width, height), Image.BILINEAR))
+        if template.std() < 2:
+            return
+        self.template_store.put(element_name, template, rect, key)
+
+    def _add_action(self, data):
         try:
-            action_url = self.url + '/add_action'
-            # Verify is False as the lets encrypt certificate raises issue on mac.
-            _ = requests.post(action_url, json=data, verify=False)
+            _ = self._post('/add_action', json=data)
         except Exception:
             pass
 
+    def _element_from_box(self, element_box):
+        element_box = self._viewport_box(element_box)
+        if self.use_cdp:
+            parent_elem = None
+            real_elem = element_box
+        else:
+            real_elem = self._match_bounding_box_to_selenium_element(element_box, multiplier=self.multiplier)
+            parent_elem = real_elem.parent
+        return testai_elem(parent_elem, real_elem, element_box, self.driver, self.multiplier, inputs=self.inputs)
+
     def _classify(self, element_name):
-        msg = ''
+        return self._run_flow(self._classify_flow(element_name))
+
+    def _classify_flow(self, element_name):
+        """
+            Finds element_name in a screenshot: from the box the server has for the screenshot, a local template
+            match, the region around its last known box and then the whole screenshot, in that order.
+            Returns (element or None, key, message).
+        """
         if self.test_case_creation_mode:
-            self._test_case_upload_screenshot(element_name)
-            element_box = self._test_case_get_box(element_name)
-            if element_box:
-                if self.use_cdp:
-                    parent_elem = None
-                    real_elem = element_box
-                else:
-                    real_elem = self._match_bounding_box_to_selenium_element(element_box, multiplier=self.multiplier)
-                    parent_elem = real_elem.parent
-                element = testai_elem(parent_elem, real_elem, element_box, self.driver, self.multiplier)
-                return element, self.last_test_case_screenshot_uuid, msg
-            else:
-                label_url = self.url + '/test_case/label/' + urllib.parse.quote(self.test_case_uuid)
-                log.info('Waiting for bounding box of element {} to be drawn in the UI: \n\t{}'.format(element_name, label_url))
-                webbrowser.open(label_url)
-                while True:
-                    element_box = self._test_case_get_box(element_name)
-                    if element_box is not None:
-                        print('Element was labeled, moving on')
-                        if self.use_cdp:
-                            parent_elem = None
-                            real_elem = element_box
-                        else:
-                            real_elem = self._match_bounding_box_to_selenium_element(element_box, multiplier=self.multiplier)
-                            parent_elem = real_elem.parent
-                        element = testai_elem(parent_elem, real_elem, element_box, self.driver,
-                                              self.multiplier)
-                        return element, self.last_test_case_screenshot_uuid, msg
-                    time.sleep(2)
-        else:
-            element = None
-            run_key = None
-            # Call service
-            ## Get screenshot & page source
-            screenshotBase64 = self._get_screenshot()
-            key = self.get_screenshot_hash(screenshotBase64)
-            resp_data = self._check_screenshot_exists(key, element_name)
-            if resp_data['success'] and 'box' in resp_data:
+            # Waits for a person to draw the box, there is nothing to overlap
+            return (yield self._classify_for_test_case, (element_name,))
+        msg = ''
+        ## Get screenshot & page source
+        screenshot, key = yield self._capture, ()
+        resp_data = yield self._check_screenshot_exists, (screenshot, key, element_name)
+        if resp_data['success'] and 'box' in resp_data:
+            if self.debug:
+                print(f'Found cached box in action info for {element_name} using that')
+            element = yield self._element_from_box, (resp_data['box'],)
+            yield self._remember_box, (element_name, resp_data['box'])
+            return element, key, msg
+        if self.template_store is not None:
+            boxes = yield self._match_templates, (screenshot, [element_name])
+            if element_name in boxes:
+                try:
+                    return (yield self._element_from_box, (boxes[element_name],)), key, msg
+                except NoElementFoundException:
+                    log.debug('No element under the local match of %s, classifying it' % element_name)
+        element, run_key, msg = yield from self._classify_region_flow(screenshot, element_name, key)
+        if element is not None:
+            return element, run_key, msg
+        return (yield from self._classify_screenshot_flow(screenshot, element_name, key))
+
+    def _classify_for_test_case(self, element_name):
+        """
+            Uploads the screenshot for test case creation and waits for the box of element_name to be drawn.
+        """
+        msg = ''
+        self._test_case_upload_screenshot(element_name)
+        element_box = self._test_case_get_box(element_name)
+        if element_box:
+            element = self._element_from_box(element_box)
+            return element, self.last_test_case_screenshot_uuid, msg
+        else:
+            label_url = self.url + '/test_case/label/' + urllib.parse.quote(self.test_case_uuid)
+            log.info('Waiting for bounding box of element {} to be drawn in the UI: \n\t{}'.format(element_name, label_url))
+            webbrowser.open(label_url)
+            element_box = self._wait_for_test_case_box(element_name)
+            if element_box is None:
+                msg = 'Timed out after %ss waiting for element_name: %s to be labeled at %s' % (self.interactive_timeout, element_name, label_url)
+                return None, self.last_test_case_screenshot_uuid, msg
+            print('Element was labeled, moving on')
+            element = self._element_from_box(element_box)
+            return element, self.last_test_case_screenshot_uuid, msg
+
+    def _match_templates(self, screenshot, element_names):
+        """
+            Looks for the templates of element_names in the screenshot, around where each was last seen.
+            Returns {element_name: box in screenshot pixels} for the confident matches.
+        """
+        boxes = {}
+        entries = [(element_name, self.template_store.get(element_name)) for element_name in element_names]
+        entries = [(element_name, entry) for element_name, entry in entries if entry is not None]
+        if not entries:
+            return boxes
+        from PIL import Image
+        numpy = _numpy()
+        img = screenshot.open()
+        m = self.multiplier
+        ox, oy = self._capture_origin
+        for element_name, (template, box, _) in entries:
+            with self.instrumentation.span('local_match', element_name=element_name) as attributes:
+                margin = self.local_match_margin
+                # Search region in CSS pixels, relative to the screenshot
+                left, top = max(0, box['x'] - ox - margin), max(0, box['y'] - oy - margin)
+                right = min(img.size[0] / m, box['x'] - ox + box['width'] + margin)
+                bottom = min(img.size[1] / m, box['y'] - oy + box['height'] + margin)
+                width, height = round((right - left) * LOCAL_MATCH_SCALE), round((bottom - top) * LOCAL_MATCH_SCALE)
+                if width < template.shape[1] or height < template.shape[0]:
+                    attributes['score'] = None
+                    self.instrumentation.incr('local_match.miss')
+                    continue
+                region = img.crop((round(left * m), round(top * m), round(right * m), round(bottom * m))).convert('L')
+                region = numpy.asarray(region.resize((width, height), Image.BILINEAR))
+                row, column, score = _ncc_peak(region, template)
+                attributes['score'] = score
+                if score < self.local_match_threshold:
+                    self.instrumentation.incr('local_match.miss')
+                    continue
+                self.instrumentation.incr('local_match.hit')
                 if self.debug:
-                    print(f'Found cached box in action info for {element_name} using that')
-                element_box = resp_data['box']
-                if self.use_cdp:
-                    parent_elem = None
-                    real_elem = element_box
-                else:
-                    real_elem = self._match_bounding_box_to_selenium_element(element_box, multiplier=self.multiplier)
-                    parent_elem = real_elem.parent
-                element = testai_elem(parent_elem, real_elem, element_box, self.driver,
-                                      self.multiplier)
-                return element, key, msg
-            source = ''
-
-            # Check results
+                    print(f'Found {element_name} locally with score {score:.2f}')
+                x = left + column * (right - left) / width
+                y = top + row * (bottom - top) / height
+                boxes[element_name] = {'x': x * m, 'y': y * m, 'width': box['width'] * m, 'height': box['height'] * m}
+        return boxes
+
+    def _classify_all(self, element_name):
+        """
+            Classifies every element labeled element_name in one screenshot. Returns ([testai_elem], key, message).
+        """
+        if self.test_case_creation_mode:
+            # Boxes are drawn one at a time in the UI
+            element, key, msg = self._classify(element_name)
+            return ([element] if element is not None else []), key, msg
+        screenshot, key = self._capture()
+        boxes, run_key, msg = self._classify_boxes(screenshot, element_name, key)
+        if not boxes:
+            return [], run_key, msg
+        boxes = [self._viewport_box(box) for box in boxes]
+        if self.use_cdp:
+            return [testai_elem(None, box, box, self.driver, self.multiplier, inputs=self.inputs) for box in boxes], run_key, msg
+        real_elems = self._match_bounding_boxes_to_selenium_elements(boxes, multiplier=self.multiplier)
+        elements = []
+        seen = set()
+        for box, real_elem in zip(boxes, real_elems):
+            # Overlapping boxes can land on the same element
+            if real_elem is None or real_elem.id in seen:
+                continue
+            seen.add(real_elem.id)
+            elements.append(testai_elem(real_elem.parent, real_elem, box, self.driver, self.multiplier, inputs=self.inputs))
+        return elements, run_key, msg
+
+    def _classify_boxes(self, screenshot, element_name, key=None):
+        """
+            Asks /classify for the boxes of every element labeled element_name in the screenshot.
+            Servers that return a single box are handled too. Returns ([box], run key, message).
+        """
+        boxes = []
+        run_key = None
+        msg = ''
+        try:
+            data = {'source': '', 'api_key': self.api_key, 'label': element_name, 'run_id': self.run_id, 'multiple': True}
+            request, scale = self._screenshot_request(screenshot, data, downscale=self.downscale_uploads)
+            r = self._post('/classify', replay_key=(key, element_name + '[]'), **request)
+            response = json.loads(r.text)
+            run_key = response['key']
+            msg = response.get('message', '')
+            if response.get('success', False):
+                log.info('successful classification of element_name: %s' % element_name)
+                boxes = response['boxes'] if 'boxes' in response else [response['elem']]
+                boxes = [self._unscale_box(box, scale) for box in boxes]
+            else:
+                msg = self._classification_failed_message(element_name, msg, r.text)
+        except Exception:
+            logging.exception('exception during classification')
+        return boxes, run_key, msg
+
+    def _classify_screenshot_flow(self, screenshot, element_name, key=None):
+        element = None
+        element_box, run_key, msg = yield self._classify_box, (screenshot, element_name, key)
+        if element_box is not None:
             try:
-                data = {'screenshot': screenshotBase64, 'source': source,
-                        'api_key':self.api_key, 'label': element_name, 'run_id': self.run_id}
-                classify_url = self.url + '/classify'
-                start = time.time()
-                r = requests.post(classify_url, data=data, verify=False)
-                end = time.time()
-                if self.debug:
-                    print(f'Classify time: {end - start}')
-                response = json.loads(r.text)
-                run_key = response['key']
-                msg = response.get('message', '')
-                if response.get('success', False):
-                    log.info('successful classification of element_name: %s' % element_name)
-                    element_box = response['elem']
-                    if self.use_cdp:
-                        parent_elem = None
-                        real_elem = element_box
-                    else:
-                        real_elem = self._match_bounding_box_to_selenium_element(element_box, multiplier=self.multiplier)
-                        parent_elem = real_elem.parent
-                    element = testai_elem(parent_elem, real_elem, element_box, self.driver, self.multiplier)
-                else:
-                    if 'Please label' in msg or 'Did not find' in msg:
-                        msg = 'Classification failed for element_name: %s - Please visit %s to classify' % (element_name, self.url + '/label/' + element_name + '?label=' + element_name)
-                    elif 'frozen label' in msg:
-                        msg = 'Classification failed for element_name: %s - However this element is frozen, so no new screenshot was uploaded. Please unfreeze the element if you want to add this screenshot to training' % element_name
-                    if msg == '':
-                        msg = 'Unknown error, here was the API response %s' % r.text
+                element = yield self._element_from_box, (element_box,)
+                yield self._remember_box, (element_name, element_box)
             except Exception:
                 logging.exception('exception during classification')
-            return element, run_key, msg
+        return element, run_key, msg
+
+    def _classify_region_flow(self, screenshot, element_name, key=None):
+        """
+            Classifies element_name in the region of interest around its last known box only.
+            Returns (element or None, run key, message) like _classify_screenshot_flow.
+        """
+        region = yield self._region_of_interest, (screenshot, element_name)
+        if region is None:
+            return None, None, ''
+        crop, offset = region
+        # The crop is sent with the key of the whole screenshot on the server
+        server_key = yield self._server_key, (screenshot, key)
+        element_box, run_key, msg = yield self._classify_box, (crop, element_name, server_key, offset)
+        element = yield self._element_from_region_box, (element_name, element_box, offset)
+        return element, run_key, msg
+
+    def _region_of_interest(self, screenshot, element_name):
+        """
+            Crops the area within region_margin CSS pixels around the last known box of element_name out of the
+            screenshot. Returns (crop as a PNG Screenshot, [left, top] of the crop in screenshot pixels), or None when
+            the box is unknown, not in the screenshot or the area would be most of the screenshot anyway.
+        """
+        if self.label_boxes is None:
+            return None
+        rect = self.label_boxes.get(self.test_case_uuid, element_name)
+        if rect is None:
+            return None
+        img = screenshot.open()
+        box = self._screenshot_box(rect)
+        margin = self.region_margin * self.multiplier
+        left, top = max(0, round(box['x'] - margin)), max(0, round(box['y'] - margin))
+        right = min(img.size[0], round(box['x'] + box['width'] + margin))
+        bottom = min(img.size[1], round(box['y'] + box['height'] + margin))
+        if right <= left or bottom <= top or (right - left) * (bottom - top) > img.size[0] * img.size[1] / 2:
+            return None
+        buf = io.BytesIO()
+        img.crop((left, top, right, bottom)).save(buf, 'PNG')
+        return Screenshot(data=buf.getvalue()), [left, top]
+
+    def _element_from_region_box(self, element_name, element_box, offset):
+        """
+            Element under a box found in the region of interest at offset, None when there is none.
+        """
+        if element_box is None:
+            self.instrumentation.incr('classify_region.miss')
+            return None
+        element_box = dict(element_box, x=element_box['x'] + offset[0], y=element_box['y'] + offset[1])
+        try:
+            element = self._element_from_box(element_box)
+        except Exception:
+            log.debug('No element under the box of %s in its region of interest' % element_name, exc_info=True)
+            self.instrumentation.incr('classify_region.miss')
+            return None
+        self.instrumentation.incr('classify_region.hit')
+        if self.debug:
+            print(f'Found {element_name} in the region around its last known box')
+        self._remember_box(element_name, element_box)
+        return element
+
+    def _classify_box(self, screenshot, element_name, key=None, offset=None):
+        """
+            Asks /classify for the box of element_name in the screenshot with hash key, or in the crop of it at
+            offset. Returns (box or None, run key, message), boxes in a crop are relative to it.
+        """
+        element_box = None
+        run_key = None
+        msg = ''
+        source = ''
+
+        # Check results
+        try:
+            data = {'source': source, 'api_key':self.api_key, 'label': element_name, 'run_id': self.run_id}
+            replay_key = self._add_region_fields(data, key, element_name, offset)
+            request, scale = self._screenshot_request(screenshot, data, downscale=self.downscale_uploads)
+            r = self._post('/classify', replay_key=replay_key, **request)
+            element_box, run_key, msg = self._classify_response(element_name, r.text, scale)
+        except Exception:
+            logging.exception('exception during classification')
+        return element_box, run_key, msg
+
+    def _add_region_fields(self, data, key, element_name, offset):
+        """
+            Tells /classify which screenshot a crop at offset was taken from. Returns the replay key of the request.
+        """
+        if offset is None:
+            return (key, element_name)
+        data['screenshot_uuid'] = key
+        data['offset'] = json.dumps(offset)
+        return (key, element_name + '@region')
+
+    def _classify_response(self, element_name, response_text, scale):
+        """
+            Parses a /classify response into (box or None, run key, message).
+        """
+        response = json.loads(response_text)
+        run_key = response['key']
+        msg = response.get('message', '')
+        if response.get('success', False):
+            log.info('successful classification of element_name: %s' % element_name)
+            return self._unscale_box(response['elem'], scale), run_key, msg
+        return None, run_key, self._classification_failed_message(element_name, msg, response_text)
+
+    def _classification_failed_message(self, element_name, msg, response_text):
+        if 'Please label' in msg or 'Did not find' in msg:
+            msg = 'Classification failed for element_name: %s - Please visit %s to classify' % (element_name, self.url + '/label/' + element_name + '?label=' + element_name)
+        elif 'frozen label' in msg:
+            msg = 'Classification failed for element_name: %s - However this element is frozen, so no new screenshot was uploaded. Please unfreeze the element if you want to add this screenshot to training' % element_name
+        if msg == '':
+            msg = 'Unknown error, here was the API response %s' % response_text
+        return msg
+
+    def _classify_many(self, element_names):
+        """
+            Classifies several labels against one screenshot: one capture, one hash, one batched cache lookup
+            and one batched /classify upload for the labels without a cached box.
+            Returns ({element_name: element or None}, key, {element_name: error message}).
+        """
+        return self._run_flow(self._classify_many_flow(element_names))
+
+    def _classify_many_flow(self, element_names):
+        msgs = {}
+        screenshot, key = yield self._capture, ()
+        boxes = yield self._check_screenshots_exist, (screenshot, key, element_names)
+        remaining = [element_name for element_name in element_names if element_name not in boxes]
+        if remaining and self.template_store is not None:
+            boxes.update((yield self._match_templates, (screenshot, remaining)))
+            remaining = [element_name for element_name in element_names if element_name not in boxes]
+        if remaining:
+            classified_boxes, msgs = yield self._classify_screenshot_many, (screenshot, remaining, key)
+            boxes.update(classified_boxes)
+        elements = yield self._elements_from_boxes, (element_names, boxes, msgs)
+        return elements, key, msgs
+
+    def _elements_from_boxes(self, element_names, boxes, msgs):
+        """
+            Returns {element_name: element or None}, adding why to msgs for the boxes without an element under them.
+            The elements under all the boxes are looked up in a single execute_script.
+        """
+        elements = {element_name: None for element_name in element_names}
+        found = [element_name for element_name in element_names if element_name in boxes]
+        if not found:
+            return elements
+        viewport_boxes = [self._viewport_box(boxes[element_name]) for element_name in found]
+        if self.use_cdp:
+            real_elems = viewport_boxes
+        else:
+            real_elems = self._match_bounding_boxes_to_selenium_elements(viewport_boxes, multiplier=self.multiplier)
+        for element_name, box, real_elem in zip(found, viewport_boxes, real_elems):
+            if real_elem is None:
+                msgs[element_name] = 'Could not find any web element under the center of the bounding box'
+                continue
+            parent_elem = None if self.use_cdp else real_elem.parent
+            elements[element_name] = testai_elem(parent_elem, real_elem, box, self.driver, self.multiplier,
+                                                 inputs=self.inputs)
+        return elements
+
+    def _check_screenshots_exist(self, screenshot, key, element_names):
+        """
+            Returns {element_name: box} for the labels that already have a box for this screenshot.
+            Servers that do not understand the batched request are asked one label at a time.
+        """
+        boxes, remaining = self._cached_boxes(key, element_names)
+        if not remaining:
+            return boxes
+        data = {'api_key': self.api_key, 'screenshot_uuid': self._server_key(screenshot, key), 'labels': remaining}
+        r = self._post('/check_screenshot_exists', replay_key=(key, remaining), json=data)
+        response = r.json() if r.status_code == 200 else {}
+        if 'boxes' not in response:
+            for element_name in remaining:
+                resp_data = self._check_screenshot_exists(screenshot, key, element_name)
+                if resp_data['success'] and 'box' in resp_data:
+                    boxes[element_name] = resp_data['box']
+            return boxes
+        boxes.update(self._store_boxes(key, remaining, response['boxes']))
+        return boxes
+
+    def _cached_boxes(self, key, element_names):
+        """
+            Returns ({element_name: box} from the box cache, element_names not in it).
+        """
+        boxes = {}
+        remaining = []
+        for element_name in element_names:
+            response = self.box_cache.get(key, element_name) if self.box_cache is not None else None
+            if response is not None:
+                self.instrumentation.incr('box_cache.hit')
+                boxes[element_name] = response['box']
+            else:
+                if self.box_cache is not None:
+                    self.instrumentation.incr('box_cache.miss')
+                remaining.append(element_name)
+        return boxes, remaining
+
+    def _store_boxes(self, key, element_names, response_boxes):
+        """
+            Caches the boxes of a batched /check_screenshot_exists response and returns those of element_names.
+        """
+        boxes = {}
+        for element_name, box in response_boxes.items():
+            if element_name in element_names and box:
+                boxes[element_name] = box
+                if self.box_cache is not None:
+                    self.box_cache.put(key, element_name, {'success': True, 'box': box})
+        return boxes
+
+    def _classify_screenshot_many(self, screenshot, element_names, key=None):
+        """
+            Uploads the screenshot once to classify every label in element_names.
+            Returns ({element_name: box}, {element_name: error message}).
+        """
+        boxes = {}
+        msgs = {}
+        try:
+            data = {'source': '', 'api_key': self.api_key, 'labels': json.dumps(element_names), 'run_id': self.run_id}
+            request, scale = self._screenshot_request(screenshot, data, downscale=self.downscale_uploads)
+            r = self._post('/classify', replay_key=(key, element_names), **request)
+            response = json.loads(r.text)
+        except Exception:
+            logging.exception('exception during batched classification')
+            response = {}
+        if 'elems' not in response:
+            # Server without batch support, classify the same screenshot one label at a time
+            for element_name in element_names:
+                box, _, msg = self._classify_box(screenshot, element_name, key)
+                if box is not None:
+                    boxes[element_name] = box
+                else:
+                    msgs[element_name] = msg
+            return boxes, msgs
+        return self._classify_many_response(element_names, response, r.text, scale)
+
+    def _classify_many_response(self, element_names, response, response_text, scale):
+        """
+            Splits a batched /classify response into ({element_name: box}, {element_name: error message}).
+        """
+        boxes = {}
+        msgs = {}
+        messages = response.get('messages', {})
+        for element_name in element_names:
+            box = response['elems'].get(element_name)
+            if box:
+                log.info('successful classification of element_name: %s' % element_name)
+                boxes[element_name] = self._unscale_box(box, scale)
+            else:
+                msgs[element_name] = self._classification_failed_message(element_name, messages.get(element_name, ''), response_text)
+        return boxes, msgs
 
     def get_screenshot_hash(self, b64img):
-        msg = base64.b64decode(b64img)
-        buf = io.BytesIO(msg)
-        img = Image.open(buf)
+        screenshot = b64img if isinstance(b64img, Screenshot) else Screenshot(b64img)
+        if self.hash_mode == 'fast':
+            return self._fast_screenshot_hash(screenshot.data)
+        return self._md5_screenshot_hash(screenshot)
+
+    def _server_key(self, screenshot, key):
+        """
+            screenshot_uuid of the screenshot with local key on the server. The server knows screenshots by their md5
+            key while fast keys only key the local caches, so in the fast mode it is hashed again when first needed.
+        """
+        if self.hash_mode == 'md5':
+            return key
+        if screenshot.server_key is None:
+            screenshot.server_key = self._md5_screenshot_hash(screenshot)
+        return screenshot.server_key
+
+    def _md5_screenshot_hash(self, screenshot):
+        img = screenshot.open()
         w, h = img.size
-        return hashlib.md5(img.crop((0, 75, w - 50, h - 75)).tobytes()).hexdigest()
-
-    def _check_screenshot_exists(self, key, element_name):
-        data = {'api_key': self.api_key, 'screenshot_uuid': key, 'label': element_name}
-        check_screenshot_url = self.url + '/check_screenshot_exists'
-        start = time.time()
-        r = requests.post(check_screenshot_url, json=data, verify=False)
-        end = time.time()
+        digest = hashlib.md5()
+        # Hashed in bands of rows so the crop is never copied out of the image as a whole, the digest is the same as
+        # over img.crop((0, 75, w - 50, h - 75)).tobytes()
+        for top in range(75, h - 75, 64):
+            digest.update(img.crop((0, top, w - 50, min(top + 64, h - 75))).tobytes())
+        return digest.hexdigest()
+
+    def _fast_screenshot_hash(self, msg):
+        """
+            Fingerprints the same crop as the md5 hash without decoding the image into memory. PNGs are fingerprinted
+            from their inflated rows a band at a time, anything else from a reduced size draft decode. The keys
+            depend on the browser's encoder, so they only key the local caches and are never sent to the server.
+        """
+        w, h = _image_size(msg)
+        # Trimming the margins of a screenshot smaller than them would leave nothing, it is fingerprinted whole
+        top = bottom = 75 if h > 150 else 0
+        right = 50 if w > 50 else 0
+        key = _png_crop_fingerprint(msg, 0, top, right, bottom)
+        if key is not None:
+            return key
+        from PIL import Image
+        img = Image.open(io.BytesIO(msg))
+        # Only JPEG supports draft mode, for other formats this is a no-op and we pay for a full decode
+        img.draft('RGB', (max(1, w // 4), max(1, h // 4)))
+        scale = 1.0 * img.size[0] / w
+        crop = (0, int(top * scale), max(1, int((w - right) * scale)), max(1, int((h - bottom) * scale)))
+        return hashlib.blake2b(img.crop(crop).tobytes(), digest_size=16).hexdigest()
+
+    def _check_screenshot_exists(self, screenshot, key, element_name):
+        response = self._cached_box_response(key, element_name)
+        if response is not None:
+            return response
+        data = {'api_key': self.api_key, 'screenshot_uuid': self._server_key(screenshot, key), 'label': element_name}
+        r = self._post('/check_screenshot_exists', replay_key=(key, element_name), json=data)
+        return self._box_response(key, element_name, r.status_code, r.text)
+
+    def _cached_box_response(self, key, element_name):
+        if self.box_cache is None:
+            return None
+        response = self.box_cache.get(key, element_name)
+        if response is None:
+            self.instrumentation.incr('box_cache.miss')
+            return None
+        self.instrumentation.incr('box_cache.hit')
         if self.debug:
-            print(f'Cached bounding box request time: {end - start}')
+            print(f'Found locally cached box for {element_name} in screenshot {key}')
+        return response
 
-        if r.status_code != 200:
+    def _box_response(self, key, element_name, status_code, response_text):
+        if status_code != 200:
             raise Exception('Error checking cached screenshot from remote')
         else:
-            response = json.loads(r.text)
+            response = json.loads(response_text)
+            if self.box_cache is not None and response.get('success') and 'box' in response:
+                self.box_cache.put(key, element_name, response)
             return response
 
-    def _upload_screenshot_if_necessary(self, element_name):
-        screenshotBase64 = self._get_screenshot()
-        key = self.get_screenshot_hash(screenshotBase64)
+    def _upload_screenshot(self, key, screenshot, element_name):
         # Check results
         try:
-            response = self._check_screenshot_exists(key, element_name)
+            response = self._check_screenshot_exists(screenshot, key, element_name)
             if self.debug:
                 print(response)
             if response['success'] == True:
@@ -761,108 +1906,309 @@ class TestAiDriver():
                 else:
                     if self.debug:
                         print(f'Screenshot {key} already exists on remote')
-                return key
             else:
                 if self.debug:
                     print(f'Screenshot {key} does not exist on remote, uploading it')
-                data = {'api_key': self.api_key, 'screenshot_uuid': key, 'screenshot': screenshotBase64, 'label': element_name, 'test_case_uuid': self.test_case_uuid}
-                upload_screenshot_url = self.url + '/upload_screenshot'
-                start = time.time()
-                r = requests.post(upload_screenshot_url, json=data, verify=False)
-                end = time.time()
-                if self.debug:
-                    print(f'Upload screenshot request time: {end - start}')
+                data = {'api_key': self.api_key, 'screenshot_uuid': self._server_key(screenshot, key), 'label': element_name,
+                        'test_case_uuid': self.test_case_uuid}
+                request, _ = self._screenshot_request(screenshot, data, as_json=True)
+                r = self._post('/upload_screenshot', **request)
                 if r.status_code != 200:
                     log.error('Error uploading screenshot to remote')
-                else:
-                    pass
-                return key
         except Exception:
             log.exception('Error checking cached screenshot / uploading it from remote')
 
 
-    def _test_case_get_box(self, label):
+    def _test_case_get_box(self, label, run_classifier=None, wait=0):
         """
             Checks for a bounding box given the last screenshot uuid that we got when uploading it.
+            The screenshot is only sent along when the classifier should run on it. With wait the server may hold
+            the request open for up to that many seconds until the box is drawn.
         """
-        data = {'api_key': self.api_key, 'label': label, 'screenshot_uuid': self.last_test_case_screenshot_uuid, 'run_classifier': self.use_classifier_during_creation}
-        if self.use_classifier_during_creation:
-            data['screenshot'] = self.last_screenshot
-
-        r = requests.post(self.url + '/test_case/get_bounding_box', json=data, verify=False)
+        if run_classifier is None:
+            run_classifier = self.use_classifier_during_creation
+        data = {'api_key': self.api_key, 'label': label, 'screenshot_uuid': self.last_test_case_screenshot_uuid, 'run_classifier': run_classifier}
+        if run_classifier:
+            request, _ = self._screenshot_request(self.last_screenshot, data, as_json=True)
+        else:
+            request = {'json': data}
+        if wait:
+            data['wait'] = wait
+            timeout = self.server_timeouts.get('/test_case/get_bounding_box', self.server_timeouts['default'])
+            connect_timeout = timeout[0] if isinstance(timeout, tuple) else timeout
+            request['timeout'] = (connect_timeout, wait + 10)
+
+        r = self._post('/test_case/get_bounding_box', **request)
         if r.status_code != 200:
             return None
         else:
             box = r.json()['box']
             return box
 
+    def _wait_for_test_case_box(self, label, poll_interval=2):
+        """
+            Long polls for the box of label to be drawn in the UI until interactive_timeout.
+            Servers that answer right away are polled every poll_interval seconds instead.
+        """
+        deadline = None if self.interactive_timeout is None else time.time() + self.interactive_timeout
+        while True:
+            start = time.time()
+            wait = self.long_poll_wait
+            if deadline is not None:
+                wait = min(wait, max(deadline - start, 0))
+            try:
+                # The classifier already ran on the first request, so polls never re-send the screenshot
+                element_box = self._test_case_get_box(label, run_classifier=False, wait=wait)
+            except Exception:
+                log.debug('Polling for the bounding box of %s failed, retrying' % label, exc_info=True)
+                element_box = None
+            if element_box is not None:
+                return element_box
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                return None
+            if now - start < poll_interval:
+                sleep_time = poll_interval - (now - start)
+                if deadline is not None:
+                    sleep_time = min(sleep_time, deadline - now)
+                time.sleep(sleep_time)
+
     def _test_case_upload_screenshot(self, label):
         """
             Uploads the screenshot to the server for test creation and retrieves the uuid / hash / key in return.
         """
-        url = self.url + '/test_case/upload_screenshot'
-        screenshotBase64 = self._get_screenshot()
-        self.last_screenshot = screenshotBase64
-        data = {'api_key': self.api_key, 'test_case_uuid': self.test_case_uuid, 'screenshot': screenshotBase64, 'label': label}
-        r = requests.post(url, data=data, verify=False)
+        screenshot = self._get_screenshot()
+        self.last_screenshot = screenshot
+        data = {'api_key': self.api_key, 'test_case_uuid': self.test_case_uuid, 'label': label}
+        request, _ = self._screenshot_request(screenshot, data)
+        r = self._post('/test_case/upload_screenshot', **request)
         if r.status_code == 200:
             res = r.json()
             if res['success']:
                 self.last_test_case_screenshot_uuid = res['key']
-                self.last_screenshot = screenshotBase64
+                self.last_screenshot = screenshot
             else:
                 raise Exception('Failed to upload screenshot during test case creation')
 
+    def _screenshot_request(self, screenshot, fields, as_json=False, downscale=False):
+        """
+            Builds the self._post keyword arguments sending the screenshot along with fields in the configured transport.
+            Returns them with the scale of the uploaded image relative to the screenshot, boxes computed on the
+            uploaded image must be divided by it. Only pass downscale when the boxes in the response are mapped back.
+            The body is streamed from the screenshot's buffer rather than built in memory.
+        """
+        if (self.screenshot_transport == 'base64' and self.upload_format is None and not downscale
+                and screenshot.format == 'png'):
+            return self._base64_request(fields, screenshot, as_json), 1.0
+        image, image_format, scale = self._encode_upload(screenshot.data, downscale)
+        if self.screenshot_transport == 'base64':
+            fields = dict(fields, screenshot_format=image_format, screenshot_scale=scale)
+            return self._base64_request(fields, Screenshot(data=image), as_json), scale
+        metadata = dict(fields, screenshot_format=image_format, screenshot_scale=scale)
+        body = _multipart_body([
+            ('screenshot', 'screenshot.' + image_format, 'image/' + image_format, image),
+            ('metadata', 'metadata.json.gz', 'application/gzip', gzip.compress(json.dumps(metadata).encode('utf-8'))),
+        ])
+        return {'data': body, 'headers': {'Content-Type': body.content_type}}, scale
+
+    def _base64_request(self, fields, screenshot, as_json=False):
+        """
+            self._post keyword arguments sending fields plus the screenshot as base64 in a JSON or form body.
+        """
+        if as_json:
+            head = json.dumps(fields)[:-1] + (', ' if fields else '') + '"screenshot": "'
+            body = _RequestBody([head.encode('utf-8'), _Base64Part(screenshot), b'"}'],
+                                content_type='application/json')
+        else:
+            # Like requests, fields set to None are left out of forms
+            head = urllib.parse.urlencode([(k, v) for k, v in fields.items() if v is not None])
+            body = _RequestBody([(head + '&screenshot=' if head else 'screenshot=').encode('ascii'),
+                                 _Base64Part(screenshot, quote=True)],
+                                content_type='application/x-www-form-urlencoded')
+        return {'data': body, 'headers': {'Content-Type': body.content_type}}
+
+    def _encode_upload(self, image, downscale=False):
+        """
+            Re-encodes the raw screenshot bytes in upload_format, at CSS pixel size if downscale is set.
+            Returns (bytes, format, scale).
+        """
+        image_format = _image_format(image)
+        scale = 1.0
+        if self.upload_format is None and image_format is not None and not (downscale and self.multiplier > 1):
+            return image, image_format, scale
+        from PIL import Image
+        img = Image.open(io.BytesIO(image))
+        image_format = self.upload_format or (img.format or 'png').lower()
+        if downscale and self.multiplier > 1:
+            scale = 1.0 / self.multiplier
+            img = img.resize((max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale))), Image.BILINEAR)
+        options = {}
+        if image_format == 'jpeg':
+            img = img.convert('RGB')
+            options['quality'] = self.upload_quality or 90
+        elif image_format == 'webp':
+            # Without a quality WebP is encoded losslessly
+            if self.upload_quality is None:
+                options['lossless'] = True
+            else:
+                options['quality'] = self.upload_quality
+        buf = io.BytesIO()
+        img.save(buf, format=image_format.upper(), **options)
+        return buf.getvalue(), image_format, scale
+
+    def _unscale_box(self, box, scale):
+        if scale == 1.0:
+            return box
+        box = dict(box)
+        for k in ('x', 'y', 'width', 'height'):
+            if k in box:
+                box[k] = box[k] / scale
+        return box
+
     def update_test_case_status(self, test_case_name, status, message='', extra_info={}):
-        url = self.url + '/test_case/set_test_case_status'
         data = {'api_key': self.api_key, 'test_case_status': status, 'message': message,
                 'test_case_uuid': test_case_name, 'extra_info': extra_info}
-        res = requests.post(url, json=data, verify=False)
+        res = self._post('/test_case/set_test_case_status', json=data)
         if res.status_code != 200:
             raise Exception('Failed to upload test case result')
 
     def _match_bounding_box_to_selenium_element(self, bounding_box, multiplier=1):
         """
             We have to ba hacky about this becasue Selenium does not let us click by coordinates.
-            We retrieve all elements, compute the IOU between the bounding_box and all the elements and pick the best match.
+            We score the elements under the center of the bounding_box by IOU in the browser, in a single
+            execute_script, and pick the best match.
         """
         # Adapt box to local coordinates
         new_box = {'x': bounding_box['x'] / multiplier, 'y': bounding_box['y'] / multiplier,
                    'width': bounding_box['width'] / multiplier, 'height': bounding_box['height'] / multiplier}
+        with self.instrumentation.span('match_bounding_box') as attributes:
+            if self.track_page_changes:
+                # The page version tells us when the layout changed, so one snapshot serves every match on the page
+                attributes['method'] = 'layout'
+                try:
+                    element = self._match_box_in_layout(new_box)
+                    if element is not None:
+                        return element
+                except NoElementFoundException:
+                    raise
+                except Exception:
+                    log.debug('Matching bounding box in the layout snapshot failed', exc_info=True)
+            attributes['method'] = 'script'
+            try:
+                candidates = self._execute_script(MATCH_BOX_SCRIPT, new_box)
+            except Exception:
+                # Drivers without javascript support, score every element from python instead
+                log.debug('Matching bounding box in the browser failed, falling back to scanning all elements', exc_info=True)
+                attributes['method'] = 'scan'
+                candidates = self._score_elements_under_box(new_box)
+            if not candidates:
+                raise NoElementFoundException('Could not find any web element under the center of the bounding box')
+            return self._pick_candidate(candidates)
+
+    def _match_bounding_boxes_to_selenium_elements(self, bounding_boxes, multiplier=1):
+        """
+            _match_bounding_box_to_selenium_element for many boxes in a single execute_script.
+            Returns the element under each box, None where there is none.
+        """
+        new_boxes = [{k: box[k] / multiplier for k in ('x', 'y', 'width', 'height')} for box in bounding_boxes]
+        with self.instrumentation.span('match_bounding_boxes', count=len(new_boxes)) as attributes:
+            attributes['method'] = 'script'
+            try:
+                candidate_lists = self._execute_script(MATCH_BOXES_SCRIPT, new_boxes)
+            except Exception:
+                log.debug('Matching bounding boxes in the browser failed, falling back to scanning all elements', exc_info=True)
+                attributes['method'] = 'scan'
+                candidate_lists = [self._score_elements_under_box(new_box) for new_box in new_boxes]
+            return [self._pick_candidate(candidates) if candidates else None for candidates in candidate_lists]
+
+    def _pick_candidate(self, candidates):
+        """
+        We have to be smart about element selection here because of clicks being intercepted and what not, so we basically 
+        examine the elements in order of decreasing score, where score > 0. As long as the center of the box is within the elements,
+        they are a valid candidate. If none of them is of type input, we pick the one with maxIOU, otherwise we pick the input type,
+        which is 90% of test cases.
+        """
+        for element, score, tag_name in candidates:
+            if (tag_name == 'input' or tag_name == 'button') and score > candidates[0][1] * 0.9:
+                return element
+        return candidates[0][0]
+
+    def _take_layout_snapshot(self):
+        token = uuid.uuid4().hex
+        page_version, rects, tag_names = self._execute_script(LAYOUT_SNAPSHOT_SCRIPT, token)
+        self._layout_snapshot = LayoutSnapshot(rects, tag_names, page_version=page_version, token=token)
+        return self._layout_snapshot
+
+    def _resolve_layout_elements(self, snapshot, indices):
+        """
+            Fetches the elements at indices of the snapshot in one round trip, None if the page changed since.
+        """
+        return self._execute_script(RESOLVE_LAYOUT_SCRIPT, snapshot.token, list(indices))
+
+    def _match_box_in_layout(self, new_box):
+        """
+            Matches new_box against the current layout snapshot, taking a new one when the page changed.
+            Returns None when the snapshot could not be used.
+        """
+        snapshot = self._layout_snapshot
+        fresh = snapshot is None
+        if fresh:
+            snapshot = self._take_layout_snapshot()
+        while True:
+            candidates = [[index, score, snapshot.tag_names[index]] for index, score in snapshot.score(new_box)]
+            if candidates:
+                elements = self._resolve_layout_elements(snapshot, [self._pick_candidate(candidates)])
+                if elements:
+                    return elements[0]
+            elif fresh:
+                raise NoElementFoundException('Could not find any web element under the center of the bounding box')
+            if fresh:
+                return None
+            # The snapshot was stale, retry once on a new one
+            snapshot = self._take_layout_snapshot()
+            fresh = True
+
+    def _score_elements_under_box(self, new_box):
+        """
+            Returns [element, score, tag name] for the elements with a positive IOU whose rect contains the center of
+            new_box, best first. This costs several WebDriver round trips per element on the page.
+        """
         # Get all elements
+        self.instrumentation.incr('webdriver.round_trips', command='find_elements')
         elements = self.driver.find_elements_by_xpath("//*")
+        self.instrumentation.incr('webdriver.round_trips', len(elements), command='rect')
         # Compute IOU
         iou_scores = []
+        rects = []
         for element in elements:
             try:
-                iou_scores.append(self._iou_boxes(new_box, element.rect))
+                rect = element.rect
+                iou_scores.append(self._iou_boxes(new_box, rect))
             except StaleElementReferenceException:
+                rect = None
                 iou_scores.append(0)
-        composite = sorted(zip(iou_scores, elements), reverse=True, key=lambda x: x[0])
-        # Pick the best match
-        """
-        We have to be smart about element selection here because of clicks being intercepted and what not, so we basically 
-        examine the elements in order of decreasing score, where score > 0. As long as the center of the box is within the elements,
-        they are a valid candidate. If none of them is of type input, we pick the one with maxIOU, otherwise we pick the input type,
-        which is 90% of test cases.
-        """
+            rects.append(rect)
+        composite = sorted(zip(iou_scores, elements, rects), reverse=True, key=lambda x: x[0])
         composite = filter(lambda x: x[0] > 0, composite)
-        composite = list(filter(lambda x: self._center_hit(new_box, x[1].rect), composite))
-
-        if len(composite) == 0:
-            raise NoElementFoundException('Could not find any web element under the center of the bounding box')
-        else:
-            for score, element in composite:
-                if (element.tag_name == 'input' or element.tag_name == 'button') and score > composite[0][0] * 0.9:
-                    return element
-            return composite[0][1]
+        composite = filter(lambda x: self._center_hit(new_box, x[2]), composite)
+        candidates = []
+        for score, element, rect in composite:
+            try:
+                self.instrumentation.incr('webdriver.round_trips', command='tag_name')
+                candidates.append([element, score, element.tag_name])
+            except StaleElementReferenceException:
+                continue
+        return candidates
 
     def _iou_boxes(self, box1, box2):
         return self._iou(box1['x'], box1['y'], box1['width'], box1['height'], box2['x'], box2['y'], box2['width'], box2['height'])
 
     def _iou(self, x, y, w, h, xx, yy, ww, hh):
-        return self._area_overlap(x, y, w, h, xx, yy, ww, hh) / (
-                    self._area(w, h) + self._area(ww, hh) - self._area_overlap(x, y, w, h, xx, yy, ww, hh))
+        overlap = self._area_overlap(x, y, w, h, xx, yy, ww, hh)
+        union = self._area(w, h) + self._area(ww, hh) - overlap
+        if union <= 0:
+            return 0
+        return overlap / union
 
     def _area_overlap(self, x, y, w, h, xx, yy, ww, hh):
         dx = min(x + w, xx + ww) - max(x, xx)
@@ -882,8 +2228,1583 @@ class TestAiDriver():
         else:
             return False
 
+class AsyncTestAiDriver(TestAiDriver):
+    """
+        TestAiDriver making its server calls with aiohttp, so one event loop can drive many browser sessions and
+        overlap their waits on the server. The *_async methods are coroutines. Selenium only offers blocking WebDriver
+        commands, so those, like the screenshots and the element lookups, run in the loop's default executor.
+        The blocking methods of TestAiDriver keep working. Needs aiohttp: pip install test-ai-selenium[async]
+    """
+    def __init__(self, driver, api_key, **kwargs):
+        # Don't wait for the check in or the first screenshot in the constructor, which may be called on the loop
+        kwargs.setdefault('fast_start', True)
+        self._aiohttp_session = None
+        self._aiohttp_loop = None
+        # Training uploads started by the *_async finds, awaited by flush_async()
+        self._background_tasks = set()
+        # Bounds the training uploads running at once to upload_queue_size, created on the loop that uses it
+        self._upload_queue_size = kwargs.get('upload_queue_size', 100)
+        self._upload_slots = None
+        self._upload_slots_loop = None
+        super().__init__(driver, api_key, **kwargs)
+
+    def _checkin_in_background(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return super()._checkin_in_background()
+        self._start_task(self.checkin_async())
+
+    def _start_task(self, coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        # The loop only keeps weak references to tasks
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+        return task
+
+    async def _spawn(self, coroutine):
+        """
+            Runs coroutine as a background task once fewer than upload_queue_size of them are running, so a burst
+            of finds waits for the uploads to catch up like a full upload queue does in the blocking driver.
+        """
+        loop = asyncio.get_running_loop()
+        if self._upload_slots is None or self._upload_slots_loop is not loop:
+            self._upload_slots = asyncio.Semaphore(self._upload_queue_size)
+            self._upload_slots_loop = loop
+        slots = self._upload_slots
+        try:
+            await slots.acquire()
+        except BaseException:
+            coroutine.close()
+            raise
+        task = self._start_task(coroutine)
+        task.add_done_callback(lambda _: slots.release())
+        return task
+
+    async def _run_blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    async def _run_flow_async(self, flow):
+        """
+            Runs a flow like _run_flow, awaiting its steps: the ones with an *_async coroutine, like the server
+            calls, on the loop and the others in the executor, so the loop never waits on the browser or the disk.
+        """
+        result, error = None, None
+        while True:
+            try:
+                fn, args = flow.send(result) if error is None else flow.throw(error)
+            except StopIteration as e:
+                return e.value
+            fn_async = getattr(self, fn.__name__ + '_async', None)
+            try:
+                if fn_async is not None:
+                    result = await fn_async(*args)
+                else:
+                    result = await self._run_blocking(fn, *args)
+                error = None
+            except Exception as e:
+                result, error = None, e
+
+    async def _submit_async(self, fn, *args):
+        """
+            Runs fn in the background like _submit, as a task on the loop.
+        """
+        fn_async = getattr(self, fn.__name__ + '_async', None)
+        coroutine = fn_async(*args) if fn_async is not None else self._run_blocking(fn, *args)
+        if self.upload_worker is None:
+            await coroutine
+        else:
+            await self._spawn(coroutine)
+
+    def _async_session(self):
+        # aiohttp sessions belong to the loop they were created on
+        loop = asyncio.get_running_loop()
+        if self._aiohttp_session is None or self._aiohttp_session.closed or self._aiohttp_loop is not loop:
+            try:
+                import aiohttp
+            except ImportError:
+                raise ImportError('AsyncTestAiDriver needs aiohttp, install it with pip install test-ai-selenium[async]')
+            # Verify is False as the lets encrypt certificate raises issue on mac.
+            connector = aiohttp.TCPConnector(limit=10, ssl=False)
+            self._aiohttp_session = aiohttp.ClientSession(connector=connector)
+            self._aiohttp_loop = loop
+        return self._aiohttp_session
+
+    def _async_request(self, kwargs):
+        """
+            Turns the requests style json / data keyword arguments of _post into (body, headers) for aiohttp.
+        """
+        if isinstance(kwargs.get('data'), _RequestBody):
+            # aiohttp closes the body once it was sent, so every attempt gets its own
+            body = _RequestBody(kwargs['data'].parts, content_type=kwargs['data'].content_type)
+            return body, dict(kwargs.get('headers') or {}, **{'Content-Length': str(len(body))})
+        if 'json' in kwargs:
+            return json.dumps(kwargs['json']).encode('utf-8'), {'Content-Type': 'application/json'}
+        # Like requests, fields set to None are left out of forms
+        fields = [(k, v) for k, v in (kwargs.get('data') or {}).items() if v is not None]
+        return urllib.parse.urlencode(fields).encode('utf-8'), {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    def _async_timeout(self, timeout):
+        import aiohttp
+        if isinstance(timeout, tuple):
+            return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        return aiohttp.ClientTimeout(total=timeout)
+
+    async def _post_async(self, endpoint, replay_key=None, **kwargs):
+        """
+            _post over aiohttp: same timeouts, circuit breaker, replay bundle and instrumentation. Failed connects
+            and 502 / 503 / 504 responses are retried max_retries times with exponential backoff.
+        """
+        import aiohttp
+        if self.replay_bundle is not None and self.replay_bundle.mode == 'replay':
+            return self._replay(endpoint, replay_key)
+        if not self.circuit_breaker.allow():
+            raise ServerUnavailableException('test.ai server is unavailable after repeated failures, '
+                                             'skipping %s for up to %ds' % (endpoint, self.circuit_breaker.cooldown))
+        timeout = self._async_timeout(kwargs.pop('timeout', None) or self.server_timeouts.get(endpoint, self.server_timeouts['default']))
+        session = self._async_session()
+        with self.instrumentation.span('POST ' + endpoint, endpoint=endpoint) as attributes:
+            attempt = 0
+            try:
+                while True:
+                    # Streamed bodies can only be sent once, build the body for every attempt
+                    body, headers = self._async_request(kwargs)
+                    try:
+                        async with session.post(self.url + endpoint, data=body, headers=headers, timeout=timeout) as r:
+                            status_code, text = r.status, await r.text()
+                        if status_code not in (502, 503, 504) or attempt >= self._max_retries:
+                            break
+                    except Exception as e:
+                        # Like _post, only requests that never reached the server are sent again
+                        if attempt >= self._max_retries or not isinstance(e, aiohttp.ClientConnectorError):
+                            self.circuit_breaker.record_failure()
+                            self.instrumentation.incr('http.failures', endpoint=endpoint)
+                            raise
+                    await asyncio.sleep(self._retry_backoff * 2 ** attempt)
+                    attempt += 1
+            except asyncio.CancelledError:
+                # Cancelled before the server answered, e.g. by asyncio.wait_for, so this call can't settle the
+                # trial of a half open circuit
+                self.circuit_breaker.release_trial()
+                raise
+            attributes['status'] = status_code
+        size = len(body) if isinstance(body, (bytes, _RequestBody)) else body.size
+        if size:
+            self.instrumentation.incr('http.bytes_uploaded', size, endpoint=endpoint)
+        if status_code >= 500:
+            self.circuit_breaker.record_failure()
+            self.instrumentation.incr('http.failures', endpoint=endpoint)
+        else:
+            self.circuit_breaker.record_success()
+            if self.replay_bundle is not None and replay_key is not None:
+                self.replay_bundle.record(endpoint, replay_key, status_code, text)
+        return ServerResponse(status_code, text)
+
+    async def checkin_async(self):
+        """
+        Check in the current test.ai session.
+        """
+        try:
+            await self._post_async('/sdk_checkin', json=self._checkin_data())
+        except Exception:
+            pass
+
+    async def flush_async(self):
+        """
+            Waits until the training uploads of the *_async finds and the queued blocking ones have been sent.
+        """
+        while self._background_tasks:
+            await asyncio.gather(*list(self._background_tasks), return_exceptions=True)
+        await self._run_blocking(self.flush)
+
+    async def close_async(self):
+        await self.flush_async()
+        if self._aiohttp_session is not None:
+            await self._aiohttp_session.close()
+        await self._run_blocking(self.close)
+
+    async def quit_async(self):
+        await self.flush_async()
+        if self._aiohttp_session is not None:
+            await self._aiohttp_session.close()
+        await self._run_blocking(self.quit)
+
+    async def find_element_async(self, by='id', value=None, element_name=None):
+        """
+        Find an element given a By strategy and locator, falling back to the test.ai classifier like find_element.
+
+        :Usage:
+            ::
+
+                element = await driver.find_element_async(By.ID, 'foo', element_name='foo_button')
+        """
+        element_name = self._selector_element_name(by, value, element_name)
+        return await self._run_flow_async(self._find_element_flow(element_name,
+                                                                  lambda: self.driver.find_element(by=by, value=value)))
+
+    async def find_by_element_name_async(self, element_name):
+        """
+        Finds an element by element_name, like find_by_element_name.
+        """
+        element_name = element_name.replace(' ', '_')
+        el, key, msg = await self._classify_async(element_name)
+        if el is None:
+            print(msg)
+            raise Exception(msg)
+        return el
+
+    async def find_by_element_names_async(self, element_names):
+        """
+        Finds several elements by element_name from a single screenshot, like find_by_element_names.
+        """
+        element_names = [element_name.replace(' ', '_') for element_name in element_names]
+        if self.test_case_creation_mode:
+            return await self._run_blocking(self.find_by_element_names, element_names)
+        elements, key, msgs = await self._run_flow_async(self._classify_many_flow(element_names))
+        return self._found_elements(element_names, elements, msgs)
+
+    async def update_test_case_status_async(self, test_case_name, status, message='', extra_info={}):
+        data = {'api_key': self.api_key, 'test_case_status': status, 'message': message,
+                'test_case_uuid': test_case_name, 'extra_info': extra_info}
+        res = await self._post_async('/test_case/set_test_case_status', json=data)
+        if res.status_code != 200:
+            raise Exception('Failed to upload test case result')
+
+    async def _classify_async(self, element_name):
+        return await self._run_flow_async(self._classify_flow(element_name))
+
+    async def _train_async(self, screenshot, element_name, rect, viewport_rect=None, train_if_necessary=True,
+                           rects=None):
+        return await self._run_flow_async(self._train_flow(screenshot, element_name, rect, viewport_rect,
+                                                           train_if_necessary, rects))
+
+    async def _classify_box_async(self, screenshot, element_name, key=None, offset=None):
+        element_box = None
+        run_key = None
+        msg = ''
+        try:
+            data = {'source': '', 'api_key': self.api_key, 'label': element_name, 'run_id': self.run_id}
+            replay_key = self._add_region_fields(data, key, element_name, offset)
+            request, scale = await self._run_blocking(self._screenshot_request, screenshot, data, False,
+                                                      self.downscale_uploads)
+            r = await self._post_async('/classify', replay_key=replay_key, **request)
+            element_box, run_key, msg = self._classify_response(element_name, r.text, scale)
+        except Exception:
+            logging.exception('exception during classification')
+        return element_box, run_key, msg
+
+    async def _classify_screenshot_many_async(self, screenshot, element_names, key=None):
+        try:
+            data = {'source': '', 'api_key': self.api_key, 'labels': json.dumps(element_names), 'run_id': self.run_id}
+            request, scale = await self._run_blocking(self._screenshot_request, screenshot, data, False,
+                                                      self.downscale_uploads)
+            r = await self._post_async('/classify', replay_key=(key, element_names), **request)
+            response = json.loads(r.text)
+        except Exception:
+            logging.exception('exception during batched classification')
+            response = {}
+        if 'elems' in response:
+            return self._classify_many_response(element_names, response, r.text, scale)
+        # Server without batch support, classify the same screenshot for every label at once
+        boxes = {}
+        msgs = {}
+        results = await asyncio.gather(*[self._classify_box_async(screenshot, element_name, key)
+                                         for element_name in element_names])
+        for element_name, (box, _, msg) in zip(element_names, results):
+            if box is not None:
+                boxes[element_name] = box
+            else:
+                msgs[element_name] = msg
+        return boxes, msgs
+
+    async def _check_screenshot_exists_async(self, screenshot, key, element_name):
+        # The box cache may read or write its file, which is left to the executor
+        response = await self._run_blocking(self._cached_box_response, key, element_name)
+        if response is not None:
+            return response
+        server_key = await self._run_blocking(self._server_key, screenshot, key)
+        data = {'api_key': self.api_key, 'screenshot_uuid': server_key, 'label': element_name}
+        r = await self._post_async('/check_screenshot_exists', replay_key=(key, element_name), json=data)
+        return await self._run_blocking(self._box_response, key, element_name, r.status_code, r.text)
+
+    async def _check_screenshots_exist_async(self, screenshot, key, element_names):
+        boxes, remaining = await self._run_blocking(self._cached_boxes, key, element_names)
+        if not remaining:
+            return boxes
+        server_key = await self._run_blocking(self._server_key, screenshot, key)
+        data = {'api_key': self.api_key, 'screenshot_uuid': server_key, 'labels': remaining}
+        r = await self._post_async('/check_screenshot_exists', replay_key=(key, remaining), json=data)
+        response = r.json() if r.status_code == 200 else {}
+        if 'boxes' in response:
+            boxes.update(await self._run_blocking(self._store_boxes, key, remaining, response['boxes']))
+            return boxes
+        # Server without batch support, ask for every label at once
+        results = await asyncio.gather(*[self._check_screenshot_exists_async(screenshot, key, element_name)
+                                         for element_name in remaining])
+        for element_name, resp_data in zip(remaining, results):
+            if resp_data['success'] and 'box' in resp_data:
+                boxes[element_name] = resp_data['box']
+        return boxes
+
+    async def _upload_screenshot_async(self, key, screenshot, element_name):
+        try:
+            response = await self._check_screenshot_exists_async(screenshot, key, element_name)
+            if response['success'] == True:
+                if self.debug:
+                    print(f'Screenshot {key} already exists on remote')
+                return
+            if self.debug:
+                print(f'Screenshot {key} does not exist on remote, uploading it')
+            server_key = await self._run_blocking(self._server_key, screenshot, key)
+            data = {'api_key': self.api_key, 'screenshot_uuid': server_key, 'label': element_name,
+                    'test_case_uuid': self.test_case_uuid}
+            request, _ = await self._run_blocking(self._screenshot_request, screenshot, data, True)
+            r = await self._post_async('/upload_screenshot', **request)
+            if r.status_code != 200:
+                log.error('Error uploading screenshot to remote')
+        except Exception:
+            log.exception('Error checking cached screenshot / uploading it from remote')
+
+    async def _add_action_async(self, data):
+        try:
+            await self._post_async('/add_action', json=data)
+        except Exception:
+            pass
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Channels per pixel for each PNG color type
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+def _image_format(image):
+    """
+        png, jpeg or webp from the signature of the encoded image, None for anything else.
+    """
+    if image[:8] == PNG_SIGNATURE:
+        return 'png'
+    if image[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if image[:4] == b'RIFF' and image[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+class Screenshot():
+    """
+        A screenshot taken once and shared by hashing, caching and uploads instead of being copied between them.
+        The base64 text from the driver is decoded into a single buffer the first time the image is needed and not
+        kept after that. PIL opens the buffer without copying it and only decodes the pixels when they are used.
+        release() frees the buffer, the screenshot can't be used afterwards.
+    """
+    __slots__ = ('_base64', '_data', 'key', 'server_key')
+
+    def __init__(self, base64_data=None, data=None):
+        self._base64 = base64_data
+        self._data = data
+        # Key in the hash_mode and md5 key the server knows the screenshot by, worked out by TestAiDriver when needed
+        self.key = None
+        self.server_key = None
+
+    @property
+    def data(self):
+        """
+            The encoded image as bytes.
+        """
+        if self._data is None:
+            if self._base64 is None:
+                raise ValueError('The screenshot was released')
+            self._data = base64.b64decode(self._base64)
+            self._base64 = None
+        return self._data
+
+    @property
+    def base64(self):
+        if self._base64 is not None:
+            return self._base64
+        return base64.b64encode(self.data).decode('ascii')
+
+    def base64_length(self):
+        if self._base64 is not None:
+            return len(self._base64)
+        return (len(self.data) + 2) // 3 * 4
+
+    def iter_base64(self, chunk_size=3 * 16384):
+        """
+            Yields the base64 text of the image in ascii chunks of about chunk_size, without building all of it.
+        """
+        if self._base64 is not None:
+            text = self._base64
+            for start in range(0, len(text), chunk_size):
+                yield text[start:start + chunk_size].encode('ascii')
+            return
+        # Encoding chunks of a multiple of 3 bytes gives the same text as encoding everything at once
+        chunk_size -= chunk_size % 3
+        view = memoryview(self.data)
+        for start in range(0, len(view), chunk_size):
+            yield base64.b64encode(view[start:start + chunk_size])
+
+    @property
+    def format(self):
+        if self._data is None and self._base64 is not None:
+            # Enough base64 for the signatures, without decoding the rest
+            return _image_format(base64.b64decode(self._base64[:16]))
+        return _image_format(self.data)
+
+    @property
+    def size(self):
+        return _image_size(self.data)
+
+    def open(self):
+        """
+            PIL image of the screenshot, the pixels are decoded when first used.
+        """
+        from PIL import Image
+        # BytesIO shares the buffer of the bytes until it is written to
+        return Image.open(io.BytesIO(self.data))
+
+    def release(self):
+        self._base64 = None
+        self._data = None
+
+class _Base64Part():
+    """
+        The base64 text of a screenshot as a part of a _RequestBody, url quoted for form bodies.
+    """
+    def __init__(self, screenshot, quote=False):
+        self.screenshot = screenshot
+        self.quote = quote
+        self._length = None
+
+    def __len__(self):
+        if not self.quote:
+            return self.screenshot.base64_length()
+        if self._length is None:
+            # '+', '/' and '=' are quoted to three characters
+            self._length = sum(len(chunk) + 2 * (chunk.count(b'+') + chunk.count(b'/') + chunk.count(b'='))
+                               for chunk in self.screenshot.iter_base64())
+        return self._length
+
+    def chunks(self):
+        for chunk in self.screenshot.iter_base64():
+            if self.quote:
+                chunk = chunk.replace(b'+', b'%2B').replace(b'/', b'%2F').replace(b'=', b'%3D')
+            yield chunk
+
+class _RequestBody(io.RawIOBase):
+    """
+        File like request body read from its parts, bytes or _Base64Part, in small pieces so a screenshot is never
+        copied into one big body. requests and aiohttp send it with a Content-Length, and it can be rewound for retries.
+    """
+    def __init__(self, parts, content_type=None):
+        super().__init__()
+        self.parts = parts
+        self.content_type = content_type
+        self._length = sum(len(part) for part in parts)
+        self._rewind()
+
+    def _rewind(self):
+        self._chunks = self._iter_chunks()
+        self._pending = memoryview(b'')
+        self._position = 0
+
+    def _iter_chunks(self, chunk_size=65536):
+        for part in self.parts:
+            if isinstance(part, _Base64Part):
+                yield from part.chunks()
+                continue
+            view = memoryview(part)
+            for start in range(0, len(view), chunk_size):
+                yield view[start:start + chunk_size]
+
+    def __len__(self):
+        return self._length
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._length
+        if offset == 0:
+            self._rewind()
+        elif offset != self._position:
+            raise io.UnsupportedOperation('Request bodies can only be rewound')
+        return self._position
+
+    def readinto(self, buffer):
+        while not len(self._pending):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        n = min(len(buffer), len(self._pending))
+        buffer[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        self._position += n
+        return n
+
+def _multipart_body(files):
+    """
+        multipart/form-data _RequestBody of the (field name, file name, content type, bytes) files.
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, filename, content_type, content in files:
+        parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n'
+                      % (boundary, name, filename, content_type)).encode('utf-8'))
+        parts.append(content)
+        parts.append(b'\r\n')
+    parts.append(('--%s--\r\n' % boundary).encode('ascii'))
+    return _RequestBody(parts, content_type='multipart/form-data; boundary=%s' % boundary)
+
+def _image_size(image):
+    """
+        (width, height) of the encoded image, read from the PNG header when possible instead of opening it with PIL.
+    """
+    if image[:8] == PNG_SIGNATURE and image[12:16] == b'IHDR':
+        return struct.unpack('>II', image[16:24])
+    from PIL import Image
+    # PIL only reads the header here, the pixels are not decoded
+    return Image.open(io.BytesIO(image)).size
+
+def _png_crop_fingerprint(png, left, top, right, bottom, chunk_size=65536):
+    """
+        Fingerprint of the pixels of a PNG left after trimming the given margins, for keys that stay on this machine.
+        The image data is only inflated, a band of rows at a time so the raster is never held in memory, and every
+        row of the crop is checksummed with crc32 the way the encoder filtered it. A filtered row depends on the
+        pixels of the row, the row above and the pixels to its left, so leaving out the first row of the crop
+        leaves a fingerprint of the crop and of the encoder only. Unfiltering the rows would cost more than a decode.
+        Returns None for images this does not handle (not a PNG, interlaced or not 8 bits per sample).
+    """
+    if png[:8] != PNG_SIGNATURE or png[12:16] != b'IHDR':
+        return None
+    width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', png[16:29])
+    channels = PNG_CHANNELS.get(color_type)
+    if channels is None or bit_depth != 8 or interlace:
+        return None
+    # The first row is only filtered against zeros when there is no margin above it
+    first_row, last_row = top + 1 if top else 0, height - bottom
+    if last_row <= first_row or width - right <= left:
+        return None
+    stride = 1 + width * channels
+    # The filter type byte of every row is checksummed too
+    col_start, col_end = left * channels, 1 + (width - right) * channels
+    checksums = array('I')
+    inflater = zlib.decompressobj()
+    data = memoryview(png)
+    pending = b''
+    row = 0
+    pos = 8
+    while pos + 8 <= len(data) and row < last_row:
+        length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+        if chunk_type == b'IDAT':
+            for start in range(pos + 8, pos + 8 + length, chunk_size):
+                compressed = data[start:min(start + chunk_size, pos + 8 + length)]
+                while compressed and row < last_row:
+                    buf = pending + inflater.decompress(compressed, stride * 64)
+                    compressed = inflater.unconsumed_tail
+                    count = min(len(buf) // stride, last_row - row)
+                    band = memoryview(buf)
+                    for i in range(max(first_row - row, 0), count):
+                        checksums.append(zlib.crc32(band[i * stride + col_start:i * stride + col_end]))
+                    row += count
+                    pending = buf[count * stride:]
+                if row >= last_row:
+                    break
+        elif chunk_type == b'IEND':
+            break
+        pos += 12 + length
+    if row < last_row:
+        return None
+    digest = hashlib.blake2b(struct.pack('>III', width - right - left, last_row - first_row, color_type),
+                             digest_size=16)
+    digest.update(checksums.tobytes())
+    return digest.hexdigest()
+
+def _ncc_peak(region, template):
+    """
+        Best match of template in region, both 2d numpy arrays, by normalized cross correlation.
+        The correlation is computed with FFTs and the window statistics with summed area tables, so the cost does
+        not grow with the template size. Returns (row, column, score) of the top left corner, score is in [-1, 1].
+    """
+    numpy = _numpy()
+    region = region.astype(numpy.float64)
+    template = template.astype(numpy.float64)
+    th, tw = template.shape
+    rh, rw = region.shape
+    t = template - template.mean()
+    t_norm = numpy.sqrt((t * t).sum())
+    if t_norm == 0:
+        return 0, 0, 0.0
+    shape = (rh + th - 1, rw + tw - 1)
+    # Correlating with a zero mean template gives sum((window - window mean) * t) at every position
+    corr = numpy.fft.irfft2(numpy.fft.rfft2(region, shape) * numpy.fft.rfft2(t[::-1, ::-1], shape), shape)
+    corr = corr[th - 1:rh, tw - 1:rw]
+    sums = numpy.zeros((rh + 1, rw + 1))
+    sums[1:, 1:] = region.cumsum(0).cumsum(1)
+    squares = numpy.zeros((rh + 1, rw + 1))
+    squares[1:, 1:] = (region * region).cumsum(0).cumsum(1)
+    window_sum = sums[th:, tw:] - sums[:-th, tw:] - sums[th:, :-tw] + sums[:-th, :-tw]
+    window_squares = squares[th:, tw:] - squares[:-th, tw:] - squares[th:, :-tw] + squares[:-th, :-tw]
+    variance = numpy.maximum(window_squares - window_sum * window_sum / (th * tw), 0)
+    # Nearly flat windows, less than a gray level of deviation, never match
+    scores = numpy.where(variance > th * tw, corr / (numpy.sqrt(numpy.maximum(variance, 1)) * t_norm), 0)
+    row, column = numpy.unravel_index(numpy.argmax(scores), scores.shape)
+    return int(row), int(column), float(scores[row, column])
+
+class LayoutSnapshot():
+    """
+        Viewport rects of every element of a page at one page version, stored in flat arrays (numpy ones when it is
+        installed) with a grid index, so several bounding boxes can be scored without going back to the browser.
+    """
+    def __init__(self, rects, tag_names, page_version=None, token=None, cell_size=128, max_cells=256):
+        self.page_version = page_version
+        self.token = token
+        self.tag_names = tag_names
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+        numpy = _numpy()
+        if numpy is not None:
+            rects = numpy.asarray(rects, dtype=numpy.float64).reshape(-1, 4)
+            self.x, self.y = rects[:, 0].copy(), rects[:, 1].copy()
+            self.width, self.height = rects[:, 2].copy(), rects[:, 3].copy()
+        else:
+            self.x, self.y = array('d', rects[0::4]), array('d', rects[1::4])
+            self.width, self.height = array('d', rects[2::4]), array('d', rects[3::4])
+        self._grid = None
+        self._large = None
+
+    def __len__(self):
+        return len(self.tag_names)
+
+    def _build_grid(self):
+        grid = {}
+        large = array('l')
+        size = self.cell_size
+        for i in range(len(self)):
+            x, y, w, h = float(self.x[i]), float(self.y[i]), float(self.width[i]), float(self.height[i])
+            if w <= 0 or h <= 0:
+                continue
+            x0, x1 = int(x // size), int((x + w) // size)
+            y0, y1 = int(y // size), int((y + h) // size)
+            # Elements like html / body cover most of the page, keep those out of the cells
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > self.max_cells:
+                large.append(i)
+                continue
+            for cx in range(x0, x1 + 1):
+                for cy in range(y0, y1 + 1):
+                    cell = grid.get((cx, cy))
+                    if cell is None:
+                        cell = grid[(cx, cy)] = array('l')
+                    cell.append(i)
+        self._grid = grid
+        self._large = large
+
+    def _cell_candidates(self, px, py):
+        if self._grid is None:
+            self._build_grid()
+        cell = self._grid.get((int(px // self.cell_size), int(py // self.cell_size)), ())
+        # Document order, so ties in score are broken the same way as when scanning every element
+        return sorted(list(cell) + list(self._large))
+
+    def elements_at(self, px, py):
+        """
+            Indices of the elements whose rect strictly contains the point.
+        """
+        indices = self._cell_candidates(px, py)
+        numpy = _numpy()
+        if numpy is not None:
+            indices = numpy.asarray(indices, dtype=numpy.int64)
+            x, y, w, h = self.x[indices], self.y[indices], self.width[indices], self.height[indices]
+            hit = (px > x) & (px < x + w) & (py > y) & (py < y + h)
+            return indices[hit].tolist()
+        return [i for i in indices if self.x[i] < px < self.x[i] + self.width[i] and
+                self.y[i] < py < self.y[i] + self.height[i]]
+
+    def score(self, box):
+        """
+            [(index, IOU)] of the elements with a positive IOU with box whose rect contains its center, best first.
+        """
+        bx, by, bw, bh = box['x'], box['y'], box['width'], box['height']
+        indices = self.elements_at(bx + bw / 2, by + bh / 2)
+        if not indices:
+            return []
+        numpy = _numpy()
+        if numpy is not None:
+            indices = numpy.asarray(indices, dtype=numpy.int64)
+            x, y, w, h = self.x[indices], self.y[indices], self.width[indices], self.height[indices]
+            dx = numpy.minimum(bx + bw, x + w) - numpy.maximum(bx, x)
+            dy = numpy.minimum(by + bh, y + h) - numpy.maximum(by, y)
+            overlap = numpy.where((dx >= 0) & (dy >= 0), dx * dy, 0.0)
+            union = bw * bh + w * h - overlap
+            scores = numpy.divide(overlap, union, out=numpy.zeros_like(overlap), where=union > 0)
+            # Stable sort keeps document order between equal scores
+            order = numpy.argsort(-scores, kind='stable')
+            return [(int(indices[i]), float(scores[i])) for i in order if scores[i] > 0]
+        scored = []
+        for i in indices:
+            x, y, w, h = self.x[i], self.y[i], self.width[i], self.height[i]
+            dx = min(bx + bw, x + w) - max(bx, x)
+            dy = min(by + bh, y + h) - max(by, y)
+            overlap = dx * dy if dx >= 0 and dy >= 0 else 0
+            union = bw * bh + w * h - overlap
+            if union > 0 and overlap > 0:
+                scored.append((i, overlap / union))
+        return sorted(scored, key=lambda x: x[1], reverse=True)
+
+class CircuitBreaker():
+    """
+        Stops calls to the server for `cooldown` seconds after `failure_threshold` consecutive failures.
+        Once the cooldown is over a single trial call is let through, its outcome closes or re-opens the circuit.
+    """
+    def __init__(self, failure_threshold=5, cooldown=30):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.time() - self._opened_at < self.cooldown or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    log.error('test.ai server failed %d times in a row, pausing calls for %ds' % (self._failures, self.cooldown))
+                self._opened_at = time.time()
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """
+            Lets another trial call through when a call ended without an outcome, e.g. it was cancelled.
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+class UploadWorker():
+    """
+        Sends training / telemetry requests from a background thread.
+        The queue is bounded, when it is full submit() blocks until the worker catches up.
+        The thread is started by the first submit() and ended by stop().
+    """
+    def __init__(self, max_queue_size=100, batch_size=10, exit_timeout=30):
+        self.batch_size = batch_size
+        self.exit_timeout = exit_timeout
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='testai-upload-worker', daemon=True)
+                self._thread.start()
+                atexit.register(self._flush_at_exit)
+        self._queue.put((fn, args, kwargs))
+
+    def stop(self, timeout=None):
+        """
+            Sends what is queued and ends the thread, a later submit() starts a new one.
+            Returns False if the thread was still running after timeout.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return True
+            atexit.unregister(self._flush_at_exit)
+        # None tells the thread to end once everything queued before it was sent
+        self._queue.put(None)
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def _run(self):
+        while True:
+            # Drain whatever is queued so a burst of finds is sent back to back on a warm connection
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for job in batch:
+                try:
+                    if job is None:
+                        return
+                    fn, args, kwargs = job
+                    fn(*args, **kwargs)
+                except Exception:
+                    log.exception('Error in background upload')
+                finally:
+                    self._queue.task_done()
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def flush(self, timeout=None):
+        """
+            Waits until every submitted job has run. Returns False if the timeout expired first.
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                if end is None:
+                    self._queue.all_tasks_done.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _flush_at_exit(self):
+        if not self.flush(timeout=self.exit_timeout):
+            log.error('Timed out sending %d queued test.ai uploads at exit' % self.pending())
+
+class BoxCache():
+    """
+        LRU cache of /check_screenshot_exists responses keyed by screenshot hash and label.
+        Entries expire after `ttl` seconds and are persisted to `path` so they survive between runs.
+        Saving merges with what other processes wrote to the file meanwhile, under a file lock. With `shared` the
+        file is re-read on a miss when it changed and written at most every `sync_interval` seconds after a put,
+        so the processes on a host see each other's boxes during the run.
+    """
+    def __init__(self, path=None, max_entries=10000, ttl=86400, shared=False, sync_interval=1.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self.sync_interval = sync_interval
+        self._entries = collections.OrderedDict()
+        self._dirty = False
+        # Set by clear() so the next save replaces the file instead of merging with it
+        self._replace = False
+        self._mtime = None
+        self._synced_at = 0
+        # Entries are added from the upload worker thread as well as the test thread
+        self._lock = threading.RLock()
+        # The file is read on first use rather than when the driver is created
+        self._loaded = False
+        atexit.register(self.save)
+
+    def _cache_key(self, key, label):
+        return '%s/%s' % (key, label)
+
+    def get(self, key, label):
+        cache_key = self._cache_key(key, label)
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._entries.get(cache_key)
+            if entry is None and self.shared and self._file_changed():
+                self.load()
+                entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            created, response = entry
+            if self.ttl is not None and time.time() - created > self.ttl:
+                del self._entries[cache_key]
+                self._dirty = True
+                return None
+            self._entries.move_to_end(cache_key)
+            return dict(response)
+
+    def put(self, key, label, response):
+        cache_key = self._cache_key(key, label)
+        with self._lock:
+            self._ensure_loaded()
+            self._entries[cache_key] = (time.time(), dict(response))
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+        if self.shared and time.time() - self._synced_at >= self.sync_interval:
+            self.save()
+
+    def clear(self):
+        with self._lock:
+            self._loaded = True
+            self._entries.clear()
+            self._dirty = True
+            self._replace = True
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._entries)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def _file_changed(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self._mtime
+        except (OSError, TypeError):
+            return False
+
+    def _read(self):
+        """
+            Returns the entries in the file, oldest first, and its modification time.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return [], None
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, 'r') as f:
+                return json.load(f), mtime
+        except Exception:
+            log.exception('Could not read box cache %s, ignoring it' % self.path)
+            return [], None
+
+    def _merge(self, entries):
+        """
+            Adds the entries read from the file to the cache. Keys only in the file go in as least recently used,
+            keys in both keep the newer response.
+        """
+        now = time.time()
+        merged = collections.OrderedDict()
+        newer = {}
+        for cache_key, (created, response) in entries:
+            if self.ttl is not None and now - created > self.ttl:
+                continue
+            current = self._entries.get(cache_key)
+            if current is None:
+                merged[cache_key] = (created, response)
+            elif current[0] < created:
+                newer[cache_key] = (created, response)
+        for cache_key, entry in self._entries.items():
+            merged[cache_key] = newer.get(cache_key, entry)
+        while len(merged) > self.max_entries:
+            merged.popitem(last=False)
+        self._entries = merged
+
+    def load(self):
+        self._loaded = True
+        entries, mtime = self._read()
+        with self._lock:
+            # Entries are stored oldest first so the LRU order survives a round trip
+            self._merge(entries)
+            self._mtime = mtime
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        try:
+            with _file_lock(self.path):
+                with self._lock:
+                    if not self._replace:
+                        # Keep what other processes saved since we last read the file
+                        self._merge(self._read()[0])
+                    entries = [[k, list(v)] for k, v in self._entries.items()]
+                    self._dirty = False
+                    self._replace = False
+                tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    json.dump(entries, f)
+                # Atomic so a concurrent reader never sees a half written file
+                os.replace(tmp_path, self.path)
+                self._mtime = os.stat(self.path).st_mtime_ns
+                self._synced_at = time.time()
+        except Exception:
+            self._dirty = True
+            log.exception('Could not write box cache %s' % self.path)
+
+class SelectorStats():
+    """
+        Consecutive failures of the selector of each element per test case, kept in a BoxCache so they carry over
+        between runs. A selector that failed `failure_threshold` times in a row is considered broken and only probed,
+        except once every `retry_interval` seconds when it gets the full implicit wait again. Failed probes are not
+        written, so a broken selector that is never checked with the full wait expires with the cache's ttl.
+    """
+    def __init__(self, cache, failure_threshold=2, retry_interval=3600):
+        self.cache = cache
+        self.failure_threshold = failure_threshold
+        self.retry_interval = retry_interval
+        # Selectors that keep working are not in the cache, remember the misses so they don't look it up every find
+        self._healthy = set()
+
+    def _entry(self, test_case, element_name):
+        if (test_case, element_name) in self._healthy:
+            return None
+        entry = self.cache.get(test_case, element_name)
+        if not entry or not entry['failures']:
+            self._healthy.add((test_case, element_name))
+        return entry
+
+    def failures(self, test_case, element_name):
+        entry = self._entry(test_case, element_name)
+        return entry['failures'] if entry else 0
+
+    def is_broken(self, test_case, element_name):
+        return self.failures(test_case, element_name) >= self.failure_threshold
+
+    def should_probe(self, test_case, element_name):
+        """
+            Whether the selector is broken and not due for a retry with the full implicit wait.
+        """
+        entry = self._entry(test_case, element_name)
+        if not entry or entry['failures'] < self.failure_threshold:
+            return False
+        return time.time() - entry.get('checked_at', 0) < self.retry_interval
+
+    def record(self, test_case, element_name, found, probed=False):
+        if found:
+            # Selectors that keep working are only written when they recover
+            if self.failures(test_case, element_name):
+                self.cache.put(test_case, element_name, {'failures': 0})
+            self._healthy.add((test_case, element_name))
+            return
+        self._healthy.discard((test_case, element_name))
+        if probed:
+            return
+        entry = self.cache.get(test_case, element_name)
+        failures = min((entry['failures'] if entry else 0) + 1, self.failure_threshold)
+        self.cache.put(test_case, element_name, {'failures': failures, 'checked_at': time.time()})
+
+class TrainingLog():
+    """
+        Digests of the training examples sent with /add_action and the number sent per label each day, kept in a
+        BoxCache so they carry over between runs. An example already sent for the same screenshot, label and boxes is
+        not sent again. With `max_per_label_per_day` at most that many examples are sent per label each day, and only
+        `sample_rate` of the rest are sent.
+    """
+    def __init__(self, cache, dedupe=True, max_per_label_per_day=None, sample_rate=1.0):
+        self.cache = cache
+        self.dedupe = dedupe
+        self.max_per_label_per_day = max_per_label_per_day
+        self.sample_rate = sample_rate
+        self._lock = threading.Lock()
+
+    def _digest(self, data):
+        boxes = data.get('boxes') or [data]
+        example = [data['key'], data['label'], data['test_case_uuid'],
+                   [[round(box[k]) for k in ('x', 'y', 'width', 'height')] for box in boxes]]
+        return hashlib.md5(json.dumps(example).encode('utf-8')).hexdigest()
+
+    def _today(self):
+        return time.strftime('%Y-%m-%d', time.gmtime())
+
+    def _sent_today(self, label):
+        entry = self.cache.get('daily', label)
+        return entry['count'] if entry and entry['day'] == self._today() else 0
+
+    def quota_left(self, label):
+        return self.max_per_label_per_day is None or self._sent_today(label) < self.max_per_label_per_day
+
+    def skip_reason(self, data):
+        """
+            Returns why the example in the /add_action data should not be sent, or None after recording it as sent.
+        """
+        with self._lock:
+            digest = self._digest(data) if self.dedupe else None
+            if digest is not None and self.cache.get('sent', digest) is not None:
+                return 'duplicate'
+            if not self.quota_left(data['label']):
+                return 'rate_limited'
+            if self.sample_rate < 1 and random.random() >= self.sample_rate:
+                return 'sampled_out'
+            if digest is not None:
+                self.cache.put('sent', digest, {})
+            if self.max_per_label_per_day is not None:
+                self.cache.put('daily', data['label'], {'day': self._today(),
+                                                        'count': self._sent_today(data['label']) + 1})
+            return None
+
+class TemplateStore():
+    """
+        Grayscale crops of labeled elements at LOCAL_MATCH_SCALE times their CSS pixel size, taken from screenshots
+        where their selector worked, with the CSS pixel box in the viewport they were taken at. The most recently used `max_templates`
+        labels are kept and persisted to `path` with numpy, sharing it between processes like BoxCache does.
+    """
+    def __init__(self, path=None, max_templates=1000, shared=False, sync_interval=1.0):
+        self.path = path
+        self.max_templates = max_templates
+        self.shared = shared
+        self.sync_interval = sync_interval
+        # label -> (template, box, screenshot key)
+        self._templates = collections.OrderedDict()
+        self._dirty = False
+        self._mtime = None
+        self._synced_at = 0
+        # Templates are learned on the upload worker thread and read on the test thread
+        self._lock = threading.RLock()
+        self._loaded = False
+        atexit.register(self.save)
+
+    def get(self, label):
+        with self._lock:
+            self._ensure_loaded()
+            entry = self._templates.get(label)
+            if entry is None and self.shared and self._file_changed():
+                self.load()
+                entry = self._templates.get(label)
+            if entry is not None:
+                self._templates.move_to_end(label)
+            return entry
+
+    def put(self, label, template, box, key=None):
+        with self._lock:
+            self._ensure_loaded()
+            self._templates[label] = (template, dict(box), key)
+            self._templates.move_to_end(label)
+            while len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+            self._dirty = True
+        if self.shared and time.time() - self._synced_at >= self.sync_interval:
+            self.save()
+
+    def __len__(self):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._templates)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def _file_changed(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self._mtime
+        except (OSError, TypeError):
+            return False
+
+    def _read(self):
+        """
+            Returns the (label, template, box, key) in the file, least recently used first, and its modification time.
+        """
+        numpy = _numpy()
+        if self.path is None or numpy is None or not os.path.exists(self.path):
+            return [], None
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with numpy.load(self.path, allow_pickle=False) as data:
+                index = json.loads(str(data['index']))
+                return [(label, data['template_%d' % i], box, key) for i, (label, box, key) in enumerate(index)], mtime
+        except Exception:
+            log.exception('Could not read templates %s, ignoring them' % self.path)
+            return [], None
+
+    def _merge(self, templates):
+        # Labels only in the file go in as least recently used, for the others ours are at least as recent
+        merged = collections.OrderedDict((label, (template, box, key)) for label, template, box, key in templates
+                                         if label not in self._templates)
+        merged.update(self._templates)
+        while len(merged) > self.max_templates:
+            merged.popitem(last=False)
+        self._templates = merged
+
+    def load(self):
+        self._loaded = True
+        templates, mtime = self._read()
+        with self._lock:
+            self._merge(templates)
+            self._mtime = mtime
+
+    def save(self):
+        numpy = _numpy()
+        if self.path is None or numpy is None or not self._dirty:
+            return
+        try:
+            with _file_lock(self.path):
+                with self._lock:
+                    self._merge(self._read()[0])
+                    entries = list(self._templates.items())
+                    self._dirty = False
+                index = [[label, box, key] for label, (template, box, key) in entries]
+                arrays = {'template_%d' % i: template for i, (label, (template, box, key)) in enumerate(entries)}
+                tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    numpy.savez_compressed(f, index=numpy.array(json.dumps(index)), **arrays)
+                os.replace(tmp_path, self.path)
+                self._mtime = os.stat(self.path).st_mtime_ns
+                self._synced_at = time.time()
+        except Exception:
+            self._dirty = True
+            log.exception('Could not write templates %s' % self.path)
+
+class Instrumentation():
+    """
+        Collects timing spans and counters of what the SDK does and forwards them to listeners.
+
+        A listener is either an object with on_span(name, seconds, attributes) and / or
+        on_counter(name, value, attributes) methods, e.g. an adapter to a metrics exporter, or a callable that is
+        called as listener(kind, name, value, attributes) with kind 'span' or 'counter'.
+        Totals are kept as well and returned by snapshot().
+    """
+    def __init__(self, listeners=None):
+        self._listeners = list(listeners or [])
+        self._counters = collections.Counter()
+        # name -> [count, total seconds, max seconds]
+        self._spans = {}
+        # Spans and counters are recorded from the upload worker thread as well as the test thread
+        self._lock = threading.Lock()
+
+    def add_listener(self, listener):
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        with self._lock:
+            self._listeners = [l for l in self._listeners if l is not listener]
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """
+            Times the with block. The attributes dict is yielded so the block can add to it, e.g. a status code.
+        """
+        start = time.perf_counter()
+        try:
+            yield attributes
+        except BaseException as e:
+            attributes.setdefault('error', type(e).__name__)
+            raise
+        finally:
+            self.record_span(name, time.perf_counter() - start, **attributes)
+
+    def record_span(self, name, seconds, **attributes):
+        with self._lock:
+            totals = self._spans.get(name)
+            if totals is None:
+                totals = self._spans[name] = [0, 0.0, 0.0]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            listeners = self._listeners
+        for listener in listeners:
+            self._notify(listener, 'span', name, seconds, attributes)
+
+    def incr(self, name, value=1, **attributes):
+        with self._lock:
+            self._counters[name] += value
+            listeners = self._listeners
+        for listener in listeners:
+            self._notify(listener, 'counter', name, value, attributes)
+
+    def _notify(self, listener, kind, name, value, attributes):
+        # A broken listener must never fail the test it is measuring
+        try:
+            if hasattr(listener, 'on_span') or hasattr(listener, 'on_counter'):
+                method = getattr(listener, 'on_' + kind, None)
+                if method is not None:
+                    method(name, value, attributes)
+            else:
+                listener(kind, name, value, attributes)
+        except Exception:
+            log.exception('Error in instrumentation listener %r' % (listener,))
+
+    def snapshot(self):
+        """
+            Returns {'counters': {name: total}, 'spans': {name: {'count', 'total', 'max'}}} since the last reset.
+        """
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'spans': {name: {'count': count, 'total': total, 'max': maximum}
+                          for name, (count, total, maximum) in self._spans.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._spans.clear()
+
+def _print_span(kind, name, value, attributes):
+    """
+        Instrumentation listener printing the timings, used when debug is on.
+    """
+    if kind == 'span':
+        details = ' '.join('%s=%s' % (k, v) for k, v in attributes.items())
+        print(f'{name} time: {value:.3f}s {details}'.rstrip())
+
+class ReplayBundle():
+    """
+        Server responses keyed by endpoint, screenshot hash and label, stored as gzipped JSON at `path`.
+        In 'record' mode responses are added to the bundle and written on save(), or at exit.
+        In 'replay' mode they are served from it.
+    """
+    def __init__(self, path, mode='replay'):
+        self.path = path
+        self.mode = mode
+        # endpoint -> {'<screenshot hash>/<labels>': [status code, response text]}
+        self._responses = {}
+        self._dirty = False
+        # Responses are recorded from the upload worker thread as well as the test thread
+        self._lock = threading.Lock()
+        if mode == 'replay' and not os.path.exists(path):
+            raise ValueError('Replay bundle %s does not exist, record it first with replay_mode=\'record\'' % path)
+        # Re-recording updates the existing bundle, so several tests can share one
+        self.load()
+        if mode == 'record':
+            atexit.register(self.save)
+
+    def _key(self, replay_key):
+        key, labels = replay_key
+        if not isinstance(labels, str):
+            labels = ','.join(labels)
+        return '%s/%s' % (key, labels)
+
+    def record(self, endpoint, replay_key, status_code, text):
+        if self.mode != 'record':
+            return
+        with self._lock:
+            self._responses.setdefault(endpoint, {})[self._key(replay_key)] = [status_code, text]
+            self._dirty = True
+
+    def response(self, endpoint, replay_key):
+        entry = self._responses.get(endpoint, {}).get(self._key(replay_key))
+        if entry is None:
+            return None
+        return ServerResponse(entry[0], entry[1])
+
+    def __len__(self):
+        return sum(len(responses) for responses in self._responses.values())
+
+    def load(self):
+        """
+            Adds the responses in the file that are not in the bundle yet.
+        """
+        if not os.path.exists(self.path):
+            return
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            bundle = json.load(f)
+        with self._lock:
+            for endpoint, responses in bundle['responses'].items():
+                recorded = self._responses.setdefault(endpoint, {})
+                for key, response in responses.items():
+                    recorded.setdefault(key, response)
+
+    def save(self):
+        if not self._dirty:
+            return
+        try:
+            # Other processes may be recording into the same bundle
+            with _file_lock(self.path):
+                self.load()
+                with self._lock:
+                    bundle = {'version': 1, 'responses': {endpoint: dict(responses) for endpoint, responses in self._responses.items()}}
+                    self._dirty = False
+                tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+                with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                    json.dump(bundle, f, separators=(',', ':'))
+                os.replace(tmp_path, self.path)
+        except Exception:
+            self._dirty = True
+            log.exception('Could not write replay bundle %s' % self.path)
+
+class ServerResponse():
+    """
+        Stands in for the requests.Response of a server call served from a ReplayBundle or made with aiohttp.
+    """
+    request = None
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+class InputQueue():
+    """
+        Pointer and key events of testai_elems, sent to the browser in as few WebDriver commands as possible.
+
+        With the 'actions' transport everything queued goes out as one W3C Actions command. 'cdp' dispatches clicks
+        with Input.dispatchMouseEvent and the keys still go as Actions. insert_text types text with Input.insertText
+        instead, which is faster but sends no key events, so only keys like Keys.ENTER are still typed as Actions.
+        Events are sent by perform(), or once the outermost batch() block ends so a whole form goes in one command.
+        With wait_for_frame a flush returns once the browser painted the next frame instead of after a fixed sleep.
+        Drivers that don't speak W3C get the keys through ActionChains and the clicks as before, one by one.
+    """
+    def __init__(self, driver, transport='actions', wait_for_frame=False, instrumentation=None, insert_text=False):
+        self.driver = driver
+        self.transport = transport
+        self.wait_for_frame = wait_for_frame
+        self.insert_text = insert_text
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        # ('actions', pointer actions, key actions) or ('cdp', method, params), in the order they are sent
+        self._commands = []
+        self._depth = 0
+        # Viewport point of the last click queued in the current batch, while only text was typed after it
+        self._focus = None
+
+    def click(self, x, y):
+        x, y = int(x), int(y)
+        if self.transport == 'cdp':
+            # Both events in a row, the browser doesn't need a pause between them
+            for event_type in ('mousePressed', 'mouseReleased'):
+                self._commands.append(('cdp', 'Input.dispatchMouseEvent', {'type': event_type, 'button': 'left',
+                                                                           'clickCount': 1, 'x': x, 'y': y}))
+        else:
+            _, pointer, keys = self._actions()
+            pointer.extend([{'type': 'pointerMove', 'duration': 0, 'x': x, 'y': y, 'origin': 'viewport'},
+                            {'type': 'pointerDown', 'button': 0}, {'type': 'pointerUp', 'button': 0}])
+            keys.extend([{'type': 'pause', 'duration': 0}] * 3)
+        self._focus = (x, y)
+        return self
+
+    def focus(self, x, y):
+        """
+            Clicks x, y unless the last click of the batch went there and only text was typed since, so the element
+            still has the focus. A second click would make it a double click that selects a word of the text.
+            Outside of a batch the events are sent right away and anything may move the focus afterwards, like a
+            click on a WebElement or a script, so it always clicks.
+        """
+        if self._focus != (int(x), int(y)):
+            self.click(x, y)
+        return self
+
+    def reset_focus(self):
+        """
+            Forgets the last click, for when the focus may have moved by other means.
+        """
+        self._focus = None
+
+    def send_keys(self, value):
+        from selenium.webdriver.common.utils import keys_to_typing
+        text = ''.join(keys_to_typing(value if isinstance(value, (list, tuple)) else [value]))
+        run = ''
+        for char in text:
+            # Keys like Keys.ENTER are in the unicode private use area
+            special = '\ue000' <= char <= '\uf8ff'
+            if self.insert_text and not special:
+                run += char
+                continue
+            if run:
+                self._commands.append(('cdp', 'Input.insertText', {'text': run}))
+                run = ''
+            _, pointer, keys = self._actions()
+            keys.extend([{'type': 'keyDown', 'value': char}, {'type': 'keyUp', 'value': char}])
+            pointer.extend([{'type': 'pause', 'duration': 0}] * 2)
+            if special:
+                # Tab, Enter and the like can move the focus
+                self._focus = None
+        if run:
+            self._commands.append(('cdp', 'Input.insertText', {'text': run}))
+        return self
+
+    def _actions(self):
+        # Continues the Actions command at the end of the queue, or starts one
+        if not self._commands or self._commands[-1][0] != 'actions':
+            self._commands.append(('actions', [], []))
+        return self._commands[-1]
+
+    def perform(self):
+        """
+            Sends the queued events, unless in a batch() block.
+        """
+        if not self._depth:
+            self.flush()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+            Holds the events queued in the with block back until it ends. They are dropped when it raises.
+        """
+        self._depth += 1
+        try:
+            yield self
+        except BaseException:
+            self._commands = []
+            self._focus = None
+            raise
+        finally:
+            self._depth -= 1
+        if not self._depth:
+            self.flush()
+
+    def flush(self):
+        commands, self._commands = self._commands, []
+        # Once the events are sent, WebDriver commands that don't go through the queue may move the focus
+        self._focus = None
+        if not commands:
+            return
+        # Selenium 3 drivers may still talk the JSON wire protocol, which has no Actions command
+        w3c = getattr(self.driver, 'w3c', not old_selenium)
+        with self.instrumentation.span('input', transport=self.transport, commands=len(commands)):
+            for command in commands:
+                if command[0] == 'actions' and not w3c:
+                    self._perform_legacy(command[1], command[2])
+                elif command[0] == 'actions':
+                    sources = [{'type': 'pointer', 'id': 'testai-mouse', 'parameters': {'pointerType': 'mouse'},
+                                'actions': command[1]},
+                               {'type': 'key', 'id': 'testai-keyboard', 'actions': command[2]}]
+                    # A source that only pauses is left out
+                    sources = [s for s in sources if any(a['type'] != 'pause' for a in s['actions'])]
+                    self.instrumentation.incr('webdriver.round_trips', command='actions')
+                    self.driver.execute(Command.W3C_ACTIONS, {'actions': sources})
+                else:
+                    self.instrumentation.incr('webdriver.round_trips', command='execute_cdp_cmd')
+                    self.driver.execute_cdp_cmd(command[1], command[2])
+            if self.wait_for_frame:
+                self.instrumentation.incr('webdriver.round_trips', command='execute_async_script')
+                self.driver.execute_async_script(NEXT_FRAME_SCRIPT)
+
+    def _perform_legacy(self, pointer, keys):
+        """
+            Sends a queued Actions command to a driver without W3C Actions: the keys typed between two clicks with
+            ActionChains and every click with Input.dispatchMouseEvent, or a script on drivers without CDP.
+        """
+        text = ''
+        x = y = None
+        for pointer_action, key_action in zip(pointer, keys):
+            if key_action['type'] == 'keyDown':
+                text += key_action['value']
+            if pointer_action['type'] == 'pointerMove':
+                x, y = pointer_action['x'], pointer_action['y']
+            elif pointer_action['type'] == 'pointerUp':
+                if text:
+                    self._send_legacy_keys(text)
+                    text = ''
+                self._click_legacy(x, y)
+        if text:
+            self._send_legacy_keys(text)
+
+    def _send_legacy_keys(self, text):
+        self.instrumentation.incr('webdriver.round_trips', command='actions')
+        ActionChains(self.driver).send_keys(text).perform()
+
+    def _click_legacy(self, x, y):
+        if hasattr(self.driver, 'execute_cdp_cmd'):
+            for event_type in ('mousePressed', 'mouseReleased'):
+                self.instrumentation.incr('webdriver.round_trips', command='execute_cdp_cmd')
+                self.driver.execute_cdp_cmd('Input.dispatchMouseEvent', {'type': event_type, 'button': 'left',
+                                                                        'clickCount': 1, 'x': x, 'y': y})
+        else:
+            self.instrumentation.incr('webdriver.round_trips', command='execute_script')
+            self.driver.execute_script('document.elementFromPoint(%d, %d).click();' % (x, y))
+
 class testai_elem(webdriver.remote.webelement.WebElement):
-    def __init__(self, parent, source_elem, elem, driver, multiplier=1.0):
+    """
+        Element found by the classifier. Only its box is kept, the rect, size, location and center are worked out
+        from it when asked for, so long lists of them from find_elements stay small.
+    """
+    __slots__ = ('driver', 'multiplier', '_box', '_is_real_elem', '_inputs')
+
+    def __init__(self, parent, source_elem, elem, driver, multiplier=1.0, inputs=None):
         self._is_real_elem = False
         if not isinstance(source_elem, dict):
             # We need to also pass the _w3c flag otherwise the get_attribute for thing like html or text is messed up
@@ -894,32 +3815,42 @@ class testai_elem(webdriver.remote.webelement.WebElement):
             self._is_real_elem = True
         self.driver = driver
         self.multiplier = multiplier
-        self._text = elem.get('text', '')
-        self._size = {'width': elem.get('width', 0)/multiplier, 'height': elem.get('height', 0)/multiplier}
-        self._location = {'x': elem.get('x', 0)/multiplier, 'y': elem.get('y', 0)/multiplier}
-        self._property = elem.get('class', '')
-        self._rect = {}
-        self.rect.update(self._size)
-        self.rect.update(self._location)
-        self._tag_name = elem.get('class', '')
-        self._cx = elem.get('x', 0)/multiplier + elem.get('width', 0) / multiplier / 2
-        self._cy = elem.get('y', 0)/multiplier + elem.get('height', 0) /multiplier / 2
+        self._box = elem
+        # InputQueue shared with the other elements of the TestAiDriver
+        self._inputs = inputs
 
     @property
     def size(self):
-        return self._size
+        return {'width': self._box.get('width', 0) / self.multiplier, 'height': self._box.get('height', 0) / self.multiplier}
     @property
     def location(self):
-        return self._location
+        return {'x': self._box.get('x', 0) / self.multiplier, 'y': self._box.get('y', 0) / self.multiplier}
     @property
     def rect(self):
-        return self._rect
+        rect = self.size
+        rect.update(self.location)
+        return rect
     @property
     def tag_name(self):
-        return self._tag_name
+        return self._box.get('class', '')
+    @property
+    def _cx(self):
+        return (self._box.get('x', 0) + self._box.get('width', 0) / 2) / self.multiplier
+    @property
+    def _cy(self):
+        return (self._box.get('y', 0) + self._box.get('height', 0) / 2) / self.multiplier
+
+    def _queue(self):
+        if self._inputs is None:
+            self._inputs = InputQueue(self.driver)
+        return self._inputs
 
     def click(self, js_click=False):
+        queue = self._queue()
         if self._is_real_elem == True:
+            # Input still queued for other elements goes first
+            queue.flush()
+            queue.reset_focus()
             if not js_click:
                 webdriver.remote.webelement.WebElement.click(self)
             else:
@@ -927,19 +3858,28 @@ class testai_elem(webdriver.remote.webelement.WebElement):
                 self.driver.execute_script('document.elementFromPoint(%d, %d).click();' % (int(self._cx), int(self._cy)))
         else:
             # Multiplier needs to be undone as js doesn't care about it. only selenium/appium
-            self.driver.execute_cdp_cmd('Input.dispatchMouseEvent', { 'type': 'mousePressed', 'button': 'left', 'clickCount': 1, 'x': self._cx, 'y': self._cy})
-            time.sleep(0.05)
-            self.driver.execute_cdp_cmd('Input.dispatchMouseEvent', { 'type': 'mouseReleased', 'button': 'left', 'clickCount': 1, 'x': self._cx, 'y': self._cy})
+            queue.click(self._cx, self._cy).perform()
 
     def send_keys(self, value, click_first=True):
+        """
+            Types value into the element. click_first focuses it with a click, sent together with the keys, which
+            is skipped in a batch_input() block when the element was the last one clicked in it.
+        """
+        queue = self._queue()
         if click_first:
-            self.click()
-        actions = ActionChains(self.driver)
-        actions.send_keys(value)
-        actions.perform()
+            if self._is_real_elem == True:
+                queue.flush()
+                queue.reset_focus()
+                webdriver.remote.webelement.WebElement.click(self)
+            else:
+                queue.focus(self._cx, self._cy)
+        queue.send_keys(value).perform()
 
     def submit(self):
         self.send_keys('\n', click_first=False)
 
+class ServerUnavailableException(Exception):
+    pass
+
 class NoElementFoundException(Exception):
     pass
\ No newline at end of file
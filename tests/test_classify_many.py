@@ -0,0 +1,44 @@
+"""
+    find_by_element_names classifies several labels from one screenshot and looks up their elements together.
+"""
+from benchmarks import FakeWebDriver, StandInServer
+from test_ai import test_ai
+
+LABELS = ['email_field', 'password_field', 'login_button']
+
+
+class ScriptRecordingDriver(FakeWebDriver):
+    def __init__(self, **kwargs):
+        super().__init__(dom_size=100, **kwargs)
+        self.scripts = []
+
+    def execute_script(self, script, *args):
+        self.scripts.append(script)
+        return super().execute_script(script, *args)
+
+
+def find_by_element_names(tmp_path, classify_box, **kwargs):
+    driver = ScriptRecordingDriver()
+    with StandInServer(classify_box=classify_box) as server:
+        testai_driver = test_ai.TestAiDriver(driver, 'api-key', test_case_name='many', server_url=server.url,
+                                             cache_dir=str(tmp_path), **kwargs)
+        driver.scripts = []
+        try:
+            return testai_driver.find_by_element_names(LABELS), driver
+        finally:
+            testai_driver.quit()
+
+
+def test_elements_of_all_labels_are_matched_in_one_script(tmp_path):
+    elements, driver = find_by_element_names(tmp_path, {'x': 200, 'y': 200, 'width': 40, 'height': 20})
+    assert sorted(elements) == sorted(LABELS)
+    assert all(element is not None for element in elements.values())
+    assert driver.scripts.count(test_ai.MATCH_BOXES_SCRIPT) == 1
+    assert test_ai.MATCH_BOX_SCRIPT not in driver.scripts
+
+
+def test_use_cdp_needs_no_script(tmp_path):
+    elements, driver = find_by_element_names(tmp_path, {'x': 200, 'y': 200, 'width': 40, 'height': 20}, use_cdp=True)
+    assert all(element is not None for element in elements.values())
+    assert test_ai.MATCH_BOXES_SCRIPT not in driver.scripts
+    assert test_ai.MATCH_BOX_SCRIPT not in driver.scripts
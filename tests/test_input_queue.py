@@ -0,0 +1,124 @@
+"""
+    Clicks and keys of classifier-found elements are queued and sent in as few WebDriver commands as possible.
+"""
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.remote.command import Command
+
+from benchmarks import FakeWebDriver, StandInServer
+from test_ai import test_ai
+
+BOX = {'x': 10, 'y': 20, 'width': 40, 'height': 20}
+
+
+class RecordingDriver(FakeWebDriver):
+    """
+        FakeWebDriver keeping the input it was sent, as ('actions', sources) or ('cdp', method, params).
+    """
+    def __init__(self, **kwargs):
+        super().__init__(dom_size=10, **kwargs)
+        self.sent = []
+
+    def execute(self, driver_command, params=None):
+        if driver_command == Command.W3C_ACTIONS:
+            self.sent.append(('actions', params['actions']))
+        return super().execute(driver_command, params)
+
+    def execute_cdp_cmd(self, cmd, cmd_args):
+        if cmd.startswith('Input.'):
+            self.sent.append(('cdp', cmd, cmd_args))
+        return super().execute_cdp_cmd(cmd, cmd_args)
+
+
+def element(driver, inputs):
+    return test_ai.testai_elem(None, BOX, BOX, driver, 1.0, inputs=inputs)
+
+
+def sources(command):
+    return {source['type']: source['actions'] for source in command[1]}
+
+
+def pointer_downs(command):
+    return sum(action['type'] == 'pointerDown' for action in sources(command).get('pointer', []))
+
+
+def test_click_and_keys_are_one_command_with_aligned_ticks():
+    driver = RecordingDriver()
+    element(driver, test_ai.InputQueue(driver)).send_keys('ab' + Keys.ENTER)
+    assert len(driver.sent) == 1
+    ticks = sources(driver.sent[0])
+    assert len(ticks['pointer']) == len(ticks['key'])
+    # Every tick is either a pointer action or a key action, the other source pauses
+    for pointer, key in zip(ticks['pointer'], ticks['key']):
+        assert (pointer['type'] == 'pause') != (key['type'] == 'pause')
+    assert [a['type'] for a in ticks['pointer'][:3]] == ['pointerMove', 'pointerDown', 'pointerUp']
+    assert ticks['pointer'][0]['x'] == 30 and ticks['pointer'][0]['y'] == 30
+    assert [a['value'] for a in ticks['key'] if a['type'] == 'keyDown'] == ['a', 'b', Keys.ENTER]
+
+
+def test_send_keys_clicks_again_outside_a_batch():
+    driver = RecordingDriver()
+    field = element(driver, test_ai.InputQueue(driver))
+    field.send_keys('abc')
+    # The focus may move in between, e.g. by a click on a plain WebElement
+    driver.find_element('id', 'working').click()
+    field.send_keys('def')
+    assert [pointer_downs(command) for command in driver.sent] == [1, 1]
+
+
+def test_send_keys_clicks_once_in_a_batch():
+    driver = RecordingDriver()
+    inputs = test_ai.InputQueue(driver)
+    field = element(driver, inputs)
+    with inputs.batch():
+        field.send_keys('abc')
+        field.send_keys('def')
+        assert driver.sent == []
+    assert len(driver.sent) == 1
+    assert pointer_downs(driver.sent[0]) == 1
+
+
+def test_batch_drops_its_input_when_it_raises():
+    driver = RecordingDriver()
+    inputs = test_ai.InputQueue(driver)
+    try:
+        with inputs.batch():
+            element(driver, inputs).send_keys('abc')
+            raise ValueError()
+    except ValueError:
+        pass
+    assert driver.sent == []
+    inputs.flush()
+    assert driver.sent == []
+
+
+def test_use_cdp_clicks_with_cdp_and_types_key_events(tmp_path):
+    driver = RecordingDriver()
+    with StandInServer() as server:
+        testai_driver = test_ai.TestAiDriver(driver, 'api-key', test_case_name='input', server_url=server.url,
+                                             cache_dir=str(tmp_path), use_cdp=True)
+    element(driver, testai_driver.inputs).send_keys('hi')
+    assert [command[0] for command in driver.sent] == ['cdp', 'cdp', 'actions']
+    assert {command[1] for command in driver.sent[:2]} == {'Input.dispatchMouseEvent'}
+    assert [a['value'] for a in sources(driver.sent[2])['key'] if a['type'] == 'keyDown'] == ['h', 'i']
+
+
+def test_insert_text_is_opt_in():
+    driver = RecordingDriver()
+    element(driver, test_ai.InputQueue(driver, transport='cdp', insert_text=True)).send_keys('hi' + Keys.ENTER)
+    assert [command[1] for command in driver.sent][:3] == ['Input.dispatchMouseEvent', 'Input.dispatchMouseEvent',
+                                                           'Input.insertText']
+    assert driver.sent[2][2] == {'text': 'hi'}
+    assert [a['value'] for a in sources(driver.sent[3])['key'] if a['type'] == 'keyDown'] == [Keys.ENTER]
+
+
+def test_driver_without_w3c_actions_gets_clicks_and_keys_one_by_one():
+    driver = RecordingDriver()
+    driver.w3c = False
+    inputs = test_ai.InputQueue(driver)
+    element(driver, inputs).send_keys('hi')
+    element(driver, inputs).click()
+    clicks = [command[2] for command in driver.sent if command[0] == 'cdp']
+    assert [(c['type'], c['x'], c['y']) for c in clicks] == [('mousePressed', 30, 30), ('mouseReleased', 30, 30)] * 2
+    # The keys went through ActionChains, between the two clicks
+    assert [command[0] for command in driver.sent] == ['cdp', 'cdp', 'actions', 'cdp', 'cdp']
+    assert [a['value'] for a in sources(driver.sent[2])['key'] if a['type'] == 'keyDown'] == ['h', 'i']
@@ -0,0 +1,77 @@
+"""
+    The fast screenshot keys only depend on the pixels the md5 keys are computed over, and never reach the server.
+"""
+import io
+
+import numpy
+import pytest
+from PIL import Image
+
+from benchmarks import FakeWebDriver, StandInServer
+from test_ai import test_ai
+
+
+def png(pixels):
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def page(height=400, width=300):
+    pixels = numpy.full((height, width, 4), 255, dtype=numpy.uint8)
+    pixels[100:140, 20:200, :3] = (10, 120, 200)
+    return pixels
+
+
+def fast_key(data):
+    driver = test_ai.TestAiDriver.__new__(test_ai.TestAiDriver)
+    driver.hash_mode = 'fast'
+    return driver.get_screenshot_hash(test_ai.Screenshot(data=data))
+
+
+def test_fast_key_ignores_the_margins():
+    pixels = page()
+    changed = pixels.copy()
+    changed[:75] = 0
+    changed[-75:] = 7
+    changed[:, -50:] = 3
+    assert fast_key(png(pixels)) == fast_key(png(changed))
+
+
+def test_fast_key_changes_with_the_crop():
+    pixels = page()
+    changed = pixels.copy()
+    changed[200, 10, 0] ^= 1
+    assert fast_key(png(pixels)) != fast_key(png(changed))
+
+
+@pytest.mark.parametrize('height', [1, 100, 150, 151])
+@pytest.mark.parametrize('image_format', ['PNG', 'JPEG'])
+def test_fast_key_of_screenshots_smaller_than_the_margins(height, image_format):
+    buf = io.BytesIO()
+    Image.fromarray(page(height=height, width=40)[:, :, :3]).save(buf, image_format)
+    assert len(fast_key(buf.getvalue())) == 32
+
+
+def test_server_gets_md5_keys_in_fast_mode(tmp_path):
+    driver = FakeWebDriver(dom_size=50)
+    driver.broken_selectors.add('broken')
+    with StandInServer(classify_box={'x': 200, 'y': 200, 'width': 40, 'height': 20}) as server:
+        testai_driver = test_ai.TestAiDriver(driver, 'api-key', test_case_name='fast', server_url=server.url,
+                                             cache_dir=str(tmp_path), hash_mode='fast', async_uploads=False)
+        sent = []
+        post = testai_driver._post
+
+        def record(path, **kwargs):
+            body = kwargs.get('json') or {}
+            sent.extend(body[name] for name in ('screenshot_uuid', 'key') if name in body)
+            return post(path, **kwargs)
+
+        testai_driver._post = record
+        testai_driver.find_element('id', 'working', element_name='working')
+        testai_driver.find_element('id', 'broken', element_name='broken')
+    screenshot, key = testai_driver._capture()
+    testai_driver.hash_mode = 'md5'
+    md5_key = testai_driver.get_screenshot_hash(screenshot)
+    assert key != md5_key
+    assert sent and set(sent) == {md5_key}
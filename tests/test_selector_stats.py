@@ -0,0 +1,69 @@
+"""
+    Selectors that keep failing are only probed without the implicit wait, with a full wait retry now and then.
+"""
+import time
+
+from test_ai.test_ai import BoxCache, SelectorStats
+
+
+class CountingCache(BoxCache):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.gets = 0
+        self.puts = 0
+
+    def get(self, key, label):
+        self.gets += 1
+        return super().get(key, label)
+
+    def put(self, key, label, response):
+        self.puts += 1
+        return super().put(key, label, response)
+
+
+def break_selector(stats):
+    for _ in range(stats.failure_threshold):
+        assert not stats.should_probe('test', 'button')
+        stats.record('test', 'button', False)
+
+
+def test_healthy_selector_looks_up_the_cache_once():
+    cache = CountingCache()
+    stats = SelectorStats(cache)
+    for _ in range(10):
+        assert not stats.should_probe('test', 'button')
+        stats.record('test', 'button', True)
+    assert cache.gets == 1
+    assert cache.puts == 0
+
+
+def test_failed_probes_are_not_written():
+    cache = CountingCache()
+    stats = SelectorStats(cache)
+    break_selector(stats)
+    puts = cache.puts
+    for _ in range(5):
+        assert stats.should_probe('test', 'button')
+        stats.record('test', 'button', False, probed=True)
+    assert cache.puts == puts
+    assert stats.failures('test', 'button') == stats.failure_threshold
+
+
+def test_broken_selector_gets_the_full_wait_after_the_retry_interval():
+    stats = SelectorStats(BoxCache(), retry_interval=0.1)
+    break_selector(stats)
+    assert stats.should_probe('test', 'button')
+    time.sleep(0.1)
+    assert not stats.should_probe('test', 'button')
+    # Still broken with the full wait, probed for another interval
+    stats.record('test', 'button', False)
+    assert stats.should_probe('test', 'button')
+
+
+def test_found_selector_is_trusted_again():
+    stats = SelectorStats(BoxCache())
+    break_selector(stats)
+    stats.record('test', 'button', True, probed=True)
+    assert not stats.is_broken('test', 'button')
+    # Other drivers sharing the cache see it recovered
+    assert not SelectorStats(stats.cache).is_broken('test', 'button')
@@ -0,0 +1,188 @@
+"""
+    Server calls go through the circuit breaker, which stops calling a failing server for a while and then lets a
+    single trial call through. Only calls that never reached the server or were turned away by a proxy are retried.
+"""
+import asyncio
+import socket
+import time
+
+import pytest
+import urllib3.util.connection
+
+from benchmarks import FakeWebDriver, StandInServer
+from test_ai import test_ai
+
+# Answered with success by the stand-in server and not called when the driver is created
+ENDPOINT = '/test_case/set_test_case_status'
+DRIVER_CLASSES = [test_ai.TestAiDriver, pytest.param(test_ai.AsyncTestAiDriver, id='async')]
+
+
+def new_driver(server, tmp_path, driver_class=test_ai.TestAiDriver, **kwargs):
+    kwargs.setdefault('circuit_breaker_threshold', 1)
+    kwargs.setdefault('circuit_breaker_cooldown', 0.1)
+    return driver_class(FakeWebDriver(dom_size=10), 'api-key', test_case_name='server-calls', server_url=server.url,
+                        cache_dir=str(tmp_path), **kwargs)
+
+
+def open_circuit(testai_driver):
+    testai_driver.circuit_breaker.record_failure()
+    assert not testai_driver.circuit_breaker.allow()
+    time.sleep(testai_driver.circuit_breaker.cooldown)
+
+
+def test_cancelled_async_trial_lets_the_next_call_through(tmp_path):
+    pytest.importorskip('aiohttp')
+    with StandInServer() as server:
+        testai_driver = new_driver(server, tmp_path, test_ai.AsyncTestAiDriver)
+
+        async def main():
+            open_circuit(testai_driver)
+            server.latency = 1.0
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(testai_driver.checkin_async(), 0.2)
+            await testai_driver.close_async()
+
+        asyncio.run(main())
+    assert testai_driver.circuit_breaker.allow()
+
+
+def test_interrupted_trial_lets_the_next_call_through(tmp_path):
+    with StandInServer() as server:
+        testai_driver = new_driver(server, tmp_path)
+        open_circuit(testai_driver)
+
+        def interrupted(*args, **kwargs):
+            raise KeyboardInterrupt()
+
+        testai_driver.session.post = interrupted
+        with pytest.raises(KeyboardInterrupt):
+            testai_driver._post('/sdk_checkin', json={})
+    assert testai_driver.circuit_breaker.allow()
+
+
+def post(testai_driver, **kwargs):
+    if not isinstance(testai_driver, test_ai.AsyncTestAiDriver):
+        return testai_driver._post(ENDPOINT, json={}, **kwargs)
+    pytest.importorskip('aiohttp')
+
+    async def main():
+        try:
+            return await testai_driver._post_async(ENDPOINT, json={}, **kwargs)
+        finally:
+            await testai_driver._aiohttp_session.close()
+
+    return asyncio.run(main())
+
+
+def closed_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_circuit_breaker_opens_after_the_threshold_and_lets_one_trial_through():
+    breaker = test_ai.CircuitBreaker(failure_threshold=2, cooldown=0.1)
+    breaker.record_failure()
+    assert breaker.allow() and not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open and not breaker.allow()
+    time.sleep(0.1)
+    assert breaker.allow()
+    # Only one trial at a time
+    assert not breaker.allow()
+    # A failed trial opens the circuit for another cooldown
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.1)
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow() and breaker.allow()
+
+
+@pytest.mark.parametrize('driver_class', DRIVER_CLASSES)
+def test_open_circuit_does_not_call_the_server(tmp_path, driver_class):
+    with StandInServer() as server:
+        testai_driver = new_driver(server, tmp_path, driver_class)
+        server.fail_next(ENDPOINT, 500)
+        assert post(testai_driver).status_code == 500
+        with pytest.raises(test_ai.ServerUnavailableException):
+            post(testai_driver)
+        assert server.requests[ENDPOINT] == 1
+        # The trial after the cooldown closes the circuit again
+        time.sleep(testai_driver.circuit_breaker.cooldown)
+        assert post(testai_driver).status_code == 200
+        assert not testai_driver.circuit_breaker.is_open
+
+
+@pytest.mark.parametrize('driver_class', DRIVER_CLASSES)
+@pytest.mark.parametrize('status', [502, 503, 504])
+def test_gateway_errors_are_retried(tmp_path, driver_class, status):
+    with StandInServer() as server:
+        testai_driver = new_driver(server, tmp_path, driver_class, retry_backoff=0.01)
+        server.fail_next(ENDPOINT, status, status)
+        assert post(testai_driver).status_code == 200
+        assert server.requests[ENDPOINT] == 3
+        server.fail_next(ENDPOINT, status, status, status)
+        assert post(testai_driver).status_code == status
+        assert server.requests[ENDPOINT] == 6
+
+
+@pytest.mark.parametrize('driver_class', DRIVER_CLASSES)
+@pytest.mark.parametrize('status', [400, 429, 500])
+def test_other_errors_are_not_retried(tmp_path, driver_class, status):
+    with StandInServer() as server:
+        testai_driver = new_driver(server, tmp_path, driver_class, retry_backoff=0.01)
+        server.fail_next(ENDPOINT, status)
+        assert post(testai_driver).status_code == status
+        assert server.requests[ENDPOINT] == 1
+
+
+@pytest.mark.parametrize('driver_class', DRIVER_CLASSES)
+def test_read_timeout_does_not_send_the_post_again(tmp_path, driver_class):
+    with StandInServer() as server:
+        testai_driver = new_driver(server, tmp_path, driver_class, retry_backoff=0.01,
+                                   timeouts={ENDPOINT: (1, 0.2)})
+        server.latency = 0.5
+        with pytest.raises(Exception):
+            post(testai_driver)
+        # Requests are counted once they were answered
+        time.sleep(1)
+        assert server.requests[ENDPOINT] == 1
+
+
+def test_failed_connects_are_retried(tmp_path, monkeypatch):
+    connects = []
+    create_connection = urllib3.util.connection.create_connection
+
+    def count(*args, **kwargs):
+        connects.append(args[0])
+        return create_connection(*args, **kwargs)
+
+    monkeypatch.setattr(urllib3.util.connection, 'create_connection', count)
+    testai_driver = test_ai.TestAiDriver(FakeWebDriver(dom_size=10), 'api-key', test_case_name='server-calls',
+                                         server_url='http://127.0.0.1:%d' % closed_port(), cache_dir=str(tmp_path),
+                                         retry_backoff=0.01)
+    connects.clear()
+    with pytest.raises(Exception):
+        post(testai_driver)
+    assert len(connects) == 3
+
+
+def test_failed_connects_are_retried_async(tmp_path, monkeypatch):
+    pytest.importorskip('aiohttp')
+    backoffs = []
+    sleep = asyncio.sleep
+
+    async def record(delay, *args, **kwargs):
+        backoffs.append(delay)
+        return await sleep(0, *args, **kwargs)
+
+    testai_driver = test_ai.AsyncTestAiDriver(FakeWebDriver(dom_size=10), 'api-key', test_case_name='server-calls',
+                                              server_url='http://127.0.0.1:%d' % closed_port(),
+                                              cache_dir=str(tmp_path), retry_backoff=0.01)
+    monkeypatch.setattr(asyncio, 'sleep', record)
+    with pytest.raises(Exception):
+        post(testai_driver)
+    # Two retries after the first attempt, with exponential backoff
+    assert [delay for delay in backoffs if delay] == [0.01, 0.02]
@@ -0,0 +1,208 @@
+"""
+    TestAiDriver is used by one thread at a time, while any number of them run side by side in threads or processes
+    sharing the caches in cache_dir. These check that no entries are lost when they do.
+"""
+import multiprocessing
+import os
+import threading
+
+import numpy
+import pytest
+
+from benchmarks import FakeWebDriver, StandInServer
+from test_ai import test_ai
+from test_ai.test_ai import BoxCache, TemplateStore
+
+THREADS = 8
+PROCESSES = 4
+ENTRIES = 50
+
+
+def run_threads(target, count=THREADS):
+    errors = []
+
+    def run(i):
+        try:
+            target(i)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def run_processes(target, *args, count=PROCESSES):
+    # spawn so the workers share nothing with the test process but the files
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=target, args=(i,) + args) for i in range(count)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    assert [process.exitcode for process in processes] == [0] * count
+
+
+def box(i, j):
+    return {'x': i, 'y': j, 'width': 10, 'height': 10}
+
+
+def template(i, j):
+    return numpy.array([[i, j] * 2] * 4, dtype=numpy.uint8)
+
+
+def put_boxes(i, path, shared=False):
+    cache = BoxCache(path, shared=shared, sync_interval=0)
+    for j in range(ENTRIES):
+        cache.put('screenshot-%d' % i, 'label-%d' % j, {'success': True, 'box': box(i, j)})
+        if j % 10 == 0:
+            cache.save()
+    cache.save()
+
+
+def put_templates(i, path):
+    store = TemplateStore(path)
+    for j in range(ENTRIES):
+        store.put('label-%d-%d' % (i, j), template(i, j), box(i, j), key='screenshot-%d' % i)
+        if j % 10 == 0:
+            store.save()
+    store.save()
+
+
+def assert_all_boxes(path, writers):
+    cache = BoxCache(path)
+    assert len(cache) == writers * ENTRIES
+    for i in range(writers):
+        for j in range(ENTRIES):
+            assert cache.get('screenshot-%d' % i, 'label-%d' % j) == {'success': True, 'box': box(i, j)}
+
+
+def assert_all_templates(path, writers):
+    store = TemplateStore(path)
+    assert len(store) == writers * ENTRIES
+    for i in range(writers):
+        for j in range(ENTRIES):
+            stored, stored_box, key = store.get('label-%d-%d' % (i, j))
+            assert (stored == template(i, j)).all()
+            assert stored_box == box(i, j)
+            assert key == 'screenshot-%d' % i
+
+
+def test_box_cache_put_and_save_from_threads(tmp_path):
+    path = str(tmp_path / 'box_cache.json')
+    cache = BoxCache(path)
+
+    def put(i):
+        for j in range(ENTRIES):
+            cache.put('screenshot-%d' % i, 'label-%d' % j, {'success': True, 'box': box(i, j)})
+            if j % 10 == 0:
+                cache.save()
+
+    run_threads(put)
+    cache.save()
+    assert_all_boxes(path, THREADS)
+
+
+def test_box_cache_saves_from_processes_are_merged(tmp_path):
+    path = str(tmp_path / 'box_cache.json')
+    run_processes(put_boxes, path)
+    assert_all_boxes(path, PROCESSES)
+    assert not os.path.exists(path + '.tmp')
+
+
+def test_shared_box_cache_sees_entries_of_other_processes(tmp_path):
+    path = str(tmp_path / 'box_cache.json')
+    cache = BoxCache(path, shared=True)
+    assert cache.get('screenshot-0', 'label-0') is None
+    run_processes(put_boxes, path, True, count=1)
+    # A miss re-reads the file once another process changed it
+    assert cache.get('screenshot-0', 'label-0') == {'success': True, 'box': box(0, 0)}
+
+
+def test_template_store_put_and_save_from_threads(tmp_path):
+    path = str(tmp_path / 'templates.npz')
+    store = TemplateStore(path)
+
+    def put(i):
+        for j in range(ENTRIES):
+            store.put('label-%d-%d' % (i, j), template(i, j), box(i, j), key='screenshot-%d' % i)
+            if j % 10 == 0:
+                store.save()
+
+    run_threads(put)
+    store.save()
+    assert_all_templates(path, THREADS)
+
+
+def test_template_store_saves_from_processes_are_merged(tmp_path):
+    path = str(tmp_path / 'templates.npz')
+    run_processes(put_templates, path)
+    assert_all_templates(path, PROCESSES)
+
+
+@pytest.mark.parametrize('shared_cache', [False, True])
+def test_drivers_in_threads_share_one_cache(tmp_path, shared_cache):
+    classify_box = {'x': 200, 'y': 200, 'width': 40, 'height': 20}
+    drivers = []
+    with StandInServer(classify_box=classify_box) as server:
+        def run(i):
+            driver = FakeWebDriver(dom_size=100)
+            driver.broken_selectors.add('broken')
+            testai_driver = test_ai.TestAiDriver(driver, 'api-key', test_case_name='test-%d' % i,
+                                                 server_url=server.url, cache_dir=str(tmp_path),
+                                                 shared_cache=shared_cache)
+            drivers.append(testai_driver)
+            for _ in range(3):
+                testai_driver.find_element('id', 'working', element_name='button')
+                assert testai_driver.find_element('id', 'broken', element_name='broken') is not None
+            testai_driver.quit()
+
+        run_threads(run)
+    assert len({id(testai_driver.box_cache) for testai_driver in drivers}) == 1
+    box_cache = drivers[0].box_cache
+    box_cache.save()
+    assert len(box_cache) > 0
+    assert len(BoxCache(box_cache.path)) == len(box_cache)
+
+
+def find_and_exit(i, url, cache_dir):
+    driver = FakeWebDriver(dom_size=100)
+    driver.broken_selectors.add('broken')
+    testai_driver = test_ai.TestAiDriver(driver, 'api-key', test_case_name='exit', server_url=url, cache_dir=cache_dir,
+                                         region_of_interest=True)
+    for _ in range(2):
+        testai_driver.find_element('id', 'working', element_name='button')
+        testai_driver.find_element('id', 'broken', element_name='broken')
+    testai_driver.quit()
+    # Like a forked worker or a killed run, without the atexit handlers
+    os._exit(0)
+
+
+def test_quit_writes_the_caches_without_atexit(tmp_path):
+    with StandInServer(classify_box={'x': 200, 'y': 200, 'width': 40, 'height': 20}) as server:
+        run_processes(find_and_exit, server.url, str(tmp_path), count=1)
+    names = sorted(name.rsplit('_', 1)[0] for name in os.listdir(str(tmp_path)) if name.endswith('.json'))
+    assert names == ['box_cache', 'label_boxes', 'selector_stats', 'training_log']
+    for name in os.listdir(str(tmp_path)):
+        if name.endswith('.json'):
+            assert len(BoxCache(str(tmp_path / name))) > 0
+
+
+def test_record_then_replay_in_one_process(tmp_path):
+    bundle = str(tmp_path / 'bundle.json.gz')
+    driver = FakeWebDriver(dom_size=100)
+    driver.broken_selectors.add('broken')
+    with StandInServer(classify_box={'x': 200, 'y': 200, 'width': 40, 'height': 20}) as server:
+        recording = test_ai.TestAiDriver(driver, 'api-key', test_case_name='replay', server_url=server.url,
+                                         cache_dir=str(tmp_path / 'record'), replay_mode='record',
+                                         replay_bundle=bundle)
+        recorded = recording.find_element('id', 'broken', element_name='broken').rect
+        recording.flush()
+    # The server is gone, every response has to come from the bundle
+    replaying = test_ai.TestAiDriver(driver, 'api-key', test_case_name='replay', server_url=server.url,
+                                     cache_dir=str(tmp_path / 'replay'), replay_mode='replay', replay_bundle=bundle)
+    assert replaying.replay_bundle is not recording.replay_bundle
+    assert replaying.find_element('id', 'broken', element_name='broken').rect == recorded
@@ -0,0 +1,78 @@
+"""
+    While creating a test case the SDK waits for the box of an element to be drawn in the UI, long polling the server
+    and falling back to polling every few seconds on servers that answer right away.
+"""
+import threading
+import time
+
+from benchmarks import FakeWebDriver, StandInServer
+from test_ai import test_ai
+
+BOX = {'x': 200, 'y': 200, 'width': 40, 'height': 20}
+
+
+def new_driver(server, tmp_path, monkeypatch, **kwargs):
+    monkeypatch.setenv('TESTAI_INTERACTIVE', '1')
+    monkeypatch.setattr(test_ai.webbrowser, 'open', lambda url: None)
+    return test_ai.TestAiDriver(FakeWebDriver(dom_size=50), 'api-key', test_case_name='creation',
+                                server_url=server.url, cache_dir=str(tmp_path), **kwargs)
+
+
+def record_posts(testai_driver):
+    sent = []
+    post = testai_driver._post
+
+    def record(path, **kwargs):
+        sent.append((path, kwargs))
+        return post(path, **kwargs)
+
+    testai_driver._post = record
+    return sent
+
+
+def test_gives_up_at_the_interactive_timeout(tmp_path, monkeypatch):
+    with StandInServer() as server:
+        testai_driver = new_driver(server, tmp_path, monkeypatch, interactive_timeout=0.5)
+        sent = record_posts(testai_driver)
+        start = time.time()
+        element, _, msg = testai_driver._classify_for_test_case('button')
+        elapsed = time.time() - start
+    assert element is None
+    assert 'Timed out after 0.5s' in msg
+    assert 0.5 <= elapsed < 2
+    # The poll is held open for what is left of the timeout rather than long_poll_wait
+    polls = [kwargs['json'] for path, kwargs in sent if path == '/test_case/get_bounding_box' and 'json' in kwargs]
+    assert len(polls) == 1
+    assert 0 < polls[0]['wait'] <= 0.5
+
+
+def test_polls_do_not_send_the_screenshot_again(tmp_path, monkeypatch):
+    with StandInServer() as server:
+        testai_driver = new_driver(server, tmp_path, monkeypatch, interactive_timeout=5, long_poll_wait=0.2)
+        sent = record_posts(testai_driver)
+        threading.Timer(0.7, server.label_test_case_box, ('button', BOX)).start()
+        element, _, msg = testai_driver._classify_for_test_case('button')
+    assert element is not None and msg == ''
+    requests = [kwargs for path, kwargs in sent if path == '/test_case/get_bounding_box']
+    assert len(requests) > 2
+    # Only the first request runs the classifier on the screenshot, the polls just send its key
+    assert 'json' not in requests[0]
+    for kwargs in requests[1:]:
+        assert set(kwargs['json']) == {'api_key', 'label', 'screenshot_uuid', 'run_classifier', 'wait'}
+        assert kwargs['json']['run_classifier'] is False
+    assert server.requests['/test_case/upload_screenshot'] == 1
+
+
+def test_polls_every_interval_when_the_server_answers_right_away(tmp_path, monkeypatch):
+    with StandInServer(long_poll=False) as server:
+        testai_driver = new_driver(server, tmp_path, monkeypatch, interactive_timeout=1)
+        start = time.time()
+        assert testai_driver._wait_for_test_case_box('button', poll_interval=0.2) is None
+        elapsed = time.time() - start
+        polls = server.requests['/test_case/get_bounding_box']
+        server.reset_counters()
+        threading.Timer(0.3, server.label_test_case_box, ('button', BOX)).start()
+        assert testai_driver._wait_for_test_case_box('button', poll_interval=0.2) == BOX
+    assert 1 <= elapsed < 1.5
+    assert 4 <= polls <= 6
+    assert server.requests['/test_case/get_bounding_box'] <= 3